@@ -0,0 +1,277 @@
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import threading
+import argparse
+import requests
+import base64
+import socket
+import json
+import time
+import sys
+import os
+
+from stubServers import start_in_background, url_overrides, IMAGE_BASE64
+
+# Load test of every route in app.py (or asyncApp.py) against the local provider stubs (stubServers.py), hence the
+# real provider APIs are never called. Reports throughput, p50/p95/p99 latency, time to first byte for the streaming
+# routes and the peak RSS of the server process while each route was being driven. Results are saved as JSON and can be
+# compared with a previous run to spot regressions.
+# Run from this directory: python loadTest.py --concurrency 20 --requests 200 --output results.json
+# Compare with a previous run: python loadTest.py --compare results.json
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+CHAT_BODY = {"messages": [{"role": "user", "text": "Hello"}], "model": "gpt-4o-mini"}
+
+# route: (request type, streamed response)
+ROUTES = {
+    "chat": ("json", False),
+    "chat-stream": ("json", True),
+    "files": ("files", False),
+    "openai-chat": ("json", False),
+    "openai-chat-stream": ("json", True),
+    "openai-image": ("files", False),
+    "huggingface-conversation": ("json", False),
+    "huggingface-image": ("files", False),
+    "huggingface-speech": ("files", False),
+    "stability-text-to-image": ("json", False),
+    "stability-image-to-image": ("files+text", False),
+    "stability-image-upscale": ("files", False),
+    "cohere-chat": ("json", False),
+    "cohere-chat-stream": ("json", True),
+    "cohere-generate": ("json", False),
+    "cohere-generate-stream": ("json", True),
+    "cohere-summarize": ("json", False),
+}
+
+SERVER_COMMANDS = {
+    "sync": lambda port: [sys.executable, "app.py"],
+    "async": lambda port: [sys.executable, "-m", "hypercorn", "asyncApp:app", "--bind", f"127.0.0.1:{port}"],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, stub_port, extra_env):
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "UPSTREAM_URL_OVERRIDES": url_overrides(stub_port),
+        "OPENAI_API_KEY": "stub", "COHERE_API_KEY": "stub",
+        "HUGGING_FACE_API_KEY": "stub", "STABILITY_API_KEY": "stub",
+    })
+    env.update(extra_env)
+    process = subprocess.Popen(SERVER_COMMANDS[mode](port), cwd=SRC_DIRECTORY, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.post(f"http://127.0.0.1:{port}/chat", json=CHAT_BODY, timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("The server did not start within 30 seconds")
+
+
+def rss_bytes(pid):
+    total = 0
+    # the server process and its workers (if any)
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            pids += [int(child) for child in file.read().split()]
+    except OSError:
+        pass
+    for process_id in pids:
+        try:
+            with open(f"/proc/{process_id}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class RSSSampler:
+    def __init__(self, pid, interval=0.02):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while self.pid and not self._stop.is_set():
+            self.peak = max(self.peak, rss_bytes(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def file_payload(index, size):
+    # every request is unique so that single-flight and the response cache do not skew the results
+    return base64.b64decode(IMAGE_BASE64) + index.to_bytes(8, "big") + os.urandom(max(size - 75, 0))
+
+
+def send(session, url, route, index, file_size):
+    request_type, streamed = ROUTES[route]
+    body = dict(CHAT_BODY, messages=[{"role": "user", "text": f"Hello {index}"}])
+    kwargs = {"stream": streamed, "timeout": 120}
+    if request_type == "json":
+        kwargs["json"] = body
+    else:
+        kwargs["files"] = [("files", (f"file{index}.png", file_payload(index, file_size), "image/png"))]
+        if request_type == "files+text":
+            kwargs["data"] = {"message1": json.dumps({"role": "user", "text": f"Hello {index}"})}
+    start = time.perf_counter()
+    response = session.post(url, **kwargs)
+    first_byte = None
+    size = 0
+    for chunk in response.iter_content(chunk_size=None):
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        size += len(chunk)
+    latency = time.perf_counter() - start
+    return response.status_code, latency, first_byte if first_byte is not None else latency, size
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_route(base_url, route, concurrency, request_count, file_size, pid):
+    url = f"{base_url}/{route}"
+    local = threading.local()
+
+    def task(index):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        try:
+            return send(local.session, url, route, index, file_size)
+        except requests.RequestException:
+            return None, None, None, 0
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        # warm up connections and lazily initialized code paths
+        list(executor.map(task, range(min(concurrency, 10))))
+        with RSSSampler(pid) as sampler:
+            start = time.perf_counter()
+            results = list(executor.map(task, range(request_count)))
+            elapsed = time.perf_counter() - start
+    ok = [result for result in results if result[0] == 200]
+    latencies = [result[1] for result in ok]
+    first_bytes = [result[2] for result in ok]
+    milliseconds = lambda value: round(value * 1000, 2) if value is not None else None
+    stats = {
+        "requests": request_count,
+        "errors": request_count - len(ok),
+        "throughput_rps": round(len(ok) / elapsed, 2),
+        "p50_ms": milliseconds(percentile(latencies, 0.50)),
+        "p95_ms": milliseconds(percentile(latencies, 0.95)),
+        "p99_ms": milliseconds(percentile(latencies, 0.99)),
+        "peak_rss_mb": round(sampler.peak / (1024 * 1024), 1) if pid else None,
+        "response_bytes": sum(result[3] for result in ok),
+    }
+    if ROUTES[route][1]:
+        stats["ttfb_p50_ms"] = milliseconds(percentile(first_bytes, 0.50))
+        stats["ttfb_p95_ms"] = milliseconds(percentile(first_bytes, 0.95))
+    return stats
+
+
+def compare(previous, current):
+    print("\nComparison with the previous run (positive = slower/larger):")
+    for route, stats in current["routes"].items():
+        before = previous.get("routes", {}).get(route)
+        if not before:
+            continue
+        changes = []
+        for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "ttfb_p50_ms", "peak_rss_mb"):
+            if stats.get(key) and before.get(key):
+                change = (stats[key] - before[key]) / before[key] * 100
+                # higher throughput is better, hence its sign is flipped so that positive is always a regression
+                changes.append(f"{key} {-change if key == 'throughput_rps' else change:+.1f}%")
+        print(f"{route:<26} " + ", ".join(changes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", choices=["sync", "async", "none"], default="sync",
+                        help="app to start, use none to test an already running server (--url)")
+    parser.add_argument("--url", default=None, help="base url of an already running server")
+    parser.add_argument("--pid", type=int, default=None, help="pid of an already running server for the RSS sampling")
+    parser.add_argument("--routes", default=",".join(ROUTES))
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100, help="requests per route")
+    parser.add_argument("--file-kb", type=int, default=256, help="size of the uploaded files")
+    parser.add_argument("--latency", type=float, default=50, help="stub response latency in milliseconds")
+    parser.add_argument("--tokens", type=int, default=20, help="tokens per stub response/stream")
+    parser.add_argument("--token-delay", type=float, default=10, help="milliseconds between stub stream tokens")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of the stub calls answered with a 503")
+    parser.add_argument("--env", action="append", default=[], help="extra server environment variable: NAME=value")
+    parser.add_argument("--output", default="results.json")
+    parser.add_argument("--compare", default=None, help="results file of a previous run")
+    arguments = parser.parse_args()
+
+    previous = None
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            previous = json.load(file)
+
+    stub = start_in_background(latency=arguments.latency / 1000, tokens=arguments.tokens,
+                               token_delay=arguments.token_delay / 1000, error_rate=arguments.error_rate)
+    stub_port = stub.server_address[1]
+    server = None
+    if arguments.server == "none":
+        base_url = arguments.url.rstrip("/")
+        pid = arguments.pid
+        # the peak RSS is only sampled when the pid of the server is provided
+        print(f"Make sure the server was started with UPSTREAM_URL_OVERRIDES={url_overrides(stub_port)}")
+    else:
+        port = free_port()
+        extra_env = dict(variable.split("=", 1) for variable in arguments.env)
+        server = start_server(arguments.server, port, stub_port, extra_env)
+        base_url = f"http://127.0.0.1:{port}"
+        pid = server.pid
+
+    results = {"config": vars(arguments), "timestamp": time.time(), "routes": {}}
+    try:
+        print(f"{'route':<26} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'ttfb50':>8} {'rss MB':>8} {'errors':>6}")
+        for route in arguments.routes.split(","):
+            stats = run_route(base_url, route, arguments.concurrency, arguments.requests, arguments.file_kb * 1024, pid)
+            results["routes"][route] = stats
+            print(f"{route:<26} {stats['throughput_rps']:>8} {stats['p50_ms']!s:>8} {stats['p95_ms']!s:>8} "
+                  f"{stats['p99_ms']!s:>8} {stats.get('ttfb_p50_ms', '-')!s:>8} {stats['peak_rss_mb']:>8} "
+                  f"{stats['errors']:>6}")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        stub.shutdown()
+
+    batch_sizes = stub.RequestHandlerClass.batch_sizes
+    if batch_sizes:
+        # the server was started with MICRO_BATCHING=true (--env MICRO_BATCHING=true)
+        results["micro_batches"] = {"batches": len(batch_sizes), "average_size": round(sum(batch_sizes) / len(batch_sizes), 2)}
+        print(f"\nMicro-batches received by the stub: {len(batch_sizes)}, "
+              f"average size: {results['micro_batches']['average_size']}")
+
+    with open(arguments.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nResults saved to {arguments.output}")
+    if previous:
+        compare(previous, results)
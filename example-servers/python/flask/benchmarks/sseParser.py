@@ -0,0 +1,92 @@
+import argparse
+import random
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from utils.sse import SSEParser
+
+# Throughput benchmark for the incremental SSE parser (src/utils/sse.py) using a large synthetic OpenAI-style stream
+# that is split into randomly sized chunks, compared with the previous chunk-by-chunk parsing of OpenAI.chat_stream.
+# Run from this directory: python sseParser.py --events 200000
+
+
+def create_stream(event_count):
+    words = ["Hello", "world", "streaming", "tokens", "żółć", "日本語", "🙂", "\\n", "\""]
+    events = []
+    for index in range(event_count):
+        content = words[index % len(words)]
+        events.append("data: " + json.dumps({"choices": [{"delta": {"content": content}}]}) + "\n\n")
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode(), event_count
+
+
+def split_into_chunks(stream, min_size, max_size, seed):
+    generator = random.Random(seed)
+    chunks = []
+    position = 0
+    while position < len(stream):
+        size = generator.randint(min_size, max_size)
+        chunks.append(stream[position:position + size])
+        position += size
+    return chunks
+
+
+def parse_incrementally(chunks):
+    parser = SSEParser()
+    tokens = 0
+    for chunk in chunks:
+        for event in parser.feed(chunk):
+            if event.data != "[DONE]":
+                json.loads(event.data)
+                tokens += 1
+    for event in parser.flush():
+        if event.data != "[DONE]":
+            tokens += 1
+    return tokens
+
+
+# the previous implementation - each chunk is decoded and split on its own, hence events split across chunks are lost
+def parse_per_chunk(chunks):
+    tokens = 0
+    crashes = 0
+    for chunk in chunks:
+        try:
+            lines = chunk.decode().split("\n")
+        except UnicodeDecodeError:
+            crashes += 1
+            continue
+        for line in filter(lambda line: line.strip(), lines):
+            data = line.replace("data:", "").replace("[DONE]", "").replace("data: [DONE]", "").strip()
+            if data:
+                try:
+                    json.loads(data)
+                    tokens += 1
+                except json.JSONDecodeError:
+                    pass
+    return tokens, crashes
+
+
+def run(name, parse, chunks, stream_size):
+    start = time.perf_counter()
+    result = parse(chunks)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<22} {elapsed * 1000:9.1f} ms {stream_size / elapsed / 1e6:9.1f} MB/s   result: {result}")
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--events", type=int, default=200000)
+    argument_parser.add_argument("--min-chunk", type=int, default=1)
+    argument_parser.add_argument("--max-chunk", type=int, default=4096)
+    argument_parser.add_argument("--seed", type=int, default=1)
+    arguments = argument_parser.parse_args()
+
+    stream, expected_tokens = create_stream(arguments.events)
+    chunks = split_into_chunks(stream, arguments.min_chunk, arguments.max_chunk, arguments.seed)
+    print(f"{len(stream) / 1e6:.1f} MB, {expected_tokens} tokens, {len(chunks)} chunks")
+    run("incremental parser", parse_incrementally, chunks, len(stream))
+    run("per-chunk (previous)", parse_per_chunk, chunks, len(stream))
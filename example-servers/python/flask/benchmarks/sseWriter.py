@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from utils.sseWriter import SSEWriter, CODECS
+from utils.config import config
+
+# Encoding throughput of the shared SSE frame writer (src/utils/sseWriter.py) compared with the previous per-token
+# "data: {json.dumps(...)}" formatting of the streaming routes. The tokens are produced without any delay, hence with a
+# coalescing window every --coalesce-bytes of text become a single frame (the upper bound of the saving). Coalescing is
+# only done by the async writer (aframes) that is used by asyncApp.py, the sync writer sends a frame per token.
+# Run from this directory: python sseWriter.py --tokens 500000
+
+
+def create_tokens(count):
+    words = ["Hello", "world", "streaming", "tokens", "żółć", "日本語", "🙂", "\n", "\""]
+    return [words[index % len(words)] + " " for index in range(count)]
+
+
+# the previous implementation
+def format_per_token(tokens):
+    return ["data: {}\n\n".format(json.dumps({"text": token})) for token in tokens]
+
+
+def create_writer(codec, window, max_bytes):
+    os.environ["SSE_JSON_CODEC"] = codec
+    os.environ["SSE_COALESCE_MS"] = str(window)
+    os.environ["SSE_COALESCE_BYTES"] = str(max_bytes)
+    config.load()
+    writer = SSEWriter()
+    writer.codec()
+    return writer
+
+
+def coalesce(writer, tokens):
+    async def texts():
+        for token in tokens:
+            yield token
+
+    async def collect():
+        return [frame async for frame in writer.aframes(texts())]
+    return asyncio.run(collect())
+
+
+def run(name, write, tokens):
+    start = time.perf_counter()
+    frames = write(tokens)
+    elapsed = time.perf_counter() - start
+    size = sum(len(frame) for frame in frames)
+    print(f"{name:<32} {elapsed * 1000:9.1f} ms {len(tokens) / elapsed / 1e6:6.2f} M tokens/s "
+          f"{len(frames):>9} frames {size / 1e6:7.1f} MB")
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--tokens", type=int, default=500000)
+    argument_parser.add_argument("--coalesce-bytes", type=int, default=256)
+    arguments = argument_parser.parse_args()
+
+    tokens = create_tokens(arguments.tokens)
+    run("per-token json.dumps (previous)", format_per_token, tokens)
+    for codec in CODECS:
+        writer = create_writer(codec, 0, arguments.coalesce_bytes)
+        # the codec is not installed
+        if writer.codec() != codec:
+            continue
+        run(f"writer {codec}", lambda tokens: list(writer.frames(tokens)), tokens)
+        writer = create_writer(codec, 1000, arguments.coalesce_bytes)
+        run(f"async writer {codec} coalesced", lambda tokens: coalesce(writer, tokens), tokens)
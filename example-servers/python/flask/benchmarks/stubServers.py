@@ -0,0 +1,177 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import argparse
+import random
+import json
+import time
+
+# Local stand-in for the OpenAI, Cohere, Hugging Face and Stability AI endpoints that are used by src/services.
+# The paths of the providers do not overlap, hence a single server can stand in for all of them - point the app at it
+# with UPSTREAM_URL_OVERRIDES (see UPSTREAM_HOSTS below or run this file to print the exact value).
+# Run standalone: python stubServers.py --port 9100 --latency 200 --tokens 50 --token-delay 20
+# --error-rate answers that share of the calls with a 503 to exercise the retries and circuit breakers of the app
+
+UPSTREAM_HOSTS = [
+    "https://api.openai.com",
+    "https://api.cohere.ai",
+    "https://api-inference.huggingface.co",
+    "https://api.stability.ai",
+]
+
+# 1x1 transparent png
+IMAGE_BASE64 = ("iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII=")
+
+
+def url_overrides(port):
+    return ",".join(f"{host}=http://127.0.0.1:{port}" for host in UPSTREAM_HOSTS)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # otherwise the delayed ACK of small responses adds ~40ms to every keep-alive request
+    disable_nagle_algorithm = True
+    # set by create_server
+    latency = 0
+    tokens = 20
+    token_delay = 0
+    error_rate = 0
+    # sizes of the received micro-batches
+    batch_sizes = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else self._read_chunked()
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return self._send_json({"message": "Stub provider is unavailable"}, status=503)
+        path = self.path
+        if path == "/v1/chat/completions":
+            request = json.loads(body)
+            if request.get("stream"):
+                return self._send_openai_stream()
+            return self._send_json({"choices": [{"message": {"content": self._text()}}]})
+        if path == "/v1/images/variations":
+            return self._send_json({"data": [{"url": "https://example.com/variation.png"}]})
+        if path == "/v1/chat":
+            if json.loads(body).get("stream"):
+                return self._send_cohere_stream(chat=True)
+            return self._send_json({"text": self._text()})
+        if path == "/v1/generate":
+            if json.loads(body).get("stream"):
+                return self._send_cohere_stream(chat=False)
+            return self._send_json({"generations": [{"text": self._text()}]})
+        if path == "/v1/summarize":
+            return self._send_json({"summary": self._text()})
+        if path == "/models/facebook/blenderbot-400M-distill":
+            return self._send_json({"generated_text": self._text()})
+        if path == "/models/google/vit-base-patch16-224":
+            return self._send_inference(body, [{"label": "tabby cat", "score": 0.9}])
+        if path == "/models/facebook/wav2vec2-large-960h-lv60-self":
+            return self._send_inference(body, {"text": self._text()})
+        if path.startswith("/v1/generation/"):
+            return self._send_json({"artifacts": [{"base64": IMAGE_BASE64}]})
+        self._send_json({"message": f"Unknown stub path {path}"}, status=404)
+
+    def _read_chunked(self):
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return b""
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _text(self):
+        return " ".join(f"token{index}" for index in range(self.tokens))
+
+    def _send_json(self, value, status=200):
+        data = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # a micro-batched call (MICRO_BATCHING=true) sends a JSON list of inputs and receives a result for each of them
+    def _send_inference(self, body, result):
+        if body.startswith(b"{"):
+            inputs = json.loads(body).get("inputs")
+            if isinstance(inputs, list):
+                self.batch_sizes.append(len(inputs))
+                return self._send_json([result] * len(inputs))
+        self._send_json(result)
+
+    def _send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_openai_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for index in range(self.tokens):
+            event = {"choices": [{"delta": {"content": f"token{index} "}}]}
+            self._send_chunk(f"data: {json.dumps(event)}\n\n".encode())
+            if self.token_delay:
+                time.sleep(self.token_delay)
+        self._send_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    # Cohere streams newline delimited JSON objects instead of SSE events
+    def _send_cohere_stream(self, chat):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/stream+json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if chat:
+            self._send_chunk(b'{"is_finished":false,"event_type":"stream-start"}\n')
+        for index in range(self.tokens):
+            event = {"is_finished": False, "event_type": "text-generation", "text": f"token{index} "}
+            self._send_chunk(json.dumps(event).encode() + b"\n")
+            if self.token_delay:
+                time.sleep(self.token_delay)
+        end = {"is_finished": True, "event_type": "stream-end", "finish_reason": "COMPLETE"}
+        self._send_chunk(json.dumps(end).encode() + b"\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+# latency and token_delay are in seconds
+def create_server(port=0, latency=0, tokens=20, token_delay=0, error_rate=0):
+    handler = type("ConfiguredStubHandler", (StubHandler,), {
+        "latency": latency, "tokens": tokens, "token_delay": token_delay, "error_rate": error_rate,
+        "batch_sizes": []})
+    return _StubServer(("127.0.0.1", port), handler)
+
+
+def start_in_background(**kwargs):
+    server = create_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds before each response")
+    parser.add_argument("--tokens", type=int, default=20, help="tokens per text response/stream")
+    parser.add_argument("--token-delay", type=float, default=0, help="milliseconds between streamed tokens")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of the calls that are answered with a 503")
+    arguments = parser.parse_args()
+    server = create_server(arguments.port, arguments.latency / 1000, arguments.tokens, arguments.token_delay / 1000,
+                           arguments.error_rate)
+    print(f"Stub providers listening on port {arguments.port}, start the app with:")
+    print(f"UPSTREAM_URL_OVERRIDES={url_overrides(arguments.port)}")
+    server.serve_forever()
@@ -1,22 +1,61 @@
+from utils.providerRegistry import providers
 from requests.exceptions import ConnectionError
-from services.huggingFace import HuggingFace
-from services.stabilityAI import StabilityAI
+from werkzeug.exceptions import HTTPException
+from utils.uploadStream import UploadRequest, upload_stats
+from utils.artifactStore import artifact_store, MIME_TYPES
+from utils.singleFlight import single_flight, request_key
+from utils.responseCache import response_cache
+from utils.httpClient import http_client
+from utils.resilience import resilience, ProviderUnavailable
+from utils.imagePreprocessor import image_preprocessor
+from utils.sseWriter import sse_writer
+from utils.config import config
+from utils.metrics import metrics
 from services.custom import Custom
-from services.openAI import OpenAI
-from services.cohere import Cohere
-from flask import Flask, request
+from flask import Flask, Response, request, send_file, g
 from dotenv import load_dotenv
 from flask_cors import CORS
+import time
 
 # ------------------ SETUP ------------------
 
 load_dotenv()
 
+# every setting is read and validated once here, hence an invalid value stops the app at startup (see utils/config.py)
+config.load()
+
 app = Flask(__name__)
 
+# uploaded files are kept in memory only up to UPLOAD_MEMORY_LIMIT_KB per request and spilled to disk above it
+app.request_class = UploadRequest
+
 # this will need to be reconfigured before taking the app to production
 cors = CORS(app)
 
+# Identical requests that arrive while the first one is in flight share its upstream call (see utils/singleFlight.py)
+def flight_key():
+    if request.files:
+        return request_key(request.path, files=request.files.getlist("files"), form=request.form.items(multi=True))
+    return request_key(request.path, data=request.get_data())
+
+# Latency, status and byte counts of every route (see utils/metrics.py) - streamed responses are recorded when they end
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_route_metrics(response):
+    # the route pattern is used instead of the path so that e.g. every artifact name does not create a new series
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    start = g.get("request_start", time.perf_counter())
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = metrics.stream(
+            route, response.status_code, start, request.content_length or 0, response.response)
+    else:
+        metrics.route(route, response.status_code, time.perf_counter() - start, request.content_length or 0,
+                      response.content_length or 0)
+    return response
+
 # ------------------ EXCEPTION HANDLERS ------------------
 
 # Sends response back to Deep Chat using the Response format:
@@ -31,6 +70,16 @@ def handle_exception(e):
     print(e)
     return {"error": "Internal service error"}, 500
 
+# the provider is overloaded or down (see utils/resilience.py) - the client can retry after the Retry-After seconds
+@app.errorhandler(ProviderUnavailable)
+def handle_provider_unavailable(e):
+    return {"error": str(e)}, e.status, {"Retry-After": str(e.retry_after)}
+
+# e.g. the routes of a disabled provider (see utils/providerRegistry.py) are not found instead of failing
+@app.errorhandler(HTTPException)
+def handle_http_exception(e):
+    return {"error": e.description}, e.code
+
 # ------------------ CUSTOM API ------------------
 
 custom = Custom()
@@ -51,80 +100,179 @@ def files():
 
 # ------------------ OPENAI API ------------------
 
-open_ai = OpenAI()
+# the service is imported and initialized on its first request and the routes are only registered when the
+# provider is enabled (see utils/providerRegistry.py)
+open_ai = providers.lazy("openai")
 
-@app.route("/openai-chat", methods=["POST"])
-def openai_chat():
-    body = request.json
-    return open_ai.chat(body)
+if providers.enabled("openai"):
+    @app.route("/openai-chat", methods=["POST"])
+    def openai_chat():
+        body = request.json
+        return single_flight.do(flight_key(), lambda: open_ai.chat(body))
 
-@app.route("/openai-chat-stream", methods=["POST"])
-def openai_chat_stream():
-    body = request.json
-    return open_ai.chat_stream(body)
+    @app.route("/openai-chat-stream", methods=["POST"])
+    def openai_chat_stream():
+        body = request.json
+        events = single_flight.stream(flight_key(), lambda: open_ai.chat_stream_events(body))
+        return Response(events, mimetype="text/event-stream")
 
-@app.route("/openai-image", methods=["POST"])
-def openai_image():
-    files = request.files.getlist("files")
-    return open_ai.image_variation(files)
+    @app.route("/openai-image", methods=["POST"])
+    def openai_image():
+        files = request.files.getlist("files")
+        return single_flight.do(flight_key(), lambda: open_ai.image_variation(files))
 
 # ------------------ HUGGING FACE API ------------------
 
-huggingFace = HuggingFace()
+huggingFace = providers.lazy("huggingface")
 
-@app.route("/huggingface-conversation", methods=["POST"])
-def hugging_face_conversation():
-    body = request.json
-    return huggingFace.conversation(body)
+if providers.enabled("huggingface"):
+    @app.route("/huggingface-conversation", methods=["POST"])
+    def hugging_face_conversation():
+        body = request.json
+        return single_flight.do(flight_key(), lambda: huggingFace.conversation(body))
 
-@app.route("/huggingface-image", methods=["POST"])
-def hugging_face_image_classification():
-    files = request.files.getlist("files")
-    return huggingFace.image_classification(files)
+    @app.route("/huggingface-image", methods=["POST"])
+    def hugging_face_image_classification():
+        files = request.files.getlist("files")
+        return single_flight.do(flight_key(), lambda: huggingFace.image_classification(files))
 
-@app.route("/huggingface-speech", methods=["POST"])
-def hugging_face_speech_recognition():
-    files = request.files.getlist("files")
-    return huggingFace.speech_recognition(files)
+    @app.route("/huggingface-speech", methods=["POST"])
+    def hugging_face_speech_recognition():
+        files = request.files.getlist("files")
+        return single_flight.do(flight_key(), lambda: huggingFace.speech_recognition(files))
 
 # ------------------ STABILITY AI API ------------------
 
-stability_ai = StabilityAI()
+stability_ai = providers.lazy("stabilityai")
 
-@app.route("/stability-text-to-image", methods=["POST"])
-def stabilityai_text_to_image():
-    body = request.json
-    return stability_ai.text_to_image(body)
+if providers.enabled("stabilityai"):
+    @app.route("/stability-text-to-image", methods=["POST"])
+    def stabilityai_text_to_image():
+        body = request.json
+        return single_flight.do(flight_key(), lambda: stability_ai.text_to_image(body))
 
-@app.route("/stability-image-to-image", methods=["POST"])
-def stabilityai_image_to_image():
-    return stability_ai.image_to_image(request)
+    @app.route("/stability-image-to-image", methods=["POST"])
+    def stabilityai_image_to_image():
+        return single_flight.do(flight_key(), lambda: stability_ai.image_to_image(request))
 
-@app.route("/stability-image-upscale", methods=["POST"])
-def stabilityai_image_to_image_upscale():
-    files = request.files.getlist("files")
-    return stability_ai.image_to_image_upscale(files)
+    @app.route("/stability-image-upscale", methods=["POST"])
+    def stabilityai_image_to_image_upscale():
+        files = request.files.getlist("files")
+        return single_flight.do(flight_key(), lambda: stability_ai.image_to_image_upscale(files))
 
 # ------------------ COHERE API ------------------
 
-cohere = Cohere()
+cohere = providers.lazy("cohere")
 
-@app.route("/cohere-chat", methods=["POST"])
-def cohere_chat():
-    body = request.json
-    return cohere.chat(body)
+if providers.enabled("cohere"):
+    @app.route("/cohere-chat", methods=["POST"])
+    def cohere_chat():
+        body = request.json
+        return single_flight.do(flight_key(), lambda: cohere.chat(body))
 
-@app.route("/cohere-generate", methods=["POST"])
-def cohere_generate_text():
-    body = request.json
-    return cohere.generate_text(body)
+    @app.route("/cohere-generate", methods=["POST"])
+    def cohere_generate_text():
+        body = request.json
+        return single_flight.do(flight_key(), lambda: cohere.generate_text(body))
 
-@app.route("/cohere-summarize", methods=["POST"])
-def cohere_summarize_text():
-    body = request.json
-    return cohere.summarize_text(body)
+    @app.route("/cohere-chat-stream", methods=["POST"])
+    def cohere_chat_stream():
+        body = request.json
+        events = single_flight.stream(flight_key(), lambda: cohere.chat_stream_events(body))
+        return Response(events, mimetype="text/event-stream")
+
+    @app.route("/cohere-generate-stream", methods=["POST"])
+    def cohere_generate_text_stream():
+        body = request.json
+        events = single_flight.stream(flight_key(), lambda: cohere.generate_text_stream_events(body))
+        return Response(events, mimetype="text/event-stream")
+
+    @app.route("/cohere-summarize", methods=["POST"])
+    def cohere_summarize_text():
+        body = request.json
+        return single_flight.do(flight_key(), lambda: cohere.summarize_text(body))
+
+# ------------------ ARTIFACTS ------------------
+
+# Serves the images that were saved by the artifact store (ARTIFACT_STORE=true) instead of being sent as data URLs.
+# Artifacts are named by the hash of their content, hence they never change and can be cached by the browser.
+@app.route("/artifacts/<name>", methods=["GET"])
+def artifacts(name):
+    path = artifact_store.path(name)
+    if path is None:
+        return {"error": "Artifact not found"}, 404
+    # send_file uses sendfile (when supported by the server) and handles If-None-Match and Range requests
+    return send_file(path, mimetype=MIME_TYPES.get(name.rsplit(".", 1)[-1]), conditional=True,
+                     etag=name.split(".")[0], max_age=31536000)
+
+# ------------------ UPSTREAM POOL STATS ------------------
+
+# Connection reuse ratio, waits and open sockets of the upstream keep-alive pools (one per provider host)
+@app.route("/upstream-stats", methods=["GET"])
+def upstream_stats():
+    return http_client.stats()
+
+# ------------------ RESPONSE CACHE STATS ------------------
+
+# Hit, miss and eviction counters of the response cache used by the deterministic routes
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    return response_cache.stats()
+
+# ------------------ SINGLE FLIGHT STATS ------------------
+
+# Number of upstream calls and the number of identical requests that joined them
+@app.route("/single-flight-stats", methods=["GET"])
+def single_flight_stats():
+    return single_flight.stats()
+
+# ------------------ UPLOAD STATS ------------------
+
+# Uploaded bytes, spilled requests and the estimated peak upload memory of a single request per route
+@app.route("/upload-stats", methods=["GET"])
+def upload_stats_route():
+    return upload_stats.stats()
+
+# ------------------ PROVIDER STATS ------------------
+
+# Circuit breaker state, in flight and queued requests, shed requests and retries per provider
+@app.route("/provider-stats", methods=["GET"])
+def provider_stats():
+    return resilience.stats()
+
+# ------------------ STREAM STATS ------------------
+
+# SSE frames, tokens and bytes sent by the streaming routes and their rates over the last 10 seconds
+@app.route("/stream-stats", methods=["GET"])
+def stream_stats():
+    return sse_writer.stats()
+
+# ------------------ IMAGE STATS ------------------
+
+# Uploaded images forwarded untouched, normalized or rejected, bytes saved and the preprocessing time
+@app.route("/image-stats", methods=["GET"])
+def image_stats():
+    return image_preprocessor.stats()
+
+# ------------------ METRICS ------------------
+
+# Route and upstream latency histograms, time to first token, byte counts and errors by provider in the Prometheus
+# text format
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# ------------------ STARTUP STATS ------------------
+
+# App setup time, enabled and disabled providers and the import/initialization time of the providers loaded so far
+@app.route("/startup-stats", methods=["GET"])
+def startup_stats():
+    return providers.stats()
+
+providers.report_startup()
 
 # ------------------ START SERVER ------------------
 
+# single process development server - see serve.py for the multi-process production mode
 if __name__ == "__main__":
-    app.run(port=8080)
+    app.run(port=config.get("server")["port"])
@@ -0,0 +1,300 @@
+from utils.providerRegistry import providers
+from werkzeug.exceptions import HTTPException
+from utils.asyncHttpClient import async_http_client
+from utils.artifactStore import artifact_store, MIME_TYPES
+from quart import Quart, Response, request, send_file, g
+from utils.singleFlight import single_flight, request_key
+from utils.responseCache import response_cache
+from utils.httpClient import http_client
+from utils.resilience import resilience, ProviderUnavailable
+from utils.imagePreprocessor import image_preprocessor
+from utils.sseWriter import sse_writer
+from utils.config import config
+from utils.metrics import metrics
+from services.custom import Custom
+from dotenv import load_dotenv
+from quart_cors import cors
+import httpx
+import time
+
+# Async (ASGI) serving mode - exposes the same routes and response format as app.py, but upstream calls do not block
+# and streams are served by async generators, hence a single process can hold thousands of concurrent SSE streams.
+# Run with an ASGI server, e.g: hypercorn asyncApp:app --bind 0.0.0.0:8080
+
+# ------------------ SETUP ------------------
+
+load_dotenv()
+
+# every setting is read and validated once here, hence an invalid value stops the app at startup (see utils/config.py)
+config.load()
+
+app = Quart(__name__)
+
+# this will need to be reconfigured before taking the app to production
+app = cors(app, allow_origin="*")
+
+@app.after_serving
+async def close_upstream_clients():
+    await async_http_client.close()
+
+async def stream_response(events):
+    # the first event is awaited before the response is created - by then the slot of the provider has been acquired (or
+    # the request has been shed, see utils/resilience.py) and the upstream call has been sent, hence their errors are
+    # sent by the error handlers (e.g. a 429 with a Retry-After header) instead of a 200 followed by a broken stream
+    try:
+        first = await events.__anext__()
+    except StopAsyncIteration:
+        first = None
+    # the stream is recorded by metrics.astream when it ends instead of by record_route_metrics
+    g.metrics_streamed = True
+    events = metrics.astream(request.url_rule.rule, 200, g.request_start, request.content_length or 0,
+                             _prepend(first, events))
+    response = Response(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # the response is sent out as soon as each event is produced
+    response.timeout = None
+    return response
+
+async def _prepend(first, events):
+    try:
+        if first is not None:
+            yield first
+        async for event in events:
+            yield event
+    finally:
+        await events.aclose()
+
+# Identical requests that arrive while the first one is in flight share its upstream call (see utils/singleFlight.py)
+async def flight_key():
+    files = await request.files
+    if files:
+        form = await request.form
+        return request_key(request.path, files=files.getlist("files"), form=form.items(multi=True))
+    return request_key(request.path, data=await request.get_data())
+
+# Latency, status and byte counts of every route (see utils/metrics.py)
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+async def record_route_metrics(response):
+    if not g.get("metrics_streamed"):
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        start = g.get("request_start", time.perf_counter())
+        metrics.route(route, response.status_code, time.perf_counter() - start, request.content_length or 0,
+                      response.content_length or 0)
+    return response
+
+# ------------------ EXCEPTION HANDLERS ------------------
+
+# Sends response back to Deep Chat using the Response format:
+# https://deepchat.dev/docs/connect/#Response
+@app.errorhandler(Exception)
+async def handle_exception(e):
+    print(e)
+    return {"error": str(e)}, 500
+
+@app.errorhandler(httpx.TransportError)
+async def handle_connection_exception(e):
+    print(e)
+    return {"error": "Internal service error"}, 500
+
+@app.errorhandler(ProviderUnavailable)
+async def handle_provider_unavailable(e):
+    return {"error": str(e)}, e.status, {"Retry-After": str(e.retry_after)}
+
+# e.g. the routes of a disabled provider (see utils/providerRegistry.py) are not found instead of failing
+@app.errorhandler(HTTPException)
+async def handle_http_exception(e):
+    return {"error": e.description}, e.code
+
+# ------------------ CUSTOM API ------------------
+
+custom = Custom()
+
+@app.route("/chat", methods=["POST"])
+async def chat():
+    body = await request.get_json()
+    return custom.chat(body)
+
+@app.route("/chat-stream", methods=["POST"])
+async def chat_stream():
+    body = await request.get_json()
+    return await stream_response(custom.chat_stream_async(body))
+
+@app.route("/files", methods=["POST"])
+async def files():
+    return await custom.files_async(request)
+
+# ------------------ OPENAI API ------------------
+
+# the service is imported and initialized on its first request and the routes are only registered when the
+# provider is enabled (see utils/providerRegistry.py)
+open_ai = providers.lazy("openai")
+
+if providers.enabled("openai"):
+    @app.route("/openai-chat", methods=["POST"])
+    async def openai_chat():
+        body = await request.get_json()
+        return await single_flight.do_async(await flight_key(), lambda: open_ai.chat_async(body))
+
+    @app.route("/openai-chat-stream", methods=["POST"])
+    async def openai_chat_stream():
+        body = await request.get_json()
+        return await stream_response(
+            single_flight.stream_async(await flight_key(), lambda: open_ai.chat_stream_async(body)))
+
+    @app.route("/openai-image", methods=["POST"])
+    async def openai_image():
+        files = (await request.files).getlist("files")
+        return await single_flight.do_async(await flight_key(), lambda: open_ai.image_variation_async(files))
+
+# ------------------ HUGGING FACE API ------------------
+
+huggingFace = providers.lazy("huggingface")
+
+if providers.enabled("huggingface"):
+    @app.route("/huggingface-conversation", methods=["POST"])
+    async def hugging_face_conversation():
+        body = await request.get_json()
+        return await single_flight.do_async(await flight_key(), lambda: huggingFace.conversation_async(body))
+
+    @app.route("/huggingface-image", methods=["POST"])
+    async def hugging_face_image_classification():
+        files = (await request.files).getlist("files")
+        return await single_flight.do_async(
+            await flight_key(), lambda: huggingFace.image_classification_async(files))
+
+    @app.route("/huggingface-speech", methods=["POST"])
+    async def hugging_face_speech_recognition():
+        files = (await request.files).getlist("files")
+        return await single_flight.do_async(
+            await flight_key(), lambda: huggingFace.speech_recognition_async(files))
+
+# ------------------ STABILITY AI API ------------------
+
+stability_ai = providers.lazy("stabilityai")
+
+if providers.enabled("stabilityai"):
+    @app.route("/stability-text-to-image", methods=["POST"])
+    async def stabilityai_text_to_image():
+        body = await request.get_json()
+        return await single_flight.do_async(await flight_key(), lambda: stability_ai.text_to_image_async(body))
+
+    @app.route("/stability-image-to-image", methods=["POST"])
+    async def stabilityai_image_to_image():
+        return await single_flight.do_async(await flight_key(), lambda: stability_ai.image_to_image_async(request))
+
+    @app.route("/stability-image-upscale", methods=["POST"])
+    async def stabilityai_image_to_image_upscale():
+        files = (await request.files).getlist("files")
+        return await single_flight.do_async(
+            await flight_key(), lambda: stability_ai.image_to_image_upscale_async(files))
+
+# ------------------ COHERE API ------------------
+
+cohere = providers.lazy("cohere")
+
+if providers.enabled("cohere"):
+    @app.route("/cohere-chat", methods=["POST"])
+    async def cohere_chat():
+        body = await request.get_json()
+        return await single_flight.do_async(await flight_key(), lambda: cohere.chat_async(body))
+
+    @app.route("/cohere-generate", methods=["POST"])
+    async def cohere_generate_text():
+        body = await request.get_json()
+        return await single_flight.do_async(await flight_key(), lambda: cohere.generate_text_async(body))
+
+    @app.route("/cohere-chat-stream", methods=["POST"])
+    async def cohere_chat_stream():
+        body = await request.get_json()
+        return await stream_response(
+            single_flight.stream_async(await flight_key(), lambda: cohere.chat_stream_async(body)))
+
+    @app.route("/cohere-generate-stream", methods=["POST"])
+    async def cohere_generate_text_stream():
+        body = await request.get_json()
+        return await stream_response(
+            single_flight.stream_async(await flight_key(), lambda: cohere.generate_text_stream_async(body)))
+
+    @app.route("/cohere-summarize", methods=["POST"])
+    async def cohere_summarize_text():
+        body = await request.get_json()
+        return await single_flight.do_async(await flight_key(), lambda: cohere.summarize_text_async(body))
+
+# ------------------ ARTIFACTS ------------------
+
+# Serves the images that were saved by the artifact store with the same caching headers as app.py
+@app.route("/artifacts/<name>", methods=["GET"])
+async def artifacts(name):
+    path = artifact_store.path(name)
+    if path is None:
+        return {"error": "Artifact not found"}, 404
+    response = await send_file(path, mimetype=MIME_TYPES.get(name.rsplit(".", 1)[-1]), add_etags=False,
+                               cache_timeout=31536000)
+    # the ETag is the content hash in the name (Quart's send_file has no etag argument), hence it is set before the
+    # If-None-Match and Range requests are handled
+    response.set_etag(name.split(".")[0])
+    await response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+    return response
+
+# ------------------ UPSTREAM POOL STATS ------------------
+
+@app.route("/upstream-stats", methods=["GET"])
+async def upstream_stats():
+    return {"sync": http_client.stats(), "async": async_http_client.stats()}
+
+# ------------------ RESPONSE CACHE STATS ------------------
+
+@app.route("/cache-stats", methods=["GET"])
+async def cache_stats():
+    return response_cache.stats()
+
+# ------------------ SINGLE FLIGHT STATS ------------------
+
+@app.route("/single-flight-stats", methods=["GET"])
+async def single_flight_stats():
+    return single_flight.stats()
+
+# /upload-stats is only served by app.py - the uploads of this app are parsed by Quart instead of UploadRequest (see
+# utils/uploadStream.py), hence their memory is not measured
+
+# ------------------ PROVIDER STATS ------------------
+
+@app.route("/provider-stats", methods=["GET"])
+async def provider_stats():
+    return resilience.stats()
+
+# ------------------ STREAM STATS ------------------
+
+@app.route("/stream-stats", methods=["GET"])
+async def stream_stats():
+    return sse_writer.stats()
+
+# ------------------ IMAGE STATS ------------------
+
+@app.route("/image-stats", methods=["GET"])
+async def image_stats():
+    return image_preprocessor.stats()
+
+# ------------------ METRICS ------------------
+
+@app.route("/metrics", methods=["GET"])
+async def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# ------------------ STARTUP STATS ------------------
+
+@app.route("/startup-stats", methods=["GET"])
+async def startup_stats():
+    return providers.stats()
+
+providers.report_startup()
+
+# ------------------ START SERVER ------------------
+
+# single process development server - see serve.py for the multi-process production mode
+if __name__ == "__main__":
+    app.run(port=config.get("server")["port"])
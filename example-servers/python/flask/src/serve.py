@@ -0,0 +1,172 @@
+from multiprocessing.connection import wait
+from utils.config import config
+from dotenv import load_dotenv
+import multiprocessing
+import argparse
+import signal
+import time
+import sys
+import os
+
+# Production entry point - runs the app in multiple worker processes (one per CPU core by default) that share a single
+# listening socket, instead of the single process development server of app.run:
+# - sync (app.py) - gunicorn with threaded (gthread) workers, every SSE stream holds a thread of its worker while the
+#   worker keeps reporting to the arbiter, hence long streams are not killed as stuck workers
+# - async (asyncApp.py) - hypercorn with asyncio (or uvloop when installed) workers, every worker serves many streams
+# On SIGTERM or SIGINT the server stops accepting connections and gives the in-flight requests and streams up to
+# SERVER_GRACEFUL_TIMEOUT seconds to finish. SIGHUP replaces the workers in the same way (e.g. to load new code).
+# Every worker has its own caches, metrics and stores - use CONVERSATION_STORE=file to share conversations.
+# gunicorn does not run on Windows, use the async mode there.
+# Run from this directory: python serve.py (sync) or python serve.py --mode async
+
+# Settings can be configured in the .env file (see .env.example):
+# HOST/PORT - address that the server listens on
+# SERVER_WORKERS - number of worker processes (default: number of CPU cores)
+# SERVER_THREADS - threads of a sync worker, i.e. the number of requests and streams a sync worker serves at a time
+# SERVER_KEEP_ALIVE - seconds an idle keep-alive connection is kept open
+# SERVER_GRACEFUL_TIMEOUT - seconds the in-flight requests are given to finish on shutdown or reload
+# SERVER_BACKLOG - connections that can wait to be accepted
+# The settings are read and validated by the server section of utils/config.py.
+
+
+# the settings of the app are validated once before the workers are started, hence an invalid value stops the server
+# with a single error instead of failing every worker (which would be replaced over and over). It runs in a spawned
+# process as this process does not import the modules of the app (see SyncServer.load).
+def check_app_settings():
+    config.load()
+
+
+def serve_sync(settings):
+    from gunicorn.app.base import BaseApplication
+
+    class SyncServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", [f"{settings['host']}:{settings['port']}"])
+            self.cfg.set("workers", settings["workers"])
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", settings["threads"])
+            # keep-alive connections beyond the busy threads wait in the worker without holding a thread
+            self.cfg.set("worker_connections", max(1000, settings["threads"]))
+            self.cfg.set("keepalive", settings["keep_alive"])
+            self.cfg.set("graceful_timeout", settings["graceful_timeout"])
+            self.cfg.set("backlog", settings["backlog"])
+            # a new master (e.g. of a rolling deployment) can bind to the port while the old one drains
+            self.cfg.set("reuse_port", True)
+
+        # the app is imported by every worker instead of the master, hence nothing (e.g. a connection pool or a
+        # thread) is shared across the fork and SIGHUP picks up new code
+        def load(self):
+            from app import app
+            return app
+
+    SyncServer().run()
+
+
+def serve_async(settings):
+    from hypercorn.asyncio.run import asyncio_worker, uvloop_worker
+    from hypercorn.config import Config
+
+    config = Config()
+    config.application_path = "asyncApp:app"
+    config.bind = [f"{settings['host']}:{settings['port']}"]
+    # with more than one worker the socket is created with SO_REUSEPORT
+    config.workers = settings["workers"]
+    config.keep_alive_timeout = settings["keep_alive"]
+    config.graceful_timeout = settings["graceful_timeout"]
+    config.backlog = settings["backlog"]
+    try:
+        import uvloop  # noqa: F401
+        worker = uvloop_worker
+    except ImportError:
+        worker = asyncio_worker
+    AsyncSupervisor(config, worker, settings["workers"]).run()
+
+
+# Runs the hypercorn workers on a socket that is created once and shared by all of them. The workers of hypercorn's own
+# supervisor are terminated as soon as the first one of them has drained, hence the streams of the other workers would
+# be cut off - this supervisor waits for all of them instead. SIGHUP starts new workers before the current ones drain.
+class AsyncSupervisor:
+    def __init__(self, config, worker, count):
+        self._config = config
+        self._worker = worker
+        self._count = count
+        self._context = multiprocessing.get_context("spawn")
+        self._sockets = None
+        self._stop_requested = False
+        self._reload_requested = False
+
+    def _start_worker(self, shutdown_event):
+        process = self._context.Process(target=self._worker, kwargs={
+            "config": self._config, "sockets": self._sockets, "shutdown_event": shutdown_event})
+        # the workers are not daemonic so that they can start processes (see utils/imagePreprocessor.py), they are
+        # joined or terminated by run
+        process.start()
+        return process
+
+    def _start_workers(self):
+        # the workers inherit the ignored SIGINT, hence Ctrl+C only reaches this process which then drains them
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        shutdown_event = self._context.Event()
+        processes = [self._start_worker(shutdown_event) for _ in range(self._count)]
+        signal.signal(signal.SIGINT, self._request_stop)
+        return shutdown_event, processes
+
+    def _request_stop(self, *args):
+        self._stop_requested = True
+
+    def _request_reload(self, *args):
+        self._reload_requested = True
+
+    def run(self):
+        self._sockets = self._config.create_sockets()
+        shutdown_event, processes = self._start_workers()
+        draining = []
+        signal.signal(signal.SIGTERM, self._request_stop)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self._request_reload)
+        while not self._stop_requested:
+            if self._reload_requested:
+                self._reload_requested = False
+                print("Reloading workers")
+                draining += processes
+                shutdown_event.set()
+                shutdown_event, processes = self._start_workers()
+            wait([process.sentinel for process in processes + draining], timeout=1)
+            draining = [process for process in draining if process.is_alive()]
+            # a worker that exited on its own (e.g. crashed) is replaced
+            for index, process in enumerate(processes):
+                if not process.is_alive() and not self._stop_requested:
+                    print(f"Worker {process.pid} exited with code {process.exitcode}, starting a new one")
+                    processes[index] = self._start_worker(shutdown_event)
+        print(f"Draining {len(processes + draining)} workers")
+        shutdown_event.set()
+        deadline = time.monotonic() + self._config.graceful_timeout + 5
+        for process in processes + draining:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        for sock in self._sockets.insecure_sockets + self._sockets.secure_sockets:
+            sock.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--mode", choices=["sync", "async"], default="sync")
+    arguments = argument_parser.parse_args()
+    try:
+        server_settings = config.read("server")["server"]
+    except ValueError as error:
+        sys.exit(str(error))
+    # the workers split the per host resources by it (e.g. the image preprocessing pool, see utils/imagePreprocessor.py)
+    os.environ["SERVER_WORKERS"] = str(server_settings["workers"])
+    checker = multiprocessing.get_context("spawn").Process(target=check_app_settings)
+    checker.start()
+    checker.join()
+    if checker.exitcode != 0:
+        sys.exit(1)
+    print(f"Starting {server_settings['workers']} {arguments.mode} workers on port {server_settings['port']}")
+    if arguments.mode == "sync":
+        serve_sync(server_settings)
+    else:
+        serve_async(server_settings)
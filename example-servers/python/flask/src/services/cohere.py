@@ -1,67 +1,214 @@
-import requests
+from utils.conversationStore import conversation_store
+from utils.asyncHttpClient import async_http_client
+from utils.responseCache import response_cache
+from utils.jsonLines import iter_json_lines, aiter_json_lines
+from utils.resilience import resilience, guards_itself
+from utils.httpClient import http_client
+from utils.sseWriter import sse_writer
+from utils.metrics import metrics
+import json
+import time
 import os
 
 # Make sure to set the COHERE_API_KEY environment variable in a .env file (create if does not exist) - see .env.example
 
 class Cohere:
+    # the headers are only built once per process instead of for every request
+    def __init__(self):
+        self.auth_headers = {"Authorization": "Bearer " + os.getenv("COHERE_API_KEY")}
+        self.json_headers = dict(self.auth_headers, **{"Content-Type": "application/json"})
+
     def chat(self, body):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + os.getenv("COHERE_API_KEY")
-        }
+        headers = self.json_headers
         chat_body = self.create_chat_body(body)
-        response = requests.post(
+        response = http_client.post(
             "https://api.cohere.ai/v1/chat", json=chat_body, headers=headers)
-        json_response = response.json()
-        if "message" in json_response:
-            raise Exception(json_response["message"])
-        # Sends response back to Deep Chat using the Response format:
-        # https://deepchat.dev/docs/connect/#Response
-        return {"text": json_response["text"]}
+        result = self.chat_result(response.json())
+        self.record_response(body, result["text"])
+        return result
+
+    async def chat_async(self, body):
+        headers = self.json_headers
+        chat_body = self.create_chat_body(body)
+        response = await async_http_client.post(
+            "https://api.cohere.ai/v1/chat", json=chat_body, headers=headers)
+        result = self.chat_result(response.json())
+        self.record_response(body, result["text"])
+        return result
 
     @staticmethod
     def create_chat_body(body):
         # Text messages are stored inside request body using the Deep Chat JSON format:
         # https://deepchat.dev/docs/connect
+        # when the request has a conversationId - only its new message is sent and the history is kept by the server
+        messages = conversation_store.window('cohere', body, Cohere.format_message)
         return {
-            'query': body['messages'][len(body['messages']) - 1]['text'],
-            'chat_history': [
-                {
-                    'user_name': 'CHATBOT' if message['role'] == 'ai' else 'USER',
-                    'text': message['text']
-                } for message in body['messages'][:-1]
-            ],
+            'query': messages[-1]['text'],
+            'chat_history': messages[:-1],
         }
 
-    def generate_text(self, body):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + os.getenv("COHERE_API_KEY")
+    @staticmethod
+    def format_message(message):
+        return {
+            'user_name': 'CHATBOT' if message['role'] == 'ai' else 'USER',
+            'text': message['text']
         }
+
+    # adds the new messages and the response to the stored conversation (if the request has a conversationId) - only
+    # called once the provider has responded
+    @staticmethod
+    def record_response(body, text):
+        conversation_store.record('cohere', body, Cohere.format_message, text)
+
+    @staticmethod
+    def chat_result(json_response):
+        if "message" in json_response:
+            raise Exception(json_response["message"])
+        # Sends response back to Deep Chat using the Response format:
+        # https://deepchat.dev/docs/connect/#Response
+        return {"text": json_response["text"]}
+
+    # Streamed counterparts of chat and generate_text - the tokens are forwarded to Deep Chat as soon as Cohere produces
+    # them instead of after the whole completion: https://docs.cohere.com/docs/streaming
+    def chat_stream_events(self, body):
+        chat_body = dict(self.create_chat_body(body), stream=True)
+        return self.stream_events("https://api.cohere.ai/v1/chat", chat_body, lambda text: self.record_response(body, text))
+
+    async def chat_stream_async(self, body):
+        chat_body = dict(self.create_chat_body(body), stream=True)
+        async for frame in self.stream_events_async(
+                "https://api.cohere.ai/v1/chat", chat_body, lambda text: self.record_response(body, text)):
+            yield frame
+
+    def generate_text_stream_events(self, body):
+        generation_body = {"prompt": body["messages"][0]["text"], "stream": True}
+        return self.stream_events("https://api.cohere.ai/v1/generate", generation_body)
+
+    async def generate_text_stream_async(self, body):
+        generation_body = {"prompt": body["messages"][0]["text"], "stream": True}
+        async for frame in self.stream_events_async("https://api.cohere.ai/v1/generate", generation_body):
+            yield frame
+
+    # sends the upstream request and checks its status before the stream events generator is returned, hence an error
+    # response is raised to the route (and sent back as a JSON error) before the stream starts
+    # on_complete is called with the full text once the stream has ended
+    def stream_events(self, url, stream_body, on_complete=None):
+        headers = self.json_headers
+        start = time.perf_counter()
+        response = http_client.post(url, json=stream_body, headers=headers, stream=True)
+        if response.status_code != 200:
+            self.raise_stream_error(response.content)
+
+        def generate():
+            texts = []
+            # Cohere streams one JSON object per line, objects split across chunks are reassembled by the parser
+            # metrics.upstream_stream records the time to the first token and the duration of the stream
+            for event in iter_json_lines(metrics.upstream_stream(url, start, response.iter_content(chunk_size=None))):
+                text = self.parse_stream_event(event)
+                if text:
+                    texts.append(text)
+                    yield text
+            if on_complete is not None:
+                on_complete("".join(texts))
+        # Sends response back to Deep Chat using the Response format:
+        # https://deepchat.dev/docs/connect/#Response
+        # the texts are encoded (and coalesced) into SSE frames by the shared writer (see utils/sseWriter.py)
+        return sse_writer.frames(generate())
+
+    async def stream_events_async(self, url, stream_body, on_complete=None):
+        async for frame in sse_writer.aframes(self.stream_texts_async(url, stream_body, on_complete)):
+            yield frame
+
+    # the error response is raised by the first text, which asyncApp.py awaits before the response is created
+    async def stream_texts_async(self, url, stream_body, on_complete):
+        headers = self.json_headers
+        start = time.perf_counter()
+        async with async_http_client.stream("POST", url, json=stream_body, headers=headers) as response:
+            if response.status_code != 200:
+                self.raise_stream_error(await response.aread())
+            texts = []
+            async for event in aiter_json_lines(metrics.aupstream_stream(url, start, response.aiter_bytes())):
+                text = self.parse_stream_event(event)
+                if text:
+                    texts.append(text)
+                    yield text
+        if on_complete is not None:
+            on_complete("".join(texts))
+
+    # errors (e.g. an invalid API key) are sent back as a regular JSON response instead of a stream
+    @staticmethod
+    def raise_stream_error(content):
+        errorMessage = json.loads(content).get("message", "Cohere stream failed")
+        print("Error in the retrieved stream:", errorMessage)
+        # this exception is not caught, however it signals to the user that there was an error
+        raise Exception(errorMessage)
+
+    # returns the text of the event or None if the event does not contain any (e.g. stream-start or the final event)
+    @staticmethod
+    def parse_stream_event(event):
+        if event.get("is_finished"):
+            if event.get("finish_reason") == "ERROR":
+                raise Exception(event.get("error") or "Cohere stream failed")
+            return None
+        return event.get("text")
+
+    def generate_text(self, body):
+        headers = self.json_headers
         # Text messages are stored inside request body using the Deep Chat JSON format:
         # https://deepchat.dev/docs/connect
         generation_body = {"prompt": body["messages"][0]["text"]}
-        response = requests.post(
+        response = http_client.post(
             "https://api.cohere.ai/v1/generate", json=generation_body, headers=headers)
-        json_response = response.json()
+        return self.generate_text_result(response.json())
+
+    async def generate_text_async(self, body):
+        headers = self.json_headers
+        generation_body = {"prompt": body["messages"][0]["text"]}
+        response = await async_http_client.post(
+            "https://api.cohere.ai/v1/generate", json=generation_body, headers=headers)
+        return self.generate_text_result(response.json())
+
+    @staticmethod
+    def generate_text_result(json_response):
         if "message" in json_response:
             raise Exception(json_response["message"])
         result = json_response["generations"][0]["text"]
         # Sends response back to Deep Chat using the Response format:
         # https://deepchat.dev/docs/connect/#Response
         return {"text": result}
-    
+
+    @guards_itself
     def summarize_text(self, body):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + os.getenv("COHERE_API_KEY")
-        }
+        headers = self.json_headers
         # Text messages are stored inside request body using the Deep Chat JSON format:
         # https://deepchat.dev/docs/connect
         summarization_body = {"text": body["messages"][0]["text"]}
-        response = requests.post(
-            "https://api.cohere.ai/v1/summarize", json=summarization_body, headers=headers)
-        json_response = response.json()
+
+        # the same text always produces the same summary, hence the route can opt in to the response cache and the call
+        # is idempotent (it is retried even when the provider may have processed it, see utils/resilience.py) - only a
+        # cache miss takes a slot of the provider
+        def request():
+            response = http_client.post(
+                "https://api.cohere.ai/v1/summarize", json=summarization_body, headers=headers, idempotent=True)
+            return self.summarize_text_result(response.json())
+        return response_cache.cached("cohere-summarize", "summarize", summarization_body["text"].encode(),
+                                     lambda: resilience.call("cohere", request))
+
+    @guards_itself
+    async def summarize_text_async(self, body):
+        headers = self.json_headers
+        summarization_body = {"text": body["messages"][0]["text"]}
+
+        async def request():
+            response = await async_http_client.post(
+                "https://api.cohere.ai/v1/summarize", json=summarization_body, headers=headers, idempotent=True)
+            return self.summarize_text_result(response.json())
+        return await response_cache.cached_async(
+            "cohere-summarize", "summarize", summarization_body["text"].encode(),
+            lambda: resilience.call_async("cohere", request))
+
+    @staticmethod
+    def summarize_text_result(json_response):
         if "message" in json_response:
             raise Exception(json_response["message"])
         result = json_response["summary"]
@@ -1,6 +1,6 @@
+from utils.streamPacer import stream_pacer
+from utils.sseWriter import sse_writer
 from flask import Response
-import time
-import json
 
 class Custom:
     def chat(self, body):
@@ -20,23 +20,39 @@ class Custom:
         response = Response(self.send_stream(response_chunks), mimetype="text/event-stream")
         response.headers["Content-Type"] = "text/event-stream"
         response.headers["Cache-Control"] = "no-cache"
-        response.headers["Connection"] = "keep-alive"
         response.headers["Access-Control-Allow-Origin"] = "*"
         return response
 
-    def send_stream(self, response_chunks, chunk_index=0):
-        if chunk_index < len(response_chunks):
-            chunk = response_chunks[chunk_index]
-            yield f"data: {json.dumps({'text': f'{chunk} '})}\n\n"
-            time.sleep(0.07)
-            yield from self.send_stream(response_chunks, chunk_index + 1)
-        else:
-            yield ""
+    # the chunks are paced by STREAM_CHUNK_DELAY or STREAM_TOKENS_PER_SECOND (see utils/streamPacer.py) and encoded
+    # into SSE frames by the shared writer (see utils/sseWriter.py)
+    def send_stream(self, response_chunks):
+        texts = (f"{chunk} " for chunk in response_chunks)
+        return sse_writer.frames(stream_pacer.pace(texts))
+
+    # Async counterpart of chat_stream used by asyncApp.py - the response is created by the app
+    async def chat_stream_async(self, body):
+        print(body)
+        response_chunks = "This is a response from a Flask server. Thank you for your message!".split(
+            " ")
+        texts = (f"{chunk} " for chunk in response_chunks)
+        # the event loop keeps serving other streams while this one is waiting
+        async for frame in sse_writer.aframes(stream_pacer.apace(texts)):
+            yield frame
 
     def files(self, request):
         # Files are stored inside a files object
         # https://deepchat.dev/docs/connect
         files = request.files.getlist("files")
+        return self.handle_files(files, request.form, None if files else request.json)
+
+    # the files, form and json of an async (Quart) request need to be awaited
+    async def files_async(self, request):
+        files = (await request.files).getlist("files")
+        form = await request.form
+        return self.handle_files(files, form, None if files else await request.get_json())
+
+    @staticmethod
+    def handle_files(files, form, json_body):
         if files:
             print("Files:")
             for file in files:
@@ -44,7 +60,7 @@ class Custom:
 
             # When sending text messages along with files - they are stored inside the data form
             # https://deepchat.dev/docs/connect
-            text_messages = list(request.form.items())
+            text_messages = list(form.items())
             if len(text_messages) > 0:
                 print("Text messages:")
                 # message objects are stored as strings and they will need to be parsed (JSON.parse) before processing
@@ -53,7 +69,7 @@ class Custom:
         else:
             # When sending text messages without any files - they are stored inside a json
             print("Text messages:")
-            print(request.json)
+            print(json_body)
 
         # Sends response back to Deep Chat using the Response format:
         # https://deepchat.dev/docs/connect/#Response
@@ -1,25 +1,44 @@
-import requests
+from utils.conversationStore import conversation_store
+from utils.asyncHttpClient import async_http_client
+from utils.responseCache import response_cache
+from utils.uploadStream import FileBody, file_digest, read_into_memory
+from utils.filePool import file_pool, combine_results
+from utils.microBatcher import micro_batcher
+from utils.resilience import resilience, guards_itself
+from utils.httpClient import http_client
+import base64
 import os
 
 # Make sure to set the HUGGING_FACE_API_KEY environment variable in a .env file (create if does not exist) - see .env.example
 
 class HuggingFace:
+    # the headers are only built once per process instead of for every request
+    def __init__(self):
+        self.auth_headers = {"Authorization": "Bearer " + os.getenv("HUGGING_FACE_API_KEY")}
+        self.json_headers = dict(self.auth_headers, **{"Content-Type": "application/json"})
+
     def conversation(self, body):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + os.getenv("HUGGING_FACE_API_KEY")
-        }
+        headers = self.json_headers
         # Text messages are stored inside request body using the Deep Chat JSON format:
         # https://deepchat.dev/docs/connect
-        conversation_body = self.create_conversation_body(body["messages"])
-        response = requests.post(
+        # when the request has a conversationId - only its new message is sent and the history is kept by the server
+        messages = conversation_store.window("huggingface", body, self.format_message)
+        conversation_body = self.create_conversation_body(messages)
+        response = http_client.post(
             "https://api-inference.huggingface.co/models/facebook/blenderbot-400M-distill", json=conversation_body, headers=headers)
-        json_response = response.json()
-        if "error" in json_response:
-            raise Exception(json_response["error"])
-        # Sends response back to Deep Chat using the Response format:
-        # https://deepchat.dev/docs/connect/#Response
-        return {"text": json_response["generated_text"]}
+        result = self.conversation_result(response.json())
+        self.record_response(body, result["text"])
+        return result
+
+    async def conversation_async(self, body):
+        headers = self.json_headers
+        messages = conversation_store.window("huggingface", body, self.format_message)
+        conversation_body = self.create_conversation_body(messages)
+        response = await async_http_client.post(
+            "https://api-inference.huggingface.co/models/facebook/blenderbot-400M-distill", json=conversation_body, headers=headers)
+        result = self.conversation_result(response.json())
+        self.record_response(body, result["text"])
+        return result
 
     @staticmethod
     def create_conversation_body(messages):
@@ -31,36 +50,167 @@ class HuggingFace:
         generated_responses = [message["text"] for message in previous_messages if message["role"] == "ai"]
         return {"inputs": {"past_user_inputs": past_user_inputs, "generated_responses": generated_responses, "text": text}, "wait_for_model": True}
 
+    @staticmethod
+    def format_message(message):
+        return {"role": message["role"], "text": message["text"]}
+
+    # adds the new messages and the response to the stored conversation (if the request has a conversationId) - only
+    # called once the provider has responded
+    @staticmethod
+    def record_response(body, text):
+        conversation_store.record("huggingface", body, HuggingFace.format_message, text)
+
+    @staticmethod
+    def conversation_result(json_response):
+        if "error" in json_response:
+            raise Exception(json_response["error"])
+        # Sends response back to Deep Chat using the Response format:
+        # https://deepchat.dev/docs/connect/#Response
+        return {"text": json_response["generated_text"]}
+
     # You can use an example image here: https://github.com/OvidijusParsiunas/deep-chat/blob/main/example-servers/ui/assets/example-image.png
+    @guards_itself
     def image_classification(self, files):
-        headers = {
-            "Authorization": "Bearer " + os.getenv("HUGGING_FACE_API_KEY")
-        }
         # Files are stored inside a files object
         # https://deepchat.dev/docs/connect
-        data=files[0].read()
-        response = requests.post(
-            "https://api-inference.huggingface.co/models/google/vit-base-patch16-224", data=data, headers=headers)
-        json_response = response.json()
+        # every file is classified concurrently (see utils/filePool.py) and the texts are returned in one response
+        return combine_results(file_pool.map(self.image_classification_file, files), files)
+
+    def image_classification_file(self, file):
+        headers = self.auth_headers
+
+        # the same file always produces the same result, hence the route can opt in to the response cache and the call
+        # is idempotent (it is retried even when the provider may have processed it, see utils/resilience.py) - only a
+        # cache miss takes a slot of the provider
+        def request():
+            if micro_batcher.enabled():
+                # concurrent requests for the model are sent upstream as a single batched call
+                return self.image_classification_result(micro_batcher.submit(
+                    "google/vit-base-patch16-224", read_into_memory(file.stream), self.batch_inference("google/vit-base-patch16-224")))
+            # the file is streamed upstream in chunks instead of being read into memory
+            response = http_client.post(
+                "https://api-inference.huggingface.co/models/google/vit-base-patch16-224", data=file.stream, headers=headers,
+                idempotent=True)
+            return self.image_classification_result(response.json())
+        return response_cache.cached("huggingface-image", "google/vit-base-patch16-224", lambda: file_digest(file),
+                                     lambda: resilience.call("huggingface", request))
+
+    @guards_itself
+    async def image_classification_async(self, files):
+        return combine_results(await file_pool.map_async(self.image_classification_file_async, files), files)
+
+    async def image_classification_file_async(self, file):
+        headers = dict(self.auth_headers)
+
+        async def request():
+            if micro_batcher.enabled():
+                return self.image_classification_result(await micro_batcher.submit_async(
+                    "google/vit-base-patch16-224", read_into_memory(file.stream),
+                    self.batch_inference_async("google/vit-base-patch16-224")))
+            body = FileBody(file.stream)
+            headers["Content-Length"] = str(len(body))
+            response = await async_http_client.post(
+                "https://api-inference.huggingface.co/models/google/vit-base-patch16-224", content=body, headers=headers,
+                idempotent=True)
+            return self.image_classification_result(response.json())
+        return await response_cache.cached_async(
+            "huggingface-image", "google/vit-base-patch16-224", lambda: file_digest(file),
+            lambda: resilience.call_async("huggingface", request))
+
+    @staticmethod
+    def image_classification_result(json_response):
         if "error" in json_response:
             raise Exception(json_response["error"])
         # Sends response back to Deep Chat using the Response format:
         # https://deepchat.dev/docs/connect/#Response
         return {"text": json_response[0]["label"]}
-    
+
     # You can use an example audio file here: https://github.com/OvidijusParsiunas/deep-chat/blob/main/example-servers/ui/assets/example-audio.m4a
+    @guards_itself
     def speech_recognition(self, files):
-        headers = {
-            "Authorization": "Bearer " + os.getenv("HUGGING_FACE_API_KEY")
-        }
         # Files are stored inside a files object
         # https://deepchat.dev/docs/connect
-        data=files[0].read()
-        response = requests.post(
-            "https://api-inference.huggingface.co/models/facebook/wav2vec2-large-960h-lv60-self", data=data, headers=headers)
-        json_response = response.json()
+        # every file is transcribed concurrently (see utils/filePool.py) and the texts are returned in one response
+        return combine_results(file_pool.map(self.speech_recognition_file, files), files)
+
+    def speech_recognition_file(self, file):
+        headers = self.auth_headers
+
+        # the same file always produces the same result, hence the route can opt in to the response cache and the call
+        # is idempotent (it is retried even when the provider may have processed it, see utils/resilience.py) - only a
+        # cache miss takes a slot of the provider
+        def request():
+            if micro_batcher.enabled():
+                # concurrent requests for the model are sent upstream as a single batched call
+                return self.speech_recognition_result(micro_batcher.submit(
+                    "facebook/wav2vec2-large-960h-lv60-self", read_into_memory(file.stream),
+                    self.batch_inference("facebook/wav2vec2-large-960h-lv60-self")))
+            # the file is streamed upstream in chunks instead of being read into memory
+            response = http_client.post(
+                "https://api-inference.huggingface.co/models/facebook/wav2vec2-large-960h-lv60-self", data=file.stream, headers=headers,
+                idempotent=True)
+            return self.speech_recognition_result(response.json())
+        return response_cache.cached(
+            "huggingface-speech", "facebook/wav2vec2-large-960h-lv60-self", lambda: file_digest(file),
+            lambda: resilience.call("huggingface", request))
+
+    @guards_itself
+    async def speech_recognition_async(self, files):
+        return combine_results(await file_pool.map_async(self.speech_recognition_file_async, files), files)
+
+    async def speech_recognition_file_async(self, file):
+        headers = dict(self.auth_headers)
+
+        async def request():
+            if micro_batcher.enabled():
+                return self.speech_recognition_result(await micro_batcher.submit_async(
+                    "facebook/wav2vec2-large-960h-lv60-self", read_into_memory(file.stream),
+                    self.batch_inference_async("facebook/wav2vec2-large-960h-lv60-self")))
+            body = FileBody(file.stream)
+            headers["Content-Length"] = str(len(body))
+            response = await async_http_client.post(
+                "https://api-inference.huggingface.co/models/facebook/wav2vec2-large-960h-lv60-self", content=body, headers=headers,
+                idempotent=True)
+            return self.speech_recognition_result(response.json())
+        return await response_cache.cached_async(
+            "huggingface-speech", "facebook/wav2vec2-large-960h-lv60-self", lambda: file_digest(file),
+            lambda: resilience.call_async("huggingface", request))
+
+    @staticmethod
+    def speech_recognition_result(json_response):
         if "error" in json_response:
             raise Exception(json_response["error"])
         # Sends response back to Deep Chat using the Response format:
         # https://deepchat.dev/docs/connect/#Response
         return {"text": json_response["text"]}
+
+    # Micro-batching (MICRO_BATCHING=true) - the files of concurrent requests are sent as a list of base64 encoded
+    # inputs in a single call and the response contains a result for every input in the same order
+    @staticmethod
+    def create_batch_body(contents):
+        return {"inputs": [base64.b64encode(content).decode() for content in contents], "options": {"wait_for_model": True}}
+
+    def batch_inference(self, model):
+        def send_batch(contents):
+            headers = self.json_headers
+            response = http_client.post(
+                "https://api-inference.huggingface.co/models/" + model, json=HuggingFace.create_batch_body(contents), headers=headers,
+                idempotent=True)
+            return HuggingFace.batch_result(response.json())
+        return send_batch
+
+    def batch_inference_async(self, model):
+        async def send_batch(contents):
+            headers = self.json_headers
+            response = await async_http_client.post(
+                "https://api-inference.huggingface.co/models/" + model, json=HuggingFace.create_batch_body(contents), headers=headers,
+                idempotent=True)
+            return HuggingFace.batch_result(response.json())
+        return send_batch
+
+    # an error of the batched call is raised for every request of the batch
+    @staticmethod
+    def batch_result(json_response):
+        if "error" in json_response:
+            raise Exception(json_response["error"])
+        return json_response
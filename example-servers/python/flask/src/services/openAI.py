@@ -1,37 +1,71 @@
+from utils.conversationStore import conversation_store
+from utils.asyncHttpClient import async_http_client
+from utils.filePool import file_pool, combine_results
+from utils.imagePreprocessor import image_preprocessor
+from utils.uploadStream import MultipartStream
+from utils.httpClient import http_client
+from utils.sse import iter_events, aiter_events
+from utils.sseWriter import sse_writer
+from utils.metrics import metrics
 from flask import Response
-import requests
 import json
+import time
 import os
 
 # Make sure to set the OPENAI_API_KEY environment variable in a .env file (create if does not exist) - see .env.example
 
 class OpenAI:
+    # the headers are built once - the API key has been validated by the provider registry (see utils/providerRegistry.py)
+    def __init__(self):
+        self.auth_headers = {"Authorization": "Bearer " + os.getenv("OPENAI_API_KEY")}
+        self.json_headers = dict(self.auth_headers, **{"Content-Type": "application/json"})
+
     @staticmethod
     def create_chat_body(body, stream=False):
         # Text messages are stored inside request body using the Deep Chat JSON format:
         # https://deepchat.dev/docs/connect
         chat_body = {
-            "messages": [
-                {
-                    "role": "assistant" if message["role"] == "ai" else message["role"],
-                    "content": message["text"]
-                } for message in body["messages"]
-            ],
+            # when the request has a conversationId - only its new message is sent and the history is kept by the server
+            "messages": conversation_store.window("openai", body, OpenAI.format_message),
             "model": body["model"]
         }
         if stream:
             chat_body["stream"] = True
         return chat_body
 
-    def chat(self, body):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY")
+    @staticmethod
+    def format_message(message):
+        return {
+            "role": "assistant" if message["role"] == "ai" else message["role"],
+            "content": message["text"]
         }
+
+    # adds the new messages and the response to the stored conversation (if the request has a conversationId) - only
+    # called once the provider has responded
+    @staticmethod
+    def record_response(body, text):
+        conversation_store.record("openai", body, OpenAI.format_message, text)
+
+    def chat(self, body):
+        headers = self.json_headers
+        chat_body = self.create_chat_body(body)
+        response = http_client.post(
+            "https://api.openai.com/v1/chat/completions", json=chat_body, headers=headers)
+        result = self.chat_result(response.json())
+        self.record_response(body, result["text"])
+        return result
+
+    async def chat_async(self, body):
+        headers = self.json_headers
         chat_body = self.create_chat_body(body)
-        response = requests.post(
+        response = await async_http_client.post(
             "https://api.openai.com/v1/chat/completions", json=chat_body, headers=headers)
-        json_response = response.json()
+        result = self.chat_result(response.json())
+        self.record_response(body, result["text"])
+        return result
+
+    @staticmethod
+    def chat_result(json_response):
         if "error" in json_response:
             raise Exception(json_response["error"]["message"])
         result = json_response["choices"][0]["message"]["content"]
@@ -40,56 +74,109 @@ class OpenAI:
         return {"text": result}
 
     def chat_stream(self, body):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY")
-        }
+        return Response(self.chat_stream_events(body), mimetype="text/event-stream")
+
+    # sends the upstream request and checks that it is an event stream before the stream events generator is returned,
+    # hence an error response is raised to the route (and sent back as a JSON error) before the stream starts
+    def chat_stream_events(self, body):
+        headers = self.json_headers
         chat_body = self.create_chat_body(body, stream=True)
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions", json=chat_body, headers=headers, stream=True)
+        url = "https://api.openai.com/v1/chat/completions"
+        start = time.perf_counter()
+        response = http_client.post(url, json=chat_body, headers=headers, stream=True)
+        if not self.is_event_stream(response.headers):
+            self.raise_stream_error(response.content)
 
         def generate():
-            # increase chunk size if getting errors for long messages
-            for chunk in response.iter_content(chunk_size=2048):
-                if chunk:
-                    if not(chunk.decode().strip().startswith("data")):
-                        errorMessage = json.loads(chunk.decode())["error"]["message"]
-                        print("Error in the retrieved stream chunk:", errorMessage)
-                        # this exception is not caught, however it signals to the user that there was an error
-                        raise Exception(errorMessage)
-                    lines = chunk.decode().split("\n")
-                    filtered_lines = list(
-                        filter(lambda line: line.strip(), lines))
-                    for line in filtered_lines:
-                        data = line.replace("data:", "").replace(
-                            "[DONE]", "").replace("data: [DONE]", "").strip()
-                        if data:
-                            try:
-                                result = json.loads(data)
-                                content = result["choices"][0].get("delta", {}).get("content", "")
-                                # Sends response back to Deep Chat using the Response format:
-                                # https://deepchat.dev/docs/connect/#Response
-                                yield "data: {}\n\n".format(json.dumps({"text": content}))
-                            except json.JSONDecodeError:
-                                # Incomplete JSON string, continue accumulating lines
-                                pass
-        return Response(generate(), mimetype="text/event-stream")
-
-    # By default - the OpenAI API will accept 1024x1024 png images, however other dimensions/formats can sometimes work by default
+            texts = []
+            # chunks are yielded as soon as they arrive and events split across chunks are reassembled by the parser
+            # metrics.upstream_stream records the time to the first token and the duration of the stream
+            for event in iter_events(metrics.upstream_stream(url, start, response.iter_content(chunk_size=None))):
+                text = self.parse_stream_event(event)
+                if text is not None:
+                    texts.append(text)
+                    yield text
+            self.record_response(body, "".join(texts))
+        # Sends response back to Deep Chat using the Response format:
+        # https://deepchat.dev/docs/connect/#Response
+        # the texts are encoded (and coalesced) into SSE frames by the shared writer (see utils/sseWriter.py)
+        return sse_writer.frames(generate())
+
+    @staticmethod
+    def is_event_stream(headers):
+        return headers.get("Content-Type", "").startswith("text/event-stream")
+
+    # errors (e.g. an invalid API key) are sent back as a regular JSON response instead of an event stream
+    @staticmethod
+    def raise_stream_error(content):
+        errorMessage = json.loads(content)["error"]["message"]
+        print("Error in the retrieved stream:", errorMessage)
+        # this exception is not caught, however it signals to the user that there was an error
+        raise Exception(errorMessage)
+
+    # returns the text of the event or None if the event does not contain any (e.g. the final [DONE] event)
+    @staticmethod
+    def parse_stream_event(event):
+        if event.data == "[DONE]":
+            return None
+        result = json.loads(event.data)
+        return result["choices"][0].get("delta", {}).get("content", "")
+
+    # Async counterpart of chat_stream used by asyncApp.py - yields the same events without blocking the event loop
+    async def chat_stream_async(self, body):
+        async for frame in sse_writer.aframes(self.chat_stream_texts_async(body)):
+            yield frame
+
+    async def chat_stream_texts_async(self, body):
+        headers = self.json_headers
+        chat_body = self.create_chat_body(body, stream=True)
+        url = "https://api.openai.com/v1/chat/completions"
+        start = time.perf_counter()
+        async with async_http_client.stream("POST", url, json=chat_body, headers=headers) as response:
+            if not self.is_event_stream(response.headers):
+                self.raise_stream_error(await response.aread())
+            texts = []
+            async for event in aiter_events(metrics.aupstream_stream(url, start, response.aiter_bytes())):
+                text = self.parse_stream_event(event)
+                if text is not None:
+                    texts.append(text)
+                    yield text
+        self.record_response(body, "".join(texts))
+
+    # By default - the OpenAI API will accept 1024x1024 png images, other images are converted before they are sent
     # You can use an example image here: https://github.com/OvidijusParsiunas/deep-chat/blob/main/example-servers/ui/assets/example-image.png
     def image_variation(self, files):
-        url = "https://api.openai.com/v1/images/variations"
-        headers = {
-            "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY")
-        }
         # Files are stored inside a files object
         # https://deepchat.dev/docs/connect
-        image_file = files[0]
-        form = {
-            "image": (image_file.filename, image_file.read(), image_file.mimetype)
-        }
-        response = requests.post(url, files=form, headers=headers)
-        json_response = response.json()
+        # every file is sent concurrently (see utils/filePool.py) and the variations are returned in one response
+        return combine_results(file_pool.map(self.image_variation_file, files), files)
+
+    def image_variation_file(self, file):
+        url = "https://api.openai.com/v1/images/variations"
+        headers = dict(self.auth_headers)
+        # the image is validated and converted into a square PNG of up to 1024x1024 (see utils/imagePreprocessor.py)
+        file = image_preprocessor.prepare("openai-image", file)
+        # the file is streamed upstream in chunks instead of being read into memory
+        form = MultipartStream(files={"image": file})
+        headers["Content-Type"] = form.content_type
+        response = http_client.post(url, data=form, headers=headers)
+        return self.image_variation_result(response.json())
+
+    async def image_variation_async(self, files):
+        return combine_results(await file_pool.map_async(self.image_variation_file_async, files), files)
+
+    async def image_variation_file_async(self, file):
+        url = "https://api.openai.com/v1/images/variations"
+        headers = dict(self.auth_headers)
+        file = await image_preprocessor.prepare_async("openai-image", file)
+        form = MultipartStream(files={"image": file})
+        headers["Content-Type"] = form.content_type
+        headers["Content-Length"] = str(len(form))
+        response = await async_http_client.post(url, content=form, headers=headers)
+        return self.image_variation_result(response.json())
+
+    @staticmethod
+    def image_variation_result(json_response):
         if "error" in json_response:
             raise Exception(json_response["error"]["message"])
         # Sends response back to Deep Chat using the Response format:
@@ -1,69 +1,139 @@
-import requests
+from utils.asyncHttpClient import async_http_client
+from utils.artifactStore import artifact_store
+from utils.responseCache import response_cache
+from utils.uploadStream import MultipartStream, file_digest
+from utils.imagePreprocessor import image_preprocessor
+from utils.filePool import file_pool, combine_results
+from utils.resilience import resilience, guards_itself
+from utils.httpClient import http_client
 import json
 import os
 
 # Make sure to set the STABILITY_API_KEY environment variable in a .env file (create if does not exist) - see .env.example
 
 class StabilityAI:
+    # the headers are only built once per process instead of for every request
+    def __init__(self):
+        self.auth_headers = {"Authorization": "Bearer " + os.getenv("STABILITY_API_KEY")}
+        self.json_headers = dict(self.auth_headers, **{"Content-Type": "application/json"})
+
     def text_to_image(self, body):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + os.getenv("STABILITY_API_KEY")
-        }
+        headers = self.json_headers
         description_body = {"text_prompts": [{"text": body["messages"][0]["text"]}]}
-        response = requests.post(
+        response = http_client.post(
             "https://api.stability.ai/v1/generation/stable-diffusion-v1-6/text-to-image", json=description_body, headers=headers)
-        json_response = response.json()
-        if "message" in json_response:    
-            raise Exception(json_response["message"])
-        result = json_response["artifacts"][0]["base64"]
-        # Sends response back to Deep Chat using the Response format:
-        # https://deepchat.dev/docs/connect/#Response
-        return {"files": [{"type": "image", "src": "data:image/png;base64," + result}]}
+        return self.image_result(response.json())
+
+    async def text_to_image_async(self, body):
+        headers = self.json_headers
+        description_body = {"text_prompts": [{"text": body["messages"][0]["text"]}]}
+        response = await async_http_client.post(
+            "https://api.stability.ai/v1/generation/stable-diffusion-v1-6/text-to-image", json=description_body, headers=headers)
+        return self.image_result(response.json())
 
     # You can use an example image here: https://github.com/OvidijusParsiunas/deep-chat/blob/main/example-servers/ui/assets/example-image.png
     def image_to_image(self, request):
         url = "https://api.stability.ai/v1/generation/stable-diffusion-v1-6/image-to-image"
-        headers = {
-            "Authorization": "Bearer " + os.getenv("STABILITY_API_KEY")
-        }
+        headers = dict(self.auth_headers)
         # Files are stored inside a files object
         # https://deepchat.dev/docs/connect
         request_files = request.files.getlist("files")
-        image_file = request_files[0]
-        form = {
-            "init_image": (image_file.filename, image_file.read(), image_file.mimetype),
+        fields = {
             # When sending text messages along with files - they are stored inside the data form
             # https://deepchat.dev/docs/connect
             "text_prompts[0][text]": json.loads(request.form.get("message1"))['text'],
             "text_prompts[0][weight]": 1
         }
-        response = requests.post(url, files=form, headers=headers)
-        json_response = response.json()
-        if "message" in json_response:    
-            raise Exception(json_response["message"])
-        result = json_response["artifacts"][0]["base64"]
-        # Sends response back to Deep Chat using the Response format:
-        # https://deepchat.dev/docs/connect/#Response
-        return {"files": [{"type": "image", "src": "data:image/png;base64," + result}]}
+        # the image is validated and resized to dimensions that the model accepts (see utils/imagePreprocessor.py)
+        init_image = image_preprocessor.prepare("stability-image-to-image", request_files[0])
+        # the file is streamed upstream in chunks instead of being read into memory
+        form = MultipartStream(fields=fields, files={"init_image": init_image})
+        headers["Content-Type"] = form.content_type
+        response = http_client.post(url, data=form, headers=headers)
+        return self.image_result(response.json())
+
+    # the files and form of an async (Quart) request need to be awaited
+    async def image_to_image_async(self, request):
+        url = "https://api.stability.ai/v1/generation/stable-diffusion-v1-6/image-to-image"
+        headers = dict(self.auth_headers)
+        request_files = (await request.files).getlist("files")
+        form_data = await request.form
+        fields = {
+            "text_prompts[0][text]": json.loads(form_data.get("message1"))['text'],
+            "text_prompts[0][weight]": 1
+        }
+        init_image = await image_preprocessor.prepare_async("stability-image-to-image", request_files[0])
+        form = MultipartStream(fields=fields, files={"init_image": init_image})
+        headers["Content-Type"] = form.content_type
+        headers["Content-Length"] = str(len(form))
+        response = await async_http_client.post(url, content=form, headers=headers)
+        return self.image_result(response.json())
 
     # You can use an example image here: https://github.com/OvidijusParsiunas/deep-chat/blob/main/example-servers/ui/assets/example-image.png
+    @guards_itself
     def image_to_image_upscale(self, files):
-        url = "https://api.stability.ai/v1/generation/esrgan-v1-x2plus/image-to-image/upscale"
-        headers = {
-            "Authorization": "Bearer " + os.getenv("STABILITY_API_KEY")
-        }
         # Files are stored inside a files object
         # https://deepchat.dev/docs/connect
-        image_file = files[0]
-        form = {
-            "image": (image_file.filename, image_file.read(), image_file.mimetype)
-        }
-        response = requests.post(url, files=form, headers=headers)
-        json_response = response.json()
-        if "message" in json_response:    
+        # every file is upscaled concurrently (see utils/filePool.py) and the images are returned in one response
+        return combine_results(file_pool.map(self.image_to_image_upscale_file, files), files)
+
+    def image_to_image_upscale_file(self, image_file):
+        url = "https://api.stability.ai/v1/generation/esrgan-v1-x2plus/image-to-image/upscale"
+        headers = dict(self.auth_headers)
+
+        # the same image always produces the same upscaled image, hence the route can opt in to the response cache and
+        # the call is idempotent (it is retried even when the provider may have processed it, see utils/resilience.py) -
+        # only a cache miss takes a slot of the provider
+        # the cache stores only the base64 image instead of the upstream JSON response - the ":base64" tag of the model
+        # gives these entries keys of their own, hence an on-disk entry that holds a JSON response (untagged key) is
+        # never read as an image. The artifact is written for every response as it can have been evicted.
+        def request():
+            # a cached response does not need the image to be preprocessed
+            image = image_preprocessor.prepare("stability-image-upscale", image_file)
+            # the file is streamed upstream in chunks instead of being read into memory
+            form = MultipartStream(files={"image": image})
+            headers["Content-Type"] = form.content_type
+            response = http_client.post(url, data=form, headers=headers, idempotent=True)
+            return self.image_base64(response.json())
+        return self.image_response(
+            response_cache.cached("stability-image-upscale", "esrgan-v1-x2plus:base64", lambda: file_digest(image_file),
+                                  lambda: resilience.call("stabilityai", request)))
+
+    @guards_itself
+    async def image_to_image_upscale_async(self, files):
+        return combine_results(await file_pool.map_async(self.image_to_image_upscale_file_async, files), files)
+
+    async def image_to_image_upscale_file_async(self, image_file):
+        url = "https://api.stability.ai/v1/generation/esrgan-v1-x2plus/image-to-image/upscale"
+        headers = dict(self.auth_headers)
+
+        async def request():
+            image = await image_preprocessor.prepare_async("stability-image-upscale", image_file)
+            form = MultipartStream(files={"image": image})
+            headers["Content-Type"] = form.content_type
+            headers["Content-Length"] = str(len(form))
+            response = await async_http_client.post(url, content=form, headers=headers, idempotent=True)
+            return self.image_base64(response.json())
+        return self.image_response(await response_cache.cached_async(
+            "stability-image-upscale", "esrgan-v1-x2plus:base64", lambda: file_digest(image_file),
+            lambda: resilience.call_async("stabilityai", request)))
+
+    @staticmethod
+    def image_result(json_response):
+        return StabilityAI.image_response(StabilityAI.image_base64(json_response))
+
+    @staticmethod
+    def image_base64(json_response):
+        if "message" in json_response:
             raise Exception(json_response["message"])
-        result = json_response["artifacts"][0]["base64"]
+        return json_response["artifacts"][0]["base64"]
+
+    @staticmethod
+    def image_response(result):
+        if artifact_store.enabled():
+            # the image is decoded once into the artifact store and the response only contains its URL
+            name = artifact_store.save_base64(result, "png")
+            return {"files": [{"type": "image", "src": artifact_store.url(name)}]}
         # Sends response back to Deep Chat using the Response format:
         # https://deepchat.dev/docs/connect/#Response
         return {"files": [{"type": "image", "src": "data:image/png;base64," + result}]}
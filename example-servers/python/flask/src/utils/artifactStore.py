@@ -0,0 +1,92 @@
+from utils.config import config
+import threading
+import hashlib
+import base64
+import time
+import re
+import os
+
+# Content-addressed on-disk store for generated binary artifacts (images). Instead of returning multi-megabyte
+# base64 data URLs inside the JSON response, an artifact is decoded once, written to disk under the hash of its content
+# and the response contains a short URL to the /artifacts route. The route sends the file without copying it through
+# Python (sendfile when supported by the server) and supports ETag and Range requests, hence repeated views are cached.
+
+# Settings can be configured in the .env file (see .env.example):
+# ARTIFACT_STORE - set to true to return artifact URLs instead of data URLs
+# ARTIFACT_STORE_DIR - directory where the artifacts are stored
+# ARTIFACT_BASE_URL - address of this server as seen by the browser (the UI is usually served from another origin)
+# ARTIFACT_STORE_MAX_MB/ARTIFACT_MAX_AGE - the oldest artifacts are evicted when the store exceeds the size or age
+
+_NAME = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,5}$")
+
+MIME_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+
+class ArtifactStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._size = None
+        self._last_eviction = 0
+
+    def enabled(self):
+        return config.get("artifact_store")["enabled"]
+
+    def url(self, name):
+        return f"{config.get('artifact_store')['base_url']}/artifacts/{name}"
+
+    # returns None for names that were not created by the store (e.g. path traversal attempts)
+    def path(self, name):
+        if not _NAME.match(name):
+            return None
+        path = os.path.join(config.get("artifact_store")["dir"], name)
+        return path if os.path.isfile(path) else None
+
+    # decodes the artifact once and returns its name - identical artifacts are only stored once
+    def save_base64(self, data, extension):
+        content = base64.b64decode(data)
+        name = f"{hashlib.sha256(content).hexdigest()}.{extension}"
+        directory = config.get("artifact_store")["dir"]
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            # refreshes the age of the artifact as it is being used again
+            os.utime(path)
+            return name
+        os.makedirs(directory, exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(content)
+        os.replace(temporary_path, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += len(content)
+        self._evict()
+        return name
+
+    def _evict(self):
+        settings = config.get("artifact_store")
+        now = time.time()
+        with self._lock:
+            # the directory is only scanned when the store is over its size or once a minute for expired artifacts
+            if self._size is not None and self._size <= settings["max_bytes"] and now - self._last_eviction < 60:
+                return
+            self._last_eviction = now
+            artifacts = []
+            with os.scandir(settings["dir"]) as entries:
+                for entry in entries:
+                    if _NAME.match(entry.name):
+                        stat = entry.stat()
+                        artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+            artifacts.sort()
+            size = sum(artifact_size for _, artifact_size, _ in artifacts)
+            for modified, artifact_size, path in artifacts:
+                if size <= settings["max_bytes"] and now - modified <= settings["max_age"]:
+                    break
+                try:
+                    os.remove(path)
+                    size -= artifact_size
+                except OSError:
+                    pass
+            self._size = size
+
+
+artifact_store = ArtifactStore()
@@ -0,0 +1,130 @@
+from utils.resilience import resilience, body_rewinder, RETRY_STATUSES, IDEMPOTENT_RETRY_STATUSES
+from contextlib import asynccontextmanager
+from utils.metrics import metrics, provider
+from utils.httpClient import http_client
+from urllib.parse import urlsplit
+from utils.config import config
+import asyncio
+import time
+
+# Non-blocking counterpart of the shared upstream client that is used by the async serving mode (asyncApp.py).
+# It uses the same UPSTREAM_* settings as the synchronous client and keeps a keep-alive pool per provider host.
+# The event loop is not blocked while waiting for upstream tokens, hence a single process can hold thousands of streams.
+
+
+class AsyncHTTPClient:
+    def __init__(self):
+        self._clients = {}
+        self._requests = {}
+
+    def client(self, url):
+        host = urlsplit(url).netloc
+        client = self._clients.get(host)
+        if client is None:
+            # httpx is imported here as it is only required when the server is started in the async mode
+            import httpx
+            settings = config.get("http_client")
+            connect_timeout, read_timeout = settings["timeout"]
+            # when UPSTREAM_POOL_BLOCK is true the connection count is capped and requests wait for a free connection
+            limits = httpx.Limits(max_keepalive_connections=settings["pool_size"],
+                                  max_connections=settings["pool_size"] if settings["pool_block"] else None)
+            client = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+            self._clients[host] = client
+        return client
+
+    def _count(self, url):
+        host = urlsplit(url).netloc
+        self._requests[host] = self._requests.get(host, 0) + 1
+
+    # retryable failures are retried with backoff and the outcome of the call is reported to the circuit breaker of
+    # the provider (see utils/resilience.py) - idempotent calls (e.g. of the deterministic routes) are also retried
+    # when the provider may have processed them
+    async def post(self, url, idempotent=False, **kwargs):
+        provider_url = url
+        name = provider(url)
+        url = http_client.resolve(url)
+        statuses = IDEMPOTENT_RETRY_STATUSES if idempotent else RETRY_STATUSES
+        rewind = body_rewinder(kwargs.get("content"))
+        attempt = 0
+        while True:
+            self._count(url)
+            start = time.perf_counter()
+            try:
+                response = await self.client(url).post(url, **kwargs)
+            except Exception as error:
+                metrics.upstream_error(provider_url, error)
+                delay = resilience.retry_delay(name, attempt) if _retryable(error, idempotent) and rewind else None
+                if delay is None:
+                    resilience.record(name, False)
+                    raise
+            else:
+                metrics.upstream(provider_url, response.status_code, time.perf_counter() - start,
+                                 int(response.request.headers.get("Content-Length") or 0), len(response.content))
+                delay = None
+                if response.status_code in statuses and rewind:
+                    delay = resilience.retry_delay(name, attempt, response.headers.get("Retry-After"))
+                if delay is None:
+                    resilience.record(name, response.status_code < 500 and response.status_code != 429)
+                    return response
+            await asyncio.sleep(delay)
+            rewind()
+            attempt += 1
+
+    # used for streamed responses - "async with async_http_client.stream(...) as response"
+    # the body is counted by metrics.aupstream_stream while it is being read, a call is only retried before its
+    # response is handed over
+    @asynccontextmanager
+    async def stream(self, method, url, idempotent=False, **kwargs):
+        provider_url = url
+        name = provider(url)
+        url = http_client.resolve(url)
+        statuses = IDEMPOTENT_RETRY_STATUSES if idempotent else RETRY_STATUSES
+        rewind = body_rewinder(kwargs.get("content"))
+        attempt = 0
+        while True:
+            self._count(url)
+            start = time.perf_counter()
+            response = None
+            try:
+                async with self.client(url).stream(method, url, **kwargs) as response:
+                    metrics.upstream(provider_url, response.status_code, time.perf_counter() - start,
+                                     int(response.request.headers.get("Content-Length") or 0), 0)
+                    delay = None
+                    if response.status_code in statuses and rewind:
+                        delay = resilience.retry_delay(name, attempt, response.headers.get("Retry-After"))
+                    if delay is None:
+                        resilience.record(name, response.status_code < 500 and response.status_code != 429)
+                        yield response
+                        return
+            except Exception as error:
+                # errors raised while the stream is being read are counted by metrics.aupstream_stream
+                if response is not None:
+                    raise
+                metrics.upstream_error(provider_url, error)
+                delay = resilience.retry_delay(name, attempt) if _retryable(error, idempotent) and rewind else None
+                if delay is None:
+                    resilience.record(name, False)
+                    raise
+            await asyncio.sleep(delay)
+            rewind()
+            attempt += 1
+
+    def stats(self):
+        return {"hosts": {host: {"requests": count} for host, count in self._requests.items()}}
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = {}
+
+
+# calls that did not reach the provider are retried, calls whose connection failed after the request may have been sent
+# only when they are idempotent - read timeouts are never retried as the provider may still be processing the call
+def _retryable(error, idempotent):
+    import httpx
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    return idempotent and isinstance(error, (httpx.RemoteProtocolError, httpx.ReadError, httpx.WriteError))
+
+
+async_http_client = AsyncHTTPClient()
@@ -0,0 +1,252 @@
+import threading
+import os
+
+# Settings of the utils and the provider registry. The apps read and validate every setting once at startup (load right
+# after load_dotenv()), hence an invalid value (e.g. UPSTREAM_RETRIES=two) stops the app with an error that names the
+# variable instead of failing the first request that needs it. The modules read their section with config.get(name) -
+# the variables are documented in the modules that use them and in .env.example.
+
+
+def _value(name, default):
+    # unset and empty variables use the default
+    return os.getenv(name) or default
+
+
+def _integer(name, default, minimum=0):
+    value = _value(name, str(default))
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} needs to be a whole number, got {value!r}")
+    if number < minimum:
+        raise ValueError(f"{name} needs to be at least {minimum}, got {number}")
+    return number
+
+
+def _number(name, default, minimum=0):
+    value = _value(name, str(default))
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"{name} needs to be a number, got {value!r}")
+    if number < minimum:
+        raise ValueError(f"{name} needs to be at least {minimum}, got {number}")
+    return number
+
+
+def _flag(name, default):
+    value = _value(name, "true" if default else "false").lower()
+    if value not in ("true", "false"):
+        raise ValueError(f"{name} needs to be true or false, got {value!r}")
+    return value == "true"
+
+
+def _choice(name, default, choices):
+    value = _value(name, default).lower()
+    if value not in choices:
+        raise ValueError(f"{name} needs to be one of {', '.join(choice or '(empty)' for choice in choices)}, "
+                         f"got {value!r}")
+    return value
+
+
+def _list(name):
+    return [item.strip() for item in _value(name, "").split(",") if item.strip()]
+
+
+# settings of serve.py (and the port of the development server of the apps)
+def _server():
+    return {
+        "host": _value("HOST", "0.0.0.0"),
+        "port": _integer("PORT", 8080, 1),
+        "workers": _integer("SERVER_WORKERS", os.cpu_count() or 1, 1),
+        "threads": _integer("SERVER_THREADS", 32, 1),
+        "keep_alive": _integer("SERVER_KEEP_ALIVE", 5),
+        "graceful_timeout": _integer("SERVER_GRACEFUL_TIMEOUT", 30),
+        "backlog": _integer("SERVER_BACKLOG", 2048, 1),
+    }
+
+
+def _providers():
+    # imported here as the registry itself reads its settings from this module
+    from utils.providerRegistry import PROVIDERS
+    listed = [name.lower() for name in _list("PROVIDERS")]
+    unknown = [name for name in listed if name not in PROVIDERS]
+    if unknown:
+        raise ValueError(f"Unknown providers in PROVIDERS: {', '.join(unknown)}")
+    enabled = []
+    disabled = {}
+    for name, (_, _, key) in PROVIDERS.items():
+        if listed and name not in listed:
+            disabled[name] = "not listed in PROVIDERS"
+        elif not os.getenv(key):
+            if listed:
+                raise ValueError(f"{name} is listed in PROVIDERS, however {key} is not set")
+            disabled[name] = f"{key} is not set"
+        else:
+            enabled.append(name)
+    return {"enabled": enabled, "disabled": disabled}
+
+
+def _http_client():
+    overrides = []
+    for override in _list("UPSTREAM_URL_OVERRIDES"):
+        if "=" not in override:
+            raise ValueError(f"UPSTREAM_URL_OVERRIDES needs prefix=replacement pairs, got {override!r}")
+        overrides.append(tuple(override.split("=", 1)))
+    return {
+        "pool_size": _integer("UPSTREAM_POOL_SIZE", 10, 1),
+        "pool_block": _flag("UPSTREAM_POOL_BLOCK", False),
+        "timeout": (_number("UPSTREAM_CONNECT_TIMEOUT", 5), _number("UPSTREAM_READ_TIMEOUT", 120)),
+        "overrides": overrides,
+    }
+
+
+def _resilience():
+    return {
+        "concurrency": _integer("PROVIDER_CONCURRENCY", 32),
+        "queue_size": _integer("PROVIDER_QUEUE_SIZE", 64),
+        "queue_timeout": _number("PROVIDER_QUEUE_TIMEOUT", 10),
+        "failure_threshold": _integer("CIRCUIT_FAILURE_THRESHOLD", 5, 1),
+        "open_seconds": _number("CIRCUIT_OPEN_SECONDS", 30),
+        "retries": _integer("UPSTREAM_RETRIES", 2),
+        "backoff": _number("UPSTREAM_RETRY_BACKOFF_MS", 200) / 1000,
+    }
+
+
+def _response_cache():
+    return {
+        "routes": {route.lstrip("/") for route in _list("RESPONSE_CACHE_ROUTES")},
+        "max_bytes": int(_number("RESPONSE_CACHE_MAX_MB", 64) * 1024 * 1024),
+        "ttl": _number("RESPONSE_CACHE_TTL", 3600),
+        "dir": os.getenv("RESPONSE_CACHE_DIR") or None,
+    }
+
+
+def _single_flight():
+    return {"enabled": _flag("SINGLE_FLIGHT", True)}
+
+
+def _conversation_store():
+    return {
+        "backend": _choice("CONVERSATION_STORE", "", ("", "memory", "file")),
+        "dir": _value("CONVERSATION_STORE_DIR", ".cache/conversations"),
+        "token_budget": _integer("CONVERSATION_TOKEN_BUDGET", 3000, 1),
+        "idle_ttl": _number("CONVERSATION_IDLE_TTL", 3600),
+    }
+
+
+def _upload():
+    return {
+        "memory_limit": _integer("UPLOAD_MEMORY_LIMIT_KB", 512) * 1024,
+        "chunk_size": _integer("UPLOAD_CHUNK_SIZE_KB", 64, 1) * 1024,
+    }
+
+
+def _file_pool():
+    return {
+        "per_request": _integer("FILES_CONCURRENCY_PER_REQUEST", 4, 1),
+        "global": _integer("FILES_CONCURRENCY_GLOBAL", 16, 1),
+    }
+
+
+def _artifact_store():
+    return {
+        "enabled": _flag("ARTIFACT_STORE", False),
+        "dir": os.path.abspath(_value("ARTIFACT_STORE_DIR", ".cache/artifacts")),
+        "base_url": _value("ARTIFACT_BASE_URL", "http://localhost:8080").rstrip("/"),
+        "max_bytes": int(_number("ARTIFACT_STORE_MAX_MB", 512) * 1024 * 1024),
+        "max_age": _number("ARTIFACT_MAX_AGE", 86400),
+    }
+
+
+def _stream_pacer():
+    return {
+        "tokens_per_second": _number("STREAM_TOKENS_PER_SECOND", 0),
+        "delay": _number("STREAM_CHUNK_DELAY", 0.07),
+    }
+
+
+def _micro_batcher():
+    return {
+        "enabled": _flag("MICRO_BATCHING", False),
+        "max_size": _integer("MICRO_BATCH_MAX_SIZE", 8, 1),
+        "wait": _number("MICRO_BATCH_WAIT_MS", 10) / 1000,
+    }
+
+
+def _sse_writer():
+    return {
+        "window": _number("SSE_COALESCE_MS", 0) / 1000,
+        "max_bytes": _integer("SSE_COALESCE_BYTES", 4096, 1),
+        # the codecs of utils/sseWriter.py
+        "codec": _choice("SSE_JSON_CODEC", "json", ("json", "orjson", "ujson")),
+    }
+
+
+def _image_preprocessor():
+    host_workers = _integer("IMAGE_PREPROCESSING_WORKERS", min(4, os.cpu_count() or 1), 1)
+    return {
+        "enabled": _flag("IMAGE_PREPROCESSING", True),
+        # serve.py sets SERVER_WORKERS to the number of app processes it runs
+        "workers": max(1, host_workers // _integer("SERVER_WORKERS", 1, 1)),
+    }
+
+
+def _metrics():
+    return {"enabled": _flag("METRICS", True)}
+
+
+# name: function that reads the settings of the section
+SECTIONS = {
+    "server": _server,
+    "providers": _providers,
+    "http_client": _http_client,
+    "resilience": _resilience,
+    "response_cache": _response_cache,
+    "single_flight": _single_flight,
+    "conversation_store": _conversation_store,
+    "upload": _upload,
+    "file_pool": _file_pool,
+    "artifact_store": _artifact_store,
+    "stream_pacer": _stream_pacer,
+    "micro_batcher": _micro_batcher,
+    "sse_writer": _sse_writer,
+    "image_preprocessor": _image_preprocessor,
+    "metrics": _metrics,
+}
+
+
+class Config:
+    def __init__(self):
+        self._sections = None
+        self._lock = threading.Lock()
+
+    # reads the named sections without keeping them (e.g. serve.py reads the server section without importing the
+    # provider registry) - all of the invalid settings are reported together
+    @staticmethod
+    def read(*names):
+        sections = {}
+        errors = []
+        for name in names:
+            try:
+                sections[name] = SECTIONS[name]()
+            except ValueError as error:
+                errors.append(str(error))
+        if errors:
+            raise ValueError("Invalid settings in the environment or the .env file:\n" + "\n".join(errors))
+        return sections
+
+    # reads every section
+    def load(self):
+        sections = self.read(*SECTIONS)
+        with self._lock:
+            self._sections = sections
+
+    # the settings are loaded on first use when the app has not loaded them (e.g. when a module is used by a script)
+    def get(self, name):
+        if self._sections is None:
+            self.load()
+        return self._sections[name]
+
+
+config = Config()
@@ -0,0 +1,156 @@
+from collections import deque
+from utils.config import config
+import threading
+import hashlib
+import json
+import time
+import os
+
+# Server-side conversation store - instead of sending (and transforming) the full message history on every turn,
+# clients send a "conversationId" property with only their newest message and the server keeps the provider-formatted
+# history of the conversation. The id can be added to the requests via the Deep Chat connect additionalBodyProps:
+# https://deepchat.dev/docs/connect#connect-1
+# Requests without a conversationId still use the full "messages" list, exactly as before.
+
+# Settings can be configured in the .env file (see .env.example):
+# CONVERSATION_STORE - "memory" or "file" (the store is disabled when not set)
+# CONVERSATION_STORE_DIR - directory used by the file store
+# CONVERSATION_TOKEN_BUDGET - approximate number of history tokens that are sent upstream (oldest messages are dropped)
+# CONVERSATION_IDLE_TTL - number of seconds after which an idle conversation is evicted
+
+
+# rough estimate that avoids loading a tokenizer - about 4 characters per token for English text
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+class _Session:
+    def __init__(self, entries=()):
+        self.entries = deque()
+        self.tokens = 0
+        self.last_access = time.time()
+        for formatted, tokens in entries:
+            self.entries.append((formatted, tokens))
+            self.tokens += tokens
+
+    # only the new message is formatted - the rest of the history is kept in the provider format
+    def append(self, formatted, tokens, token_budget):
+        self.entries.append((formatted, tokens))
+        self.tokens += tokens
+        # the newest message is always kept even when it alone exceeds the budget
+        while self.tokens > token_budget and len(self.entries) > 1:
+            _, removed_tokens = self.entries.popleft()
+            self.tokens -= removed_tokens
+
+
+class MemoryBackend:
+    def __init__(self):
+        self._sessions = {}
+
+    def load(self, key):
+        return self._sessions.get(key)
+
+    def save(self, key, session):
+        self._sessions[key] = session
+
+    def evict_idle(self, idle_ttl):
+        threshold = time.time() - idle_ttl
+        for key in [key for key, session in self._sessions.items() if session.last_access < threshold]:
+            del self._sessions[key]
+
+
+class FileBackend:
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def load(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return _Session(entries)
+
+    def save(self, key, session):
+        path = self._path(key)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(list(session.entries), file)
+        os.replace(temporary_path, path)
+
+    # the modification time of a file is the last time its conversation was used
+    def evict_idle(self, idle_ttl):
+        threshold = time.time() - idle_ttl
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and entry.stat().st_mtime < threshold:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+
+class ConversationStore:
+    def __init__(self):
+        self._backend = None
+        self._lock = threading.Lock()
+        self._last_eviction = time.time()
+
+    # the backend is created on first use (under the lock) once the settings have been loaded
+    def backend(self):
+        if self._backend is None:
+            settings = config.get("conversation_store")
+            if settings["backend"] == "memory":
+                self._backend = MemoryBackend()
+            else:
+                self._backend = FileBackend(settings["dir"])
+        return self._backend
+
+    def _key(self, provider, body):
+        if config.get("conversation_store")["backend"] and isinstance(body, dict) and body.get("conversationId"):
+            return f"{provider}:{body['conversationId']}"
+        return None
+
+    def _evict_idle(self):
+        idle_ttl = config.get("conversation_store")["idle_ttl"]
+        now = time.time()
+        # idle conversations are looked for at most once a minute
+        if now - self._last_eviction > min(idle_ttl, 60):
+            self._last_eviction = now
+            self.backend().evict_idle(idle_ttl)
+
+    # Returns the provider-formatted messages that should be sent upstream. When the request has a conversationId, its
+    # new messages are appended to a copy of the stored history (limited by the token budget) - nothing is saved until
+    # the provider has responded (see record), hence a failed or abandoned turn does not leave a message without reply.
+    def window(self, provider, body, format_message):
+        key = self._key(provider, body)
+        if key is None:
+            return [format_message(message) for message in body["messages"]]
+        token_budget = config.get("conversation_store")["token_budget"]
+        with self._lock:
+            self._evict_idle()
+            stored = self.backend().load(key)
+            session = _Session(stored.entries if stored else ())
+        for message in body["messages"]:
+            session.append(format_message(message), estimate_tokens(message["text"] or ""), token_budget)
+        return [formatted for formatted, _ in session.entries]
+
+    # adds the new messages of the request together with the response of the provider to the stored conversation
+    def record(self, provider, body, format_message, text):
+        key = self._key(provider, body)
+        if key is None:
+            return
+        token_budget = config.get("conversation_store")["token_budget"]
+        with self._lock:
+            session = self.backend().load(key) or _Session()
+            for message in body["messages"]:
+                session.append(format_message(message), estimate_tokens(message["text"] or ""), token_budget)
+            session.append(format_message({"role": "ai", "text": text}), estimate_tokens(text or ""), token_budget)
+            session.last_access = time.time()
+            self.backend().save(key, session)
+
+conversation_store = ConversationStore()
@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.config import config
+import threading
+import asyncio
+
+# Concurrent processing of every uploaded file of a request. The files are sent upstream on a worker pool that is
+# shared by all requests (the global cap), while a single request only has a limited number of files in flight at a
+# time (the per-request cap) - hence a request with many files queues behind its own files instead of taking over the
+# pool and the files of other requests are interleaved with them. A request with a single file is processed inline.
+
+# Settings can be configured in the .env file (see .env.example):
+# FILES_CONCURRENCY_PER_REQUEST - maximum number of files of a single request that are processed at the same time
+# FILES_CONCURRENCY_GLOBAL - maximum number of files that are processed at the same time across all requests
+
+
+class FilePool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._semaphore = None
+
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(config.get("file_pool")["global"], thread_name_prefix="files")
+        return self._executor
+
+    # returns the results of function(file) in the order of the files, the first error is raised
+    def map(self, function, files):
+        if len(files) <= 1:
+            return [function(file) for file in files]
+        executor = self.executor()
+        per_request = config.get("file_pool")["per_request"]
+        results = [None] * len(files)
+        pending = {}
+        index = 0
+        try:
+            while index < len(files) or pending:
+                while index < len(files) and len(pending) < per_request:
+                    pending[executor.submit(function, files[index])] = index
+                    index += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+        except Exception:
+            # the files that have not started yet are not sent
+            for future in pending:
+                future.cancel()
+            raise
+        return results
+
+    # async counterpart of map - function is a coroutine function
+    async def map_async(self, function, files):
+        if len(files) <= 1:
+            return [await function(file) for file in files]
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(config.get("file_pool")["global"])
+        global_limit = self._semaphore
+        request_limit = asyncio.Semaphore(config.get("file_pool")["per_request"])
+
+        # the global slot is only taken once the request has a free slot of its own
+        async def run(file):
+            async with request_limit:
+                async with global_limit:
+                    return await function(file)
+        tasks = [asyncio.ensure_future(run(file)) for file in files]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+
+# Combines the Deep Chat responses of the files into a single response:
+# https://deepchat.dev/docs/connect/#Response
+# texts are prefixed with the name of their file when there is more than one file
+def combine_results(results, files):
+    if not results:
+        raise Exception("No files were uploaded")
+    if len(results) == 1:
+        return results[0]
+    combined = {}
+    texts = [f"{file.filename}: {result['text']}" for result, file in zip(results, files) if "text" in result]
+    if texts:
+        combined["text"] = "\n".join(texts)
+    result_files = [result_file for result in results for result_file in result.get("files", [])]
+    if result_files:
+        combined["files"] = result_files
+    return combined
+
+
+file_pool = FilePool()
@@ -0,0 +1,162 @@
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+from requests.adapters import HTTPAdapter
+from utils.resilience import resilience, body_rewinder, RETRY_STATUSES, IDEMPOTENT_RETRY_STATUSES
+from utils.metrics import metrics, provider
+from urllib.parse import urlsplit
+from utils.config import config
+import threading
+import requests
+import time
+
+# Shared upstream client used by all of the services. Instead of calling requests.post (which opens a new connection
+# for every call and pays for a DNS lookup, TCP connect and TLS handshake each time), every provider host gets its own
+# keep-alive connection pool that is reused across chat turns.
+
+# Pool settings can be configured in the .env file (see .env.example):
+# UPSTREAM_POOL_SIZE - maximum number of kept-alive connections per provider host
+# UPSTREAM_POOL_BLOCK - when "true", requests wait for a free connection instead of opening an extra one
+# UPSTREAM_CONNECT_TIMEOUT/UPSTREAM_READ_TIMEOUT - timeouts in seconds that are applied to every upstream call
+# UPSTREAM_URL_OVERRIDES - comma separated prefix=replacement pairs that redirect provider URLs, e.g. to the local stub
+#   servers of the benchmarks: https://api.openai.com=http://127.0.0.1:9100
+
+
+class _PoolStatsMixin:
+    # counts how many times a request found every connection of the pool in use - if UPSTREAM_POOL_BLOCK is true the
+    # request waited for a connection to be released, otherwise a temporary connection was opened and then discarded
+    waits = 0
+
+    def _get_conn(self, timeout=None):
+        if self.pool is not None and self.pool.empty():
+            self.waits += 1
+        return super()._get_conn(timeout)
+
+
+class _HTTPPool(_PoolStatsMixin, HTTPConnectionPool):
+    pass
+
+
+class _HTTPSPool(_PoolStatsMixin, HTTPSConnectionPool):
+    pass
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPPool, "https": _HTTPSPool}
+
+
+class HTTPClient:
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, url):
+        for prefix, replacement in config.get("http_client")["overrides"]:
+            if url.startswith(prefix):
+                return replacement + url[len(prefix):]
+        return url
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    settings = config.get("http_client")
+                    session = requests.Session()
+                    adapter = _PooledAdapter(pool_connections=1, pool_maxsize=settings["pool_size"],
+                                             pool_block=settings["pool_block"])
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._sessions[host] = session
+        return session
+
+    # retryable failures are retried with backoff and the outcome of the call is reported to the circuit breaker of
+    # the provider (see utils/resilience.py) - idempotent calls (e.g. of the deterministic routes) are also retried
+    # when the provider may have processed them
+    def request(self, method, url, idempotent=False, **kwargs):
+        provider_url = url
+        name = provider(url)
+        url = self.resolve(url)
+        kwargs.setdefault("timeout", config.get("http_client")["timeout"])
+        idempotent = idempotent or method == "GET"
+        statuses = IDEMPOTENT_RETRY_STATUSES if idempotent else RETRY_STATUSES
+        rewind = body_rewinder(kwargs.get("data"))
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session(url).request(method, url, **kwargs)
+            except requests.RequestException as error:
+                metrics.upstream_error(provider_url, error)
+                # a read timeout is never retried as the provider may still be processing the call
+                retryable = rewind and (_connect_failed(error) or (
+                    idempotent and isinstance(error, requests.ConnectionError)))
+                delay = resilience.retry_delay(name, attempt) if retryable else None
+                if delay is None:
+                    resilience.record(name, False)
+                    raise
+            else:
+                # the body of a streamed response is counted by metrics.upstream_stream while it is being read
+                metrics.upstream(provider_url, response.status_code, time.perf_counter() - start,
+                                 int(response.request.headers.get("Content-Length") or 0),
+                                 0 if kwargs.get("stream") else len(response.content))
+                delay = None
+                if response.status_code in statuses and rewind:
+                    delay = resilience.retry_delay(name, attempt, response.headers.get("Retry-After"))
+                if delay is None:
+                    resilience.record(name, response.status_code < 500 and response.status_code != 429)
+                    return response
+                # the error body of a streamed response is read so that its connection is returned to the pool
+                response.content
+                response.close()
+            time.sleep(delay)
+            rewind()
+            attempt += 1
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    # reuse_ratio is the share of upstream requests that were sent over an already open connection
+    def stats(self):
+        hosts = {}
+        for host, session in list(self._sessions.items()):
+            adapter = session.get_adapter("https://" + host)
+            requests_sent = connections_opened = waits = idle_sockets = in_use = 0
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+                waits += pool.waits
+                idle = list(pool.pool.queue)
+                idle_sockets += sum(1 for conn in idle if conn is not None and conn.sock is not None)
+                in_use += pool.pool.maxsize - len(idle)
+            hosts[host] = {
+                "requests": requests_sent,
+                "connections_opened": connections_opened,
+                "reuse_ratio": round(1 - connections_opened / requests_sent, 4) if requests_sent else 0,
+                "waits": waits,
+                "open_sockets": idle_sockets + in_use,
+                "idle_sockets": idle_sockets,
+                "in_use": in_use,
+            }
+        return {"pool_size": config.get("http_client")["pool_size"], "hosts": hosts}
+
+
+# the call did not reach the provider - the DNS lookup failed or the connection could not be opened in time
+def _connect_failed(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if isinstance(error, requests.ConnectionError) and error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+# a single instance is shared by every service so that the pools are reused across routes
+http_client = HTTPClient()
@@ -0,0 +1,333 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor
+from werkzeug.exceptions import UnsupportedMediaType
+from werkzeug.datastructures import FileStorage
+from utils.uploadStream import hold_memory, read_into_memory
+from utils.metrics import metrics
+from utils.config import config
+from io import BytesIO
+import multiprocessing
+import threading
+import asyncio
+import struct
+import types
+import time
+import sys
+import os
+
+# Normalization of the images that are uploaded to the image routes before they are forwarded upstream. The format and
+# dimensions of every image are read from its header bytes - files that are not images are rejected straight away and
+# images that the provider already accepts are forwarded untouched. Other images (e.g. a large photo sent to the OpenAI
+# variations API that expects square PNGs) are downsized, cropped and/or transcoded to the format and dimensions of the
+# provider (see PROFILES) instead of being uploaded in full and rejected after a long round trip.
+# Decoding and encoding images is CPU bound, hence it runs on a bounded process pool instead of the threads of the app
+# (daemonic app processes use a thread pool instead). The resizing uses Pillow (pip install pillow) - when it is not
+# installed the images are only validated. Bytes saved and the preprocessing time are available at /image-stats and
+# /metrics.
+
+# Settings can be configured in the .env file (see .env.example):
+# IMAGE_PREPROCESSING - set to false to forward the uploaded images as they are
+# IMAGE_PREPROCESSING_WORKERS - processes per host (default: number of CPU cores up to 4) - they are split between the
+#   app processes of serve.py (SERVER_WORKERS) and every app process has at least one
+
+# route: accepted formats (the first one is used for transcoding), maximum side length/pixels, whether the image needs
+# to be square, a multiple that both sides need to be rounded down to and the maximum file size
+PROFILES = {
+    # https://platform.openai.com/docs/api-reference/images/createVariation
+    "openai-image": {"formats": ("png",), "max_side": 1024, "square": True, "max_bytes": 4 * 1024 * 1024},
+    # https://platform.stability.ai/docs/api-reference#tag/v1generation/operation/imageToImage
+    "stability-image-to-image": {"formats": ("png", "jpeg"), "max_side": 1536, "multiple_of": 64},
+    # https://platform.stability.ai/docs/api-reference#tag/v1generation/operation/upscaleImage
+    "stability-image-upscale": {"formats": ("png", "jpeg", "webp"), "max_pixels": 1024 * 1024},
+}
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp", "gif": "image/gif"}
+
+# bytes that are read to find the dimensions (the size of a JPEG is stored after its EXIF data)
+HEADER_SIZE = 64 * 1024
+
+
+# returns (format, width, height) of the image (the dimensions are None when they are not in the header) or None
+def sniff(header):
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and len(header) >= 24:
+        width, height = struct.unpack(">II", header[16:24])
+        return "png", width, height
+    if header[:6] in (b"GIF87a", b"GIF89a") and len(header) >= 10:
+        width, height = struct.unpack("<HH", header[6:10])
+        return "gif", width, height
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP" and len(header) >= 30:
+        chunk = header[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", header[26:30])
+            return "webp", width & 0x3fff, height & 0x3fff
+        if chunk == b"VP8L":
+            bits = int.from_bytes(header[21:25], "little")
+            return "webp", (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b"VP8X":
+            return "webp", int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+        return "webp", None, None
+    if header[:3] == b"\xff\xd8\xff":
+        return ("jpeg",) + _jpeg_size(header)
+    return None
+
+
+# the size is stored in the first start of frame segment
+def _jpeg_size(header):
+    index = 2
+    while index + 9 <= len(header):
+        if header[index] != 0xFF:
+            break
+        marker = header[index + 1]
+        if marker == 0xFF:
+            index += 1
+            continue
+        if 0xD0 <= marker <= 0xD8 or marker == 0x01:
+            index += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", header[index + 5:index + 9])
+            return width, height
+        index += 2 + int.from_bytes(header[index + 2:index + 4], "big")
+    return None, None
+
+
+def _fits(profile, image_format, width, height, size):
+    if image_format not in profile["formats"] or width is None:
+        return False
+    if size > profile.get("max_bytes", size) or max(width, height) > profile.get("max_side", max(width, height)):
+        return False
+    if width * height > profile.get("max_pixels", width * height):
+        return False
+    if profile.get("square") and width != height:
+        return False
+    # images that are smaller than the multiple are not upscaled, hence they are forwarded as they are
+    multiple = profile.get("multiple_of")
+    return not multiple or all(side < multiple or side % multiple == 0 for side in (width, height))
+
+
+# Runs in the processes of the pool - returns the encoded image, its format and dimensions
+def normalize(data, profile):
+    from PIL import Image, ImageOps
+    image = Image.open(BytesIO(data))
+    source_format = (image.format or "").lower()
+    # photos are often stored rotated with an EXIF orientation that the providers do not apply
+    image = ImageOps.exif_transpose(image)
+    if profile.get("square") and image.width != image.height:
+        side = min(image.size)
+        left, top = (image.width - side) // 2, (image.height - side) // 2
+        image = image.crop((left, top, left + side, top + side))
+    max_side = profile.get("max_side")
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    max_pixels = profile.get("max_pixels")
+    if max_pixels and image.width * image.height > max_pixels:
+        scale = (max_pixels / (image.width * image.height)) ** 0.5
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+    multiple = profile.get("multiple_of")
+    if multiple and (image.width >= multiple or image.height >= multiple):
+        width = image.width - image.width % multiple if image.width >= multiple else image.width
+        height = image.height - image.height % multiple if image.height >= multiple else image.height
+        left, top = (image.width - width) // 2, (image.height - height) // 2
+        image = image.crop((left, top, left + width, top + height))
+    image_format = source_format if source_format in profile["formats"] else profile["formats"][0]
+    output = BytesIO()
+    if image_format == "jpeg":
+        image.convert("RGB").save(output, "JPEG", quality=90)
+    elif image_format == "webp":
+        image.save(output, "WEBP", quality=90)
+    else:
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+        image.save(output, "PNG")
+    return output.getvalue(), image_format, image.width, image.height
+
+
+# Runs in the processes of the pool - they exit once the app process is gone (e.g. it was killed) instead of being left
+# behind waiting for images
+def _watch_parent(parent):
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+# Spawned processes import the main module of the parent, hence with python app.py every process of the pool would set
+# up the whole app again. The processes are started by submit, therefore all of them are started up front while a
+# module without code stands in for the main module.
+def _start_process_pool(workers):
+    executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_watch_parent, initargs=(os.getpid(),))
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        for _ in range(workers):
+            executor.submit(os.getpid)
+    finally:
+        sys.modules["__main__"] = main
+    return executor
+
+
+class ImagePreprocessor:
+    def __init__(self):
+        self._pillow = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pool = None
+        self._slots = None
+        self._async_slots = None
+        self._stats = {"images": 0, "forwarded_untouched": 0, "normalized": 0, "rejected": 0, "unprocessed": 0,
+                       "failed": 0, "pool_restarts": 0, "bytes_in": 0, "bytes_out": 0, "processing_seconds": 0.0}
+
+    # whether Pillow is installed - checked on first use
+    def pillow(self):
+        if self._pillow is None:
+            try:
+                import PIL  # noqa: F401
+                self._pillow = True
+            except ImportError:
+                print("Pillow is not installed, uploaded images are only validated (pip install pillow)")
+                self._pillow = False
+        return self._pillow
+
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    workers = config.get("image_preprocessor")["workers"]
+                    if self._slots is None:
+                        # the images that wait for the pool are held in memory, hence only a few are queued per process
+                        self._slots = threading.BoundedSemaphore(workers * 2)
+                    if multiprocessing.current_process().daemon:
+                        # e.g. the workers of the hypercorn command are not allowed to start processes - Pillow
+                        # releases the GIL while it decodes, resizes and encodes, hence threads still run in parallel
+                        print("Images are preprocessed on threads as daemonic processes cannot start a process pool "
+                              "(run python serve.py --mode async to use processes)")
+                        self._pool = "thread"
+                        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="images")
+                    else:
+                        # spawned processes do not inherit the threads and locks of the app (unlike forked ones)
+                        self._pool = "process"
+                        self._executor = _start_process_pool(workers)
+        return self._executor
+
+    # returns the future of the normalized image - a pool that broke before the image was submitted is replaced
+    def _submit(self, data, profile):
+        executor = self.executor()
+        try:
+            return executor, executor.submit(normalize, data, profile)
+        except BrokenExecutor:
+            self._replace(executor)
+            executor = self.executor()
+            return executor, executor.submit(normalize, data, profile)
+
+    # A process of the pool died (e.g. it ran out of memory on a huge image) - the pool cannot be used anymore, hence
+    # the following images are processed by a new one. The images that were in the pool fail.
+    def _replace(self, executor):
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._stats["pool_restarts"] += 1
+        print("The image preprocessing pool broke, starting a new one")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _broken(self, executor, file):
+        self._replace(executor)
+        self._record("failed", 0, 0, 0)
+        return Exception(f"{file.filename} could not be processed")
+
+    # returns the file that should be forwarded for the route - the uploaded file or a normalized copy of it
+    def prepare(self, route, file):
+        check = self._check(route, file)
+        if check is None:
+            return file
+        data, profile = check
+        self.executor()
+        start = time.perf_counter()
+        with self._slots:
+            executor, future = self._submit(data, profile)
+            try:
+                result = future.result()
+            except BrokenExecutor:
+                raise self._broken(executor, file)
+        return self._normalized(route, file, len(data), result, time.perf_counter() - start)
+
+    # async counterpart of prepare - the event loop is not blocked while the image is processed
+    async def prepare_async(self, route, file):
+        check = self._check(route, file)
+        if check is None:
+            return file
+        data, profile = check
+        self.executor()
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(config.get("image_preprocessor")["workers"] * 2)
+        start = time.perf_counter()
+        async with self._async_slots:
+            executor, future = self._submit(data, profile)
+            try:
+                result = await asyncio.wrap_future(future)
+            except BrokenExecutor:
+                raise self._broken(executor, file)
+        return self._normalized(route, file, len(data), result, time.perf_counter() - start)
+
+    # validates the file from its header - returns None when it can be forwarded as it is, otherwise its content
+    def _check(self, route, file):
+        if not config.get("image_preprocessor")["enabled"]:
+            return None
+        stream = file.stream
+        position = stream.tell()
+        header = stream.read(HEADER_SIZE)
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell() - position
+        stream.seek(position)
+        sniffed = sniff(header)
+        if sniffed is None:
+            self._record("rejected", size, size, 0)
+            # a client error (415) instead of a failure of the route
+            raise UnsupportedMediaType(f"{file.filename} is not a supported image (PNG, JPEG, WEBP or GIF)")
+        profile = PROFILES[route]
+        if _fits(profile, *sniffed, size):
+            self._record("forwarded_untouched", size, size, 0)
+            return None
+        if not self.pillow():
+            # the provider decides whether it accepts the image
+            self._record("unprocessed", size, size, 0)
+            return None
+        # unlike the files that are streamed upstream - the image is decoded from memory (see utils/uploadStream.py)
+        data = read_into_memory(stream)
+        stream.seek(position)
+        return data, profile
+
+    def _normalized(self, route, file, size, result, seconds):
+        data, image_format, width, height = result
+        hold_memory(file.stream, len(data))
+        self._record("normalized", size, len(data), seconds)
+        metrics.observe("deepchat_image_preprocess_seconds", (("route", route),), seconds)
+        name = os.path.splitext(file.filename or "image")[0] + "." + ("jpg" if image_format == "jpeg" else image_format)
+        return FileStorage(BytesIO(data), filename=name, content_type=MIME_TYPES[image_format])
+
+    def _record(self, outcome, bytes_in, bytes_out, seconds):
+        with self._lock:
+            stats = self._stats
+            stats["images"] += 1
+            stats[outcome] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["processing_seconds"] += seconds
+        metrics.inc("deepchat_image_preprocess_total", (("outcome", outcome),))
+        if bytes_in != bytes_out:
+            metrics.inc("deepchat_image_bytes_saved_total", (), bytes_in - bytes_out)
+
+    # bytes_saved can be negative when images are transcoded to a larger format (e.g. a JPEG photo into a PNG)
+    def stats(self):
+        settings = config.get("image_preprocessor")
+        with self._lock:
+            stats = dict(self._stats)
+        normalized = stats["normalized"]
+        return dict(stats, bytes_saved=stats["bytes_in"] - stats["bytes_out"],
+                    processing_seconds=round(stats["processing_seconds"], 3),
+                    average_processing_ms=round(stats["processing_seconds"] / normalized * 1000, 2) if normalized else 0,
+                    enabled=settings["enabled"], pillow=self.pillow(), workers=settings["workers"], pool=self._pool)
+
+
+image_preprocessor = ImagePreprocessor()
@@ -0,0 +1,46 @@
+import json
+
+# Incremental parser of newline delimited JSON streams (e.g. the streamed responses of Cohere:
+# https://docs.cohere.com/docs/streaming). As with the SSE parser (see utils/sse.py) upstream chunks do not line up
+# with the lines - the unfinished line is kept as bytes and only complete lines are decoded, hence no objects are lost
+# regardless of how the upstream response is chunked.
+
+
+class JSONLinesParser:
+    def __init__(self):
+        self._buffer = bytearray()
+
+    # returns the objects that were completed by the chunk
+    def feed(self, chunk):
+        buffer = self._buffer
+        # only the new bytes need to be searched as the buffer never contains a complete line
+        search_from = len(buffer)
+        buffer += chunk
+        end = buffer.rfind(b"\n", search_from)
+        if end == -1:
+            return []
+        lines = buffer[:end].split(b"\n")
+        del buffer[:end + 1]
+        return [json.loads(line) for line in lines if line.strip()]
+
+    # parses the last object if the stream ended without a trailing newline
+    def flush(self):
+        return self.feed(b"\n") if self._buffer else []
+
+
+def iter_json_lines(chunks):
+    parser = JSONLinesParser()
+    for chunk in chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+async def aiter_json_lines(chunks):
+    parser = JSONLinesParser()
+    async for chunk in chunks:
+        if chunk:
+            for value in parser.feed(chunk):
+                yield value
+    for value in parser.flush():
+        yield value
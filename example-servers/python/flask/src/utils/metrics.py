@@ -0,0 +1,267 @@
+from urllib.parse import urlsplit
+from utils.config import config
+from bisect import bisect_left
+import threading
+import time
+
+# In-process latency, status and byte metrics of every route and every upstream provider call, exposed in the
+# Prometheus text format on the /metrics route. Recording a value is a dictionary lookup and a bucket increment under a
+# lock, the text is only built when /metrics is scraped.
+# Route latency minus upstream latency is the time spent parsing the request and serializing the response.
+
+# Settings can be configured in the .env file (see .env.example):
+# METRICS - set to false to stop recording (the /metrics route then returns no samples)
+
+# seconds - upper bounds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# histograms that do not measure seconds
+_BUCKETS = {
+    "deepchat_batch_size": (1, 2, 4, 8, 16, 32, 64),
+}
+
+PROVIDERS = {
+    "api.openai.com": "openai",
+    "api.cohere.ai": "cohere",
+    "api-inference.huggingface.co": "huggingface",
+    "api.stability.ai": "stabilityai",
+}
+
+# name: (type, help)
+_METRICS = {
+    "deepchat_route_requests_total": ("counter", "Requests handled by each route by response status"),
+    "deepchat_route_errors_total": ("counter", "Requests that failed with a 5xx status or an error during the stream"),
+    "deepchat_route_duration_seconds": ("histogram", "Time from the request until the response (or stream) ended"),
+    "deepchat_route_first_byte_seconds": ("histogram", "Time from the request until the first chunk of a stream"),
+    "deepchat_route_request_bytes_total": ("counter", "Request body bytes received by each route"),
+    "deepchat_route_response_bytes_total": ("counter", "Response body bytes sent by each route"),
+    "deepchat_upstream_requests_total": ("counter", "Upstream provider calls by response status"),
+    "deepchat_upstream_errors_total": ("counter", "Upstream calls that failed by HTTP status or exception name"),
+    "deepchat_upstream_duration_seconds": ("histogram", "Upstream call time (until the headers of streamed calls)"),
+    "deepchat_upstream_time_to_first_token_seconds": ("histogram", "Time from an upstream stream call to its first chunk"),
+    "deepchat_upstream_stream_duration_seconds": ("histogram", "Time from an upstream stream call until it ended"),
+    "deepchat_upstream_request_bytes_total": ("counter", "Request body bytes sent to each provider"),
+    "deepchat_upstream_response_bytes_total": ("counter", "Response body bytes received from each provider"),
+    "deepchat_sse_frames_total": ("counter", "SSE frames sent by the streaming routes"),
+    "deepchat_sse_tokens_total": ("counter", "Tokens sent in the SSE frames (a frame can contain several tokens)"),
+    "deepchat_sse_bytes_total": ("counter", "Bytes of the SSE frames sent by the streaming routes"),
+    "deepchat_batch_size": ("histogram", "Number of requests sent upstream in a single micro-batch"),
+    "deepchat_batch_wait_seconds": ("histogram", "Time a request waited for its micro-batch to be sent"),
+    "deepchat_batch_queue_depth": ("gauge", "Requests waiting for a micro-batch or its response"),
+    "deepchat_provider_in_flight": ("gauge", "Requests holding a concurrency slot of the provider"),
+    "deepchat_provider_queue_depth": ("gauge", "Requests waiting for a concurrency slot of the provider"),
+    "deepchat_provider_shed_total": ("counter", "Requests rejected by admission control by reason"),
+    "deepchat_upstream_retries_total": ("counter", "Upstream calls that were retried"),
+    "deepchat_circuit_state": ("gauge", "Circuit breaker state of the provider (0 closed, 1 half open, 2 open)"),
+    "deepchat_circuit_transitions_total": ("counter", "Circuit breaker state changes by the new state"),
+    "deepchat_image_preprocess_total": ("counter", "Uploaded images by preprocessing outcome"),
+    "deepchat_image_preprocess_seconds": ("histogram", "Time an image waited for and was normalized by the pool"),
+    "deepchat_image_bytes_saved_total": ("counter", "Upload bytes saved by normalizing images (negative when grown)"),
+}
+
+
+def provider(url):
+    host = urlsplit(url).netloc
+    return PROVIDERS.get(host, host)
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def enabled(self):
+        return config.get("metrics")["enabled"]
+
+    # labels are a tuple of (name, value) pairs, gauges are stored with the counters
+    # the recording functions check the setting themselves, hence the modules that record metrics do not need to
+    def inc(self, name, labels, amount=1):
+        if not self.enabled():
+            return
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        if not self.enabled():
+            return
+        with self._lock:
+            self._counters[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        if not self.enabled():
+            return
+        key = (name, labels)
+        buckets = _BUCKETS.get(name, BUCKETS)
+        index = bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # a count per bucket, the count of the values above the last bucket and the sum
+                histogram = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    # ------------------ ROUTES ------------------
+
+    def route(self, route, status, seconds, request_bytes, response_bytes):
+        if not self.enabled():
+            return
+        labels = (("route", route),)
+        self.inc("deepchat_route_requests_total", labels + (("status", str(status)),))
+        if status >= 500:
+            self.inc("deepchat_route_errors_total", labels)
+        self.observe("deepchat_route_duration_seconds", labels, seconds)
+        self.inc("deepchat_route_request_bytes_total", labels, request_bytes)
+        self.inc("deepchat_route_response_bytes_total", labels, response_bytes)
+
+    # wraps the chunks of a streamed response - the route is recorded when the stream ends (start is perf_counter())
+    def stream(self, route, status, start, request_bytes, chunks):
+        if not self.enabled():
+            return chunks
+        return self._stream(route, status, start, request_bytes, chunks)
+
+    def _stream(self, route, status, start, request_bytes, chunks):
+        size = 0
+        first = True
+        try:
+            for chunk in chunks:
+                if first:
+                    self.observe("deepchat_route_first_byte_seconds", (("route", route),), time.perf_counter() - start)
+                    first = False
+                size += len(chunk.encode() if isinstance(chunk, str) else chunk)
+                yield chunk
+        except Exception:
+            self.inc("deepchat_route_errors_total", (("route", route),))
+            raise
+        finally:
+            # the original generator is closed when the client disconnects mid-stream
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            self.route(route, status, time.perf_counter() - start, request_bytes, size)
+
+    def astream(self, route, status, start, request_bytes, chunks):
+        if not self.enabled():
+            return chunks
+        return self._astream(route, status, start, request_bytes, chunks)
+
+    async def _astream(self, route, status, start, request_bytes, chunks):
+        size = 0
+        first = True
+        try:
+            async for chunk in chunks:
+                if first:
+                    self.observe("deepchat_route_first_byte_seconds", (("route", route),), time.perf_counter() - start)
+                    first = False
+                size += len(chunk.encode() if isinstance(chunk, str) else chunk)
+                yield chunk
+        except Exception:
+            self.inc("deepchat_route_errors_total", (("route", route),))
+            raise
+        finally:
+            close = getattr(chunks, "aclose", None)
+            if close is not None:
+                await close()
+            self.route(route, status, time.perf_counter() - start, request_bytes, size)
+
+    # ------------------ UPSTREAM ------------------
+
+    def upstream(self, url, status, seconds, request_bytes, response_bytes):
+        if not self.enabled():
+            return
+        labels = (("provider", provider(url)),)
+        self.inc("deepchat_upstream_requests_total", labels + (("status", str(status)),))
+        if status >= 400:
+            self.inc("deepchat_upstream_errors_total", labels + (("reason", str(status)),))
+        self.observe("deepchat_upstream_duration_seconds", labels, seconds)
+        self.inc("deepchat_upstream_request_bytes_total", labels, request_bytes)
+        self.inc("deepchat_upstream_response_bytes_total", labels, response_bytes)
+
+    # connection errors, timeouts etc.
+    def upstream_error(self, url, error):
+        if self.enabled():
+            self.inc("deepchat_upstream_errors_total", (("provider", provider(url)), ("reason", type(error).__name__)))
+
+    # wraps the raw chunks of a streamed upstream response (start is the perf_counter() before the call was sent)
+    def upstream_stream(self, url, start, chunks):
+        if not self.enabled():
+            return chunks
+        return self._upstream_stream(url, start, chunks)
+
+    def _upstream_stream(self, url, start, chunks):
+        labels = (("provider", provider(url)),)
+        size = 0
+        try:
+            for chunk in chunks:
+                if size == 0:
+                    self.observe("deepchat_upstream_time_to_first_token_seconds", labels, time.perf_counter() - start)
+                size += len(chunk)
+                yield chunk
+        except Exception as error:
+            self.upstream_error(url, error)
+            raise
+        finally:
+            self.observe("deepchat_upstream_stream_duration_seconds", labels, time.perf_counter() - start)
+            self.inc("deepchat_upstream_response_bytes_total", labels, size)
+
+    def aupstream_stream(self, url, start, chunks):
+        if not self.enabled():
+            return chunks
+        return self._aupstream_stream(url, start, chunks)
+
+    async def _aupstream_stream(self, url, start, chunks):
+        labels = (("provider", provider(url)),)
+        size = 0
+        try:
+            async for chunk in chunks:
+                if size == 0:
+                    self.observe("deepchat_upstream_time_to_first_token_seconds", labels, time.perf_counter() - start)
+                size += len(chunk)
+                yield chunk
+        except Exception as error:
+            self.upstream_error(url, error)
+            raise
+        finally:
+            self.observe("deepchat_upstream_stream_duration_seconds", labels, time.perf_counter() - start)
+            self.inc("deepchat_upstream_response_bytes_total", labels, size)
+
+    # ------------------ EXPOSITION ------------------
+
+    # Prometheus text format (version 0.0.4)
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), values in histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(_BUCKETS.get(name, BUCKETS) + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {round(values[-1], 6)}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        output = []
+        for name, (metric_type, description) in _METRICS.items():
+            if name in samples:
+                output.append(f"# HELP {name} {description}")
+                output.append(f"# TYPE {name} {metric_type}")
+                output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
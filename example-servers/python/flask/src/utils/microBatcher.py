@@ -0,0 +1,145 @@
+from utils.metrics import metrics
+from utils.config import config
+import threading
+import asyncio
+import time
+
+# Micro-batching of upstream inference calls - concurrent requests for the same model are collected for a short window
+# (or until the batch is full) and sent upstream as a single batched call, then each result is routed back to the
+# request that is waiting for it. The first request of a batch sends it, hence no background thread is needed in the
+# sync mode. In the async mode the batch is sent by a task so that a cancelled request does not strand the others.
+
+# Settings can be configured in the .env file (see .env.example):
+# MICRO_BATCHING - set to true to batch the Hugging Face image classification and speech recognition calls
+# MICRO_BATCH_MAX_SIZE - maximum number of requests in a single batch
+# MICRO_BATCH_WAIT_MS - how long the first request of a batch waits for others to join it
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.submitted = time.perf_counter()
+        self.result = None
+        self.error = None
+
+
+class _Batch:
+    def __init__(self, full):
+        self.items = []
+        self.calls = []
+        self.full = full
+
+
+class MicroBatcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._async_batches = {}
+        self._depth = {}
+        # strong references to the sending tasks (the event loop only keeps weak ones)
+        self._tasks = set()
+
+    def enabled(self):
+        return config.get("micro_batcher")["enabled"]
+
+    def _queue(self, key, change):
+        with self._lock:
+            depth = self._depth[key] = self._depth.get(key, 0) + change
+        metrics.set("deepchat_batch_queue_depth", (("model", key),), depth)
+
+    # send_batch receives the items of a batch and returns their results in the same order
+    def submit(self, key, item, send_batch):
+        call = _Call()
+        batch, leader = self._join(self._batches, key, item, call, threading.Event)
+        self._queue(key, 1)
+        if leader:
+            batch.full.wait(config.get("micro_batcher")["wait"])
+            self._close(self._batches, key, batch)
+            self._send(key, batch, send_batch)
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    # async counterpart of submit - send_batch is a coroutine function
+    async def submit_async(self, key, item, send_batch):
+        call = _Call()
+        call.future = asyncio.get_running_loop().create_future()
+        batch, leader = self._join(self._async_batches, key, item, call, asyncio.Event)
+        self._queue(key, 1)
+        if leader:
+            task = asyncio.ensure_future(self._send_async(key, batch, send_batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await call.future
+
+    def _join(self, batches, key, item, call, event_class):
+        with self._lock:
+            batch = batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = batches[key] = _Batch(event_class())
+            batch.items.append(item)
+            batch.calls.append(call)
+            if len(batch.items) >= config.get("micro_batcher")["max_size"]:
+                # a full batch is closed so that the next request starts a new one
+                del batches[key]
+                batch.full.set()
+        return batch, leader
+
+    # no more requests can join the batch after it is closed
+    def _close(self, batches, key, batch):
+        with self._lock:
+            if batches.get(key) is batch:
+                del batches[key]
+
+    def _record(self, key, batch):
+        sent = time.perf_counter()
+        labels = (("model", key),)
+        metrics.observe("deepchat_batch_size", labels, len(batch.items))
+        for call in batch.calls:
+            metrics.observe("deepchat_batch_wait_seconds", labels, sent - call.submitted)
+
+    @staticmethod
+    def _check(batch, results):
+        if len(results) != len(batch.items):
+            raise Exception(f"Batched call returned {len(results)} results for {len(batch.items)} inputs")
+
+    def _send(self, key, batch, send_batch):
+        self._record(key, batch)
+        try:
+            results = send_batch(batch.items)
+            self._check(batch, results)
+            for call, result in zip(batch.calls, results):
+                call.result = result
+        except Exception as error:
+            for call in batch.calls:
+                call.error = error
+        finally:
+            self._queue(key, -len(batch.items))
+            for call in batch.calls:
+                call.done.set()
+
+    async def _send_async(self, key, batch, send_batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), config.get("micro_batcher")["wait"])
+        except asyncio.TimeoutError:
+            pass
+        self._close(self._async_batches, key, batch)
+        self._record(key, batch)
+        try:
+            results = await send_batch(batch.items)
+            self._check(batch, results)
+            for call, result in zip(batch.calls, results):
+                if not call.future.done():
+                    call.future.set_result(result)
+        except Exception as error:
+            for call in batch.calls:
+                if not call.future.done():
+                    call.future.set_exception(error)
+        finally:
+            self._queue(key, -len(batch.items))
+
+
+micro_batcher = MicroBatcher()
@@ -0,0 +1,92 @@
+from utils.resilience import resilience
+from utils.config import config
+import importlib
+import threading
+import time
+
+# Registry of the provider services. The configuration is read and validated once (see utils/config.py) - a provider is
+# enabled when its API key is set (and it is listed in PROVIDERS if that is set) and the apps only register the routes
+# of enabled providers.
+# The service modules are not imported at startup - a provider is imported and initialized (e.g. its headers are built)
+# on its first request, hence a cold start only pays for the providers that are actually used. The startup time and
+# the import/initialization time of every loaded provider are printed and available at /startup-stats.
+
+# Settings can be configured in the .env file (see .env.example):
+# PROVIDERS - comma separated providers to enable (openai, huggingface, stabilityai, cohere) - every listed provider
+#   needs its API key. By default every provider that has an API key is enabled.
+
+# name: (module, class, API key variable)
+PROVIDERS = {
+    "openai": ("services.openAI", "OpenAI", "OPENAI_API_KEY"),
+    "huggingface": ("services.huggingFace", "HuggingFace", "HUGGING_FACE_API_KEY"),
+    "stabilityai": ("services.stabilityAI", "StabilityAI", "STABILITY_API_KEY"),
+    "cohere": ("services.cohere", "Cohere", "COHERE_API_KEY"),
+}
+
+
+class ProviderRegistry:
+    def __init__(self):
+        # the registry is the first import of the apps, hence this is close to the start of the app setup
+        self._created = time.perf_counter()
+        self._startup_ms = None
+        self._lock = threading.Lock()
+        self._services = {}
+        self._loaded = {}
+
+    def enabled(self, name):
+        return name in config.get("providers")["enabled"]
+
+    # returns the (guarded) service of the provider, the service is imported and initialized on first use
+    def get(self, name):
+        service = self._services.get(name)
+        if service is None:
+            with self._lock:
+                service = self._services.get(name)
+                if service is None:
+                    service = self._load(name)
+        return service
+
+    # returns a stand-in for the service that loads it on the first method call - used by the routes of the apps
+    def lazy(self, name):
+        return LazyService(self, name)
+
+    def _load(self, name):
+        if not self.enabled(name):
+            raise Exception(f"{name} is not enabled")
+        module_name, class_name, _ = PROVIDERS[name]
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        imported = time.perf_counter()
+        # every call of the service goes through the admission control and circuit breaker of the provider
+        service = resilience.guard(name, getattr(module, class_name)())
+        initialized = time.perf_counter()
+        self._loaded[name] = {"import_ms": round((imported - start) * 1000, 2),
+                              "init_ms": round((initialized - imported) * 1000, 2)}
+        print(f"Loaded {name} in {(initialized - start) * 1000:.1f}ms")
+        self._services[name] = service
+        return service
+
+    # called once the app has been set up
+    def report_startup(self):
+        self._startup_ms = round((time.perf_counter() - self._created) * 1000, 2)
+        settings = config.get("providers")
+        disabled = ", ".join(f"{name} ({reason})" for name, reason in settings["disabled"].items())
+        print(f"App set up in {self._startup_ms}ms - enabled providers: {', '.join(settings['enabled']) or 'none'}"
+              + (f", disabled: {disabled}" if disabled else ""))
+
+    def stats(self):
+        settings = config.get("providers")
+        return {"startup_ms": self._startup_ms, "enabled": settings["enabled"], "disabled": settings["disabled"],
+                "loaded": dict(self._loaded)}
+
+
+class LazyService:
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(self._registry.get(self._name), attribute)
+
+
+providers = ProviderRegistry()
@@ -0,0 +1,324 @@
+from utils.metrics import metrics
+from utils.config import config
+import threading
+import functools
+import inspect
+import asyncio
+import random
+import time
+
+# Resilience layer for the provider services:
+# - admission control - every provider has a concurrency limit and a bounded wait queue, requests that do not fit into
+#   the queue are shed straight away with a 429 and requests that waited for too long get a 503
+# - circuit breaker - after a number of consecutive upstream failures the provider is considered down and its requests
+#   fail fast with a 503 until the cool down is over, then a single probe request decides whether it is up again
+# - retries - the shared upstream clients retry calls that did not reach the provider (the connection could not be
+#   opened) or that the provider rejected before processing them (429, 503) with jittered exponential backoff. Calls
+#   that may have been processed (e.g. the connection was closed after the request was sent, 502, 504) could run a paid
+#   generation twice, hence they are only retried when the service marks the call as idempotent (idempotent=True, used
+#   by the deterministic routes). Bodies are rewound before every retry and calls with bodies that cannot be rewound are
+#   not retried. The circuit breaker counts the outcome of the call once, after its retries.
+# The state of every provider is available at /provider-stats and /metrics.
+
+# Settings can be configured in the .env file (see .env.example):
+# PROVIDER_CONCURRENCY - maximum number of requests that call a provider at the same time (0 disables the limit)
+# PROVIDER_QUEUE_SIZE/PROVIDER_QUEUE_TIMEOUT - requests that wait for a free slot and how long (seconds) they wait
+# CIRCUIT_FAILURE_THRESHOLD/CIRCUIT_OPEN_SECONDS - consecutive failures that open the circuit and how long it stays open
+# UPSTREAM_RETRIES/UPSTREAM_RETRY_BACKOFF_MS - number of retries and the base delay of the exponential backoff
+
+# the provider rejected the call before processing it
+RETRY_STATUSES = {429, 503}
+# the call may have been processed - only retried for idempotent calls
+IDEMPOTENT_RETRY_STATUSES = RETRY_STATUSES | {502, 504}
+
+# longest delay between two retries (including a Retry-After sent by the provider)
+MAX_BACKOFF = 10
+
+_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+# converted into a 429/503 response with a Retry-After header by the app
+class ProviderUnavailable(Exception):
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Provider:
+    def __init__(self, name, settings):
+        self.name = name
+        self.limit = settings["concurrency"]
+        self.semaphore = threading.Semaphore(self.limit) if self.limit else None
+        self.async_semaphore = None
+        self.active = 0
+        self.waiting = 0
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.counters = {"shed_queue_full": 0, "shed_queue_timeout": 0, "shed_circuit_open": 0, "retries": 0,
+                         "circuit_opened": 0}
+
+
+class Resilience:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers = {}
+
+    def provider(self, name):
+        provider = self._providers.get(name)
+        if provider is None:
+            with self._lock:
+                provider = self._providers.setdefault(name, _Provider(name, config.get("resilience")))
+        return provider
+
+    # wraps the public methods of a service - see GuardedService
+    def guard(self, name, service):
+        return GuardedService(self, name, service)
+
+    # ------------------ CIRCUIT BREAKER ------------------
+
+    def _set_state(self, provider, state):
+        print(f"Circuit of {provider.name} changed from {provider.state} to {state}")
+        provider.state = state
+        metrics.set("deepchat_circuit_state", (("provider", provider.name),), _STATES[state])
+        metrics.inc("deepchat_circuit_transitions_total", (("provider", provider.name), ("state", state)))
+
+    # returns True when the request is the probe of a half open circuit
+    def _check_circuit(self, provider):
+        with self._lock:
+            if provider.state == "closed":
+                return False
+            remaining = provider.opened_at + config.get("resilience")["open_seconds"] - time.monotonic()
+            if provider.state == "open" and remaining <= 0:
+                self._set_state(provider, "half_open")
+            if provider.state == "half_open" and not provider.probing:
+                provider.probing = True
+                return True
+            provider.counters["shed_circuit_open"] += 1
+        self._shed(provider, "circuit_open")
+        raise ProviderUnavailable(f"{provider.name} is currently unavailable", 503, max(1, round(remaining)))
+
+    def _end_probe(self, provider, probe):
+        # the probe did not reach the provider (e.g. a cache hit), hence the next request probes instead
+        if probe:
+            with self._lock:
+                provider.probing = False
+
+    # called by the upstream clients with the outcome of every call (after its retries)
+    def record(self, name, success):
+        provider = self.provider(name)
+        with self._lock:
+            if success:
+                provider.failures = 0
+                if provider.state == "half_open":
+                    provider.probing = False
+                    self._set_state(provider, "closed")
+                return
+            provider.failures += 1
+            if provider.state == "half_open" or (
+                    provider.state == "closed" and provider.failures >= config.get("resilience")["failure_threshold"]):
+                provider.opened_at = time.monotonic()
+                provider.probing = False
+                provider.counters["circuit_opened"] += 1
+                self._set_state(provider, "open")
+
+    # ------------------ ADMISSION ------------------
+
+    def _shed(self, provider, reason):
+        metrics.inc("deepchat_provider_shed_total", (("provider", provider.name), ("reason", reason)))
+
+    def _queue(self, provider, change):
+        with self._lock:
+            provider.waiting += change
+            waiting = provider.waiting
+        metrics.set("deepchat_provider_queue_depth", (("provider", provider.name),), waiting)
+
+    def _active(self, provider, change):
+        with self._lock:
+            provider.active += change
+            active = provider.active
+        metrics.set("deepchat_provider_in_flight", (("provider", provider.name),), active)
+
+    def _queue_full(self, provider):
+        with self._lock:
+            provider.counters["shed_queue_full"] += 1
+        self._shed(provider, "queue_full")
+        return ProviderUnavailable(f"Too many requests for {provider.name}, please try again later", 429, 1)
+
+    def _queue_timeout(self, provider):
+        with self._lock:
+            provider.counters["shed_queue_timeout"] += 1
+        self._shed(provider, "queue_timeout")
+        return ProviderUnavailable(f"{provider.name} is overloaded, please try again later", 503, 1)
+
+    def acquire(self, name):
+        provider = self.provider(name)
+        probe = self._check_circuit(provider)
+        if provider.semaphore is not None and not provider.semaphore.acquire(blocking=False):
+            if provider.waiting >= config.get("resilience")["queue_size"]:
+                self._end_probe(provider, probe)
+                raise self._queue_full(provider)
+            self._queue(provider, 1)
+            try:
+                acquired = provider.semaphore.acquire(timeout=config.get("resilience")["queue_timeout"])
+            finally:
+                self._queue(provider, -1)
+            if not acquired:
+                self._end_probe(provider, probe)
+                raise self._queue_timeout(provider)
+        self._active(provider, 1)
+        return provider, probe
+
+    def release(self, provider, probe):
+        self._active(provider, -1)
+        if provider.semaphore is not None:
+            provider.semaphore.release()
+        self._end_probe(provider, probe)
+
+    async def acquire_async(self, name):
+        provider = self.provider(name)
+        probe = self._check_circuit(provider)
+        if provider.limit:
+            if provider.async_semaphore is None:
+                provider.async_semaphore = asyncio.Semaphore(provider.limit)
+            semaphore = provider.async_semaphore
+            if semaphore.locked():
+                if provider.waiting >= config.get("resilience")["queue_size"]:
+                    self._end_probe(provider, probe)
+                    raise self._queue_full(provider)
+                self._queue(provider, 1)
+                try:
+                    await asyncio.wait_for(semaphore.acquire(), config.get("resilience")["queue_timeout"])
+                except asyncio.TimeoutError:
+                    self._end_probe(provider, probe)
+                    raise self._queue_timeout(provider)
+                finally:
+                    self._queue(provider, -1)
+            else:
+                await semaphore.acquire()
+        self._active(provider, 1)
+        return provider, probe
+
+    def release_async(self, provider, probe):
+        self._active(provider, -1)
+        if provider.async_semaphore is not None:
+            provider.async_semaphore.release()
+        self._end_probe(provider, probe)
+
+    # calls function while it holds a slot of the provider - used by the methods that guard themselves
+    def call(self, name, function):
+        provider, probe = self.acquire(name)
+        try:
+            return function()
+        finally:
+            self.release(provider, probe)
+
+    async def call_async(self, name, function):
+        provider, probe = await self.acquire_async(name)
+        try:
+            return await function()
+        finally:
+            self.release_async(provider, probe)
+
+    # ------------------ RETRIES ------------------
+
+    # returns the delay before the retry or None when the call should not be retried
+    def retry_delay(self, name, attempt, retry_after=None):
+        settings = config.get("resilience")
+        provider = self.provider(name)
+        if attempt >= settings["retries"] or provider.state == "open":
+            return None
+        with self._lock:
+            provider.counters["retries"] += 1
+        metrics.inc("deepchat_upstream_retries_total", (("provider", name),))
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), MAX_BACKOFF)
+        # full jitter - the retries of requests that failed at the same time are spread out
+        return random.uniform(0, min(MAX_BACKOFF, settings["backoff"] * 2 ** attempt))
+
+    def stats(self):
+        settings = config.get("resilience")
+        providers = {}
+        with self._lock:
+            for name, provider in self._providers.items():
+                providers[name] = dict(provider.counters, state=provider.state, in_flight=provider.active,
+                                       queue_depth=provider.waiting, consecutive_failures=provider.failures)
+        return {"concurrency": settings["concurrency"], "queue_size": settings["queue_size"], "providers": providers}
+
+
+# Returns a function that sends the request body again from the position it had before the first attempt or None when
+# the body cannot be rewound (e.g. a generator)
+def body_rewinder(body):
+    if body is None or isinstance(body, (bytes, str, dict, list, tuple)):
+        return lambda: None
+    if hasattr(body, "rewind"):
+        return body.rewind
+    if hasattr(body, "seek") and hasattr(body, "tell"):
+        position = body.tell()
+        return lambda: body.seek(position)
+    return None
+
+
+# Marks a method of a service that only calls the provider on a response cache miss - the method is not wrapped by
+# GuardedService and guards the upstream call itself (resilience.call), hence a cache hit neither waits for a slot nor
+# fails while the circuit is open
+def guards_itself(method):
+    method.guards_itself = True
+    return method
+
+
+# Proxy of a provider service - every method call holds a slot of the provider until it returns (or until the stream
+# it returned ends). Methods that the service calls on itself are not wrapped.
+class GuardedService:
+    def __init__(self, resilience, name, service):
+        self._resilience = resilience
+        self._name = name
+        self._service = service
+
+    def __getattr__(self, attribute):
+        method = getattr(self._service, attribute)
+        if not callable(method) or getattr(method, "guards_itself", False):
+            return method
+        resilience, name = self._resilience, self._name
+        if inspect.isasyncgenfunction(method):
+            @functools.wraps(method)
+            async def guarded_stream(*args, **kwargs):
+                provider, probe = await resilience.acquire_async(name)
+                try:
+                    async for chunk in method(*args, **kwargs):
+                        yield chunk
+                finally:
+                    resilience.release_async(provider, probe)
+            return guarded_stream
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def guarded_async(*args, **kwargs):
+                return await resilience.call_async(name, lambda: method(*args, **kwargs))
+            return guarded_async
+
+        @functools.wraps(method)
+        def guarded(*args, **kwargs):
+            provider, probe = resilience.acquire(name)
+            try:
+                result = method(*args, **kwargs)
+            except BaseException:
+                resilience.release(provider, probe)
+                raise
+            if inspect.isgenerator(result):
+                # the slot is held until the stream has been sent
+                return _release_after(result, lambda: resilience.release(provider, probe))
+            resilience.release(provider, probe)
+            return result
+        return guarded
+
+
+def _release_after(chunks, release):
+    try:
+        yield from chunks
+    finally:
+        release()
+
+
+resilience = Resilience()
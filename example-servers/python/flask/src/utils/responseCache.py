@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from utils.config import config
+import threading
+import hashlib
+import json
+import time
+import os
+
+# Cache for the responses of deterministic routes (the same input always produces the same output) - e.g. image
+# classification, speech recognition, summarization and upscaling. Entries are keyed by a hash of the route, model and
+# payload bytes and kept in a memory-bounded LRU with a TTL, with an optional on-disk tier that survives restarts.
+
+# Settings can be configured in the .env file (see .env.example):
+# RESPONSE_CACHE_ROUTES - comma separated routes that opt in to caching, e.g. huggingface-image,cohere-summarize
+# RESPONSE_CACHE_MAX_MB - memory limit of the in-memory tier
+# RESPONSE_CACHE_TTL - number of seconds an entry stays valid
+# RESPONSE_CACHE_DIR - directory of the on-disk tier (disabled when not set)
+
+
+class ResponseCache:
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    def enabled(self, route):
+        return route in config.get("response_cache")["routes"]
+
+    @staticmethod
+    def key(route, model, payload):
+        digest = hashlib.sha256()
+        for part in (route.encode(), model.encode(), payload):
+            # the length prefix prevents different parts from producing the same concatenation
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value, size = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self._size -= size
+        value = self._read_from_disk(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._put_in_memory(key, value)
+        return value
+
+    def put(self, key, value):
+        self._put_in_memory(key, value)
+        self._write_to_disk(key, value)
+
+    def _put_in_memory(self, key, value):
+        settings = config.get("response_cache")
+        size = len(json.dumps(value))
+        if size > settings["max_bytes"]:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[2]
+            self._entries[key] = (time.monotonic() + settings["ttl"], value, size)
+            self._size += size
+            while self._size > settings["max_bytes"]:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(config.get("response_cache")["dir"], key[:2], key + ".json")
+
+    def _read_from_disk(self, key):
+        if not config.get("response_cache")["dir"]:
+            return None
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > config.get("response_cache")["ttl"]:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_to_disk(self, key, value):
+        if not config.get("response_cache")["dir"]:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first so that concurrent readers never see a partially written entry
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(value, file)
+        os.replace(temporary_path, path)
+
+    # returns the cached response or calls compute and caches its result (errors are raised and never cached)
+    # payload can be a function that returns the bytes (e.g. the digest of an uploaded file), it is only called when
+    # the route is cached
+    def cached(self, route, model, payload, compute):
+        if not self.enabled(route):
+            return compute()
+        key = self.key(route, model, payload() if callable(payload) else payload)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    async def cached_async(self, route, model, payload, compute):
+        if not self.enabled(route):
+            return await compute()
+        key = self.key(route, model, payload() if callable(payload) else payload)
+        value = self.get(key)
+        if value is None:
+            value = await compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "routes": sorted(config.get("response_cache")["routes"]),
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+response_cache = ResponseCache()
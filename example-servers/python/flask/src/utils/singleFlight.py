@@ -0,0 +1,289 @@
+from utils.config import config
+import threading
+import hashlib
+import asyncio
+
+# Request coalescing (single-flight) - when identical requests arrive while the first one is still waiting for its
+# upstream response, they do not send their own upstream calls but wait for the first call and share its result.
+# Streams are produced into a shared buffer by the request thread of the first request while it sends them - requests
+# that join an ongoing stream receive the chunks that were already produced and then the live ones. When the first
+# client disconnects while joined requests are still reading, the rest of the stream is produced by a thread instead
+# (and it is stopped once no request reads it anymore). The async app produces a stream in a task that is cancelled when
+# its last reader disconnects, and runs a call in a task that is not cancelled with the request that started it.
+# Set SINGLE_FLIGHT=false in the .env file to disable it (see .env.example).
+
+
+def request_key(path, data=b"", files=(), form=()):
+    digest = hashlib.sha256(path.encode())
+    digest.update(data)
+    for key, value in sorted(form):
+        digest.update(f"\n{key}={value}".encode())
+    # files are hashed by their content so that the key does not depend on the multipart boundary of the request
+    for file in files:
+        digest.update(b"\nfile:")
+        for block in iter(lambda: file.stream.read(65536), b""):
+            digest.update(block)
+        file.stream.seek(0)
+    return digest.hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Broadcast:
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+        # requests that joined the stream and are still reading it (guarded by the lock of SingleFlight)
+        self.readers = 0
+
+    def follow(self):
+        self.readers += 1
+
+    def publish(self, chunk):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+    def subscribe(self):
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.chunks) and not self.finished:
+                    self.condition.wait()
+                chunks = self.chunks[index:]
+                index += len(chunks)
+                finished = self.finished and index >= len(self.chunks)
+            yield from chunks
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class _AsyncBroadcast:
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.updated = asyncio.Event()
+        # requests that read the stream, the first one included (guarded by the lock of SingleFlight)
+        self.readers = 1
+        self.task = None
+
+    def follow(self):
+        self.readers += 1
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self.updated.set()
+
+    def finish(self, error=None):
+        self.finished = True
+        self.error = error
+        self.updated.set()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                chunk = self.chunks[index]
+                index += 1
+                yield chunk
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            # the producer runs on the same event loop, hence nothing can be published between these two lines
+            self.updated.clear()
+            await self.updated.wait()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+        self._async_calls = {}
+        self._async_streams = {}
+        self._lock = threading.Lock()
+        self.leaders = self.joined = 0
+
+    def enabled(self):
+        return config.get("single_flight")["enabled"]
+
+    # follow is called with the joined call while the lock is held
+    def _join(self, calls, key, create, follow=None):
+        with self._lock:
+            call = calls.get(key)
+            if call is not None:
+                self.joined += 1
+                if follow is not None:
+                    follow(call)
+                return call, False
+            call = create()
+            calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def _leave(self, calls, key, call):
+        with self._lock:
+            if calls.get(key) is call:
+                del calls[key]
+
+    def do(self, key, function):
+        if not self.enabled():
+            return function()
+        call, leader = self._join(self._calls, key, _Call)
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            self._leave(self._calls, key, call)
+            call.done.set()
+
+    async def do_async(self, key, function):
+        if not self.enabled():
+            return await function()
+        task, leader = self._join(self._async_calls, key, lambda: asyncio.ensure_future(function()))
+        if leader:
+            task.add_done_callback(lambda task: self._finish_async(key, task))
+        # the call runs in its own task and is shielded, hence a cancelled request (the first one included) does not
+        # cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def _finish_async(self, key, task):
+        self._leave(self._async_calls, key, task)
+        # retrieves the exception so that it is not reported as never retrieved when every request was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    # function is called by the first request (upstream errors are raised to it) and returns the chunk generator
+    def stream(self, key, function):
+        if not self.enabled():
+            return function()
+        broadcast, leader = self._join(self._streams, key, _Broadcast, _Broadcast.follow)
+        if not leader:
+            return self._follow(broadcast)
+        try:
+            chunks = function()
+        except Exception as error:
+            self._leave(self._streams, key, broadcast)
+            broadcast.finish(error)
+            raise
+        return self._lead(key, broadcast, chunks)
+
+    # the first request sends the chunks while it publishes them, hence a stream that nobody joins takes no extra thread
+    def _lead(self, key, broadcast, chunks):
+        try:
+            for chunk in chunks:
+                broadcast.publish(chunk)
+                yield chunk
+        except GeneratorExit:
+            # the client disconnected - the joined requests still need the rest of the stream
+            if self._abandon(key, broadcast):
+                chunks.close()
+                broadcast.finish(Exception("The stream was cancelled"))
+            else:
+                threading.Thread(target=self._produce, args=(key, broadcast, chunks), daemon=True).start()
+            raise
+        except Exception as error:
+            broadcast.finish(error)
+            self._leave(self._streams, key, broadcast)
+            raise
+        broadcast.finish()
+        self._leave(self._streams, key, broadcast)
+
+    def _produce(self, key, broadcast, chunks):
+        try:
+            for chunk in chunks:
+                broadcast.publish(chunk)
+                # every joined request disconnected as well
+                if self._abandon(key, broadcast):
+                    chunks.close()
+                    broadcast.finish(Exception("The stream was cancelled"))
+                    return
+            broadcast.finish()
+        except Exception as error:
+            broadcast.finish(error)
+        self._leave(self._streams, key, broadcast)
+
+    # removes the stream when nobody reads it, hence later requests start a new one instead of joining a cut off stream
+    def _abandon(self, key, broadcast):
+        with self._lock:
+            if broadcast.readers:
+                return False
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+            return True
+
+    def _follow(self, broadcast):
+        try:
+            yield from broadcast.subscribe()
+        finally:
+            with self._lock:
+                broadcast.readers -= 1
+
+    # function returns an async chunk generator
+    def stream_async(self, key, function):
+        if not self.enabled():
+            return function()
+        broadcast, leader = self._join(self._async_streams, key, _AsyncBroadcast, _AsyncBroadcast.follow)
+        if leader:
+            async def produce():
+                try:
+                    async for chunk in function():
+                        broadcast.publish(chunk)
+                    broadcast.finish()
+                except Exception as error:
+                    broadcast.finish(error)
+                finally:
+                    self._leave(self._async_streams, key, broadcast)
+            broadcast.task = asyncio.get_running_loop().create_task(produce())
+        return self._follow_async(key, broadcast)
+
+    # the stream is cancelled (and removed) once no request reads it anymore
+    async def _follow_async(self, key, broadcast):
+        try:
+            async for chunk in broadcast.subscribe():
+                yield chunk
+        finally:
+            with self._lock:
+                broadcast.readers -= 1
+                abandoned = not broadcast.readers
+                if abandoned and self._async_streams.get(key) is broadcast:
+                    del self._async_streams[key]
+            if abandoned:
+                broadcast.task.cancel()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled(),
+                "in_flight": len(self._calls) + len(self._async_calls),
+                "streams_in_flight": len(self._streams) + len(self._async_streams),
+                "leaders": self.leaders,
+                "joined": self.joined,
+            }
+
+
+single_flight = SingleFlight()
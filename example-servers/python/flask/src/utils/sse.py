@@ -0,0 +1,93 @@
+from collections import namedtuple
+
+# Incremental Server-Sent Events parser that can be used by the streaming path of any provider.
+# Upstream chunks do not line up with events - an event (or even a multibyte UTF-8 character) can be split across two
+# chunks. The parser therefore keeps the unfinished line as bytes and only decodes complete lines, hence no events are
+# lost regardless of how the upstream response is chunked. Each byte is searched and decoded only once.
+# Event format: https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+
+SSEEvent = namedtuple("SSEEvent", ["event", "data", "id"])
+
+
+class SSEParser:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data = []
+        self._event = ""
+        self._id = None
+
+    # returns the events that were completed by the chunk
+    def feed(self, chunk):
+        buffer = self._buffer
+        # only the new bytes need to be searched as the buffer never contains a complete line
+        search_from = len(buffer)
+        buffer += chunk
+        end = buffer.rfind(b"\n", search_from)
+        if end == -1:
+            return []
+        # \n is never a part of a multibyte character, hence the complete lines are always safe to decode (once)
+        lines = buffer[:end].decode("utf-8").split("\n")
+        del buffer[:end + 1]
+        events = []
+        data = self._data
+        for line in lines:
+            if line.endswith("\r"):
+                line = line[:-1]
+            # fast path for the most common line
+            if line.startswith("data: "):
+                data.append(line[6:])
+                continue
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+                data = self._data
+        return events
+
+    # dispatches the last event if the stream ended without a trailing blank line
+    def flush(self):
+        events = self.feed(b"\n") if self._buffer else []
+        event = self._process_line("")
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line):
+        if not line:
+            if not self._data:
+                self._event = ""
+                return None
+            event = SSEEvent(self._event or "message", "\n".join(self._data), self._id)
+            self._data = []
+            self._event = ""
+            return event
+        if line[0] == ":":
+            # comment lines are used by some providers to keep the connection alive
+            return None
+        field, _, value = line.partition(":")
+        if value[:1] == " ":
+            value = value[1:]
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            self._id = value
+        return None
+
+
+def iter_events(chunks):
+    parser = SSEParser()
+    for chunk in chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+async def aiter_events(chunks):
+    parser = SSEParser()
+    async for chunk in chunks:
+        if chunk:
+            for event in parser.feed(chunk):
+                yield event
+    for event in parser.flush():
+        yield event
@@ -0,0 +1,289 @@
+from collections import deque
+from utils.metrics import metrics
+from utils.config import config
+import threading
+import asyncio
+import json
+import time
+
+# Frame writer shared by the streaming routes. Every frame keeps the Deep Chat streaming format:
+# data: {"text": "..."}\n\n - https://deepchat.dev/docs/connect/#Response
+# Only the text is JSON encoded (with the configured codec) and placed into a pre-encoded frame template, instead of
+# dumping a dictionary and formatting a string for every token. Tokens that arrive within the coalescing window are
+# joined into a single frame, hence fast models produce fewer (larger) writes and flushes per client. Deep Chat appends
+# the texts of the frames, hence the streamed message is the same.
+# The first token and the tokens of a stream that is slower than the window are sent straight away. Buffered tokens are
+# sent once the window has passed even when no further token arrives, hence the window is the upper bound of the added
+# latency. Coalescing is only used by the async app (aframes) - a sync stream can only send a frame when its next token
+# arrives, waiting for a deadline would take a second thread per stream, hence frames sends a frame per token.
+
+# Settings can be configured in the .env file (see .env.example):
+# SSE_COALESCE_MS - window in which tokens are joined into one frame by the async app (0 sends a frame per token)
+# SSE_COALESCE_BYTES - a frame is sent once its buffered text reaches this size
+# SSE_JSON_CODEC - json (default), orjson or ujson (the latter two need to be installed with pip)
+
+_PREFIX = b'data: {"text": '
+_SUFFIX = b'}\n\n'
+
+
+def _json_codec():
+    return lambda value: json.dumps(value).encode()
+
+
+def _orjson_codec():
+    import orjson
+    return orjson.dumps
+
+
+def _ujson_codec():
+    import ujson
+    return lambda value: ujson.dumps(value).encode()
+
+
+# name: function that returns an encoder of a value to JSON bytes - more codecs can be registered here (and added to the
+# SSE_JSON_CODEC choices in utils/config.py)
+CODECS = {"json": _json_codec, "orjson": _orjson_codec, "ujson": _ujson_codec}
+
+
+class SSEWriter:
+    def __init__(self):
+        self._codec = None
+        self._encode = None
+        self._lock = threading.Lock()
+        self._totals = {"streams": 0, "frames": 0, "tokens": 0, "bytes": 0}
+        # [second, frames, bytes] of the last 10 seconds
+        self._seconds = deque(maxlen=10)
+
+    # returns the codec that encodes the frames - the configured one or json when it is not installed
+    def codec(self):
+        if self._codec is None:
+            codec = config.get("sse_writer")["codec"]
+            try:
+                self._encode = CODECS[codec]()
+            except ImportError:
+                print(f"{codec} is not installed, SSE frames are encoded with json instead")
+                codec = "json"
+                self._encode = _json_codec()
+            self._codec = codec
+        return self._codec
+
+    def frame(self, text):
+        self.codec()
+        return _PREFIX + self._encode(text) + _SUFFIX
+
+    # returns the frames of a stream of texts - a frame per text
+    def frames(self, texts):
+        stream = _Stream(self, 0)
+        try:
+            for text in texts:
+                frame = stream.add(text)
+                if frame is not None:
+                    yield frame
+            frame = stream.flush()
+            if frame is not None:
+                yield frame
+        finally:
+            stream.close()
+
+    # async counterpart of frames - the texts are coalesced within the window
+    async def aframes(self, texts):
+        stream = _Stream(self, config.get("sse_writer")["window"])
+        if not stream.window:
+            try:
+                async for text in texts:
+                    yield stream.add(text)
+            finally:
+                stream.close()
+            return
+        # the texts are read by a task of the stream, hence the wait for the next text can end at the deadline of the
+        # buffered texts without cancelling (and thereby ending) the upstream stream
+        reader = _Reader(texts, stream.max_bytes)
+        try:
+            while not reader.finished():
+                await reader.wait(stream.deadline())
+                for text in reader.take():
+                    frame = stream.add(text)
+                    if frame is not None:
+                        yield frame
+                if stream.buffered() and not stream.remaining():
+                    # the window has passed without a new text
+                    yield stream.flush()
+            frame = stream.flush()
+            if frame is not None:
+                yield frame
+        finally:
+            reader.close()
+            stream.close()
+
+    def _commit(self, frames, tokens, size, second, ended):
+        with self._lock:
+            totals = self._totals
+            totals["frames"] += frames
+            totals["tokens"] += tokens
+            totals["bytes"] += size
+            totals["streams"] += ended
+            if not self._seconds or self._seconds[-1][0] != second:
+                self._seconds.append([second, 0, 0])
+            self._seconds[-1][1] += frames
+            self._seconds[-1][2] += size
+        metrics.inc("deepchat_sse_frames_total", (), frames)
+        metrics.inc("deepchat_sse_tokens_total", (), tokens)
+        metrics.inc("deepchat_sse_bytes_total", (), size)
+
+    # the rates are averaged over the last 10 seconds
+    def stats(self):
+        window = config.get("sse_writer")["window"]
+        now = int(time.monotonic())
+        with self._lock:
+            recent = [entry for entry in self._seconds if now - entry[0] < 10]
+            totals = dict(self._totals)
+        return dict(totals,
+                    frames_per_second=round(sum(entry[1] for entry in recent) / 10, 2),
+                    bytes_per_second=round(sum(entry[2] for entry in recent) / 10, 2),
+                    tokens_per_frame=round(totals["tokens"] / totals["frames"], 2) if totals["frames"] else 0,
+                    codec=self.codec(), coalesce_ms=window * 1000)
+
+
+# Coalescing state of a single stream - the counters are committed to the shared stats at most once a second so that
+# sending a frame does not take any locks
+class _Stream:
+    def __init__(self, writer, window):
+        writer.codec()
+        self._writer = writer
+        self._encode = writer._encode
+        self.window = window
+        self.max_bytes = config.get("sse_writer")["max_bytes"]
+        self._buffer = []
+        self._size = 0
+        self._started = 0
+        self._last_sent = float("-inf")
+        self._second = int(time.monotonic())
+        self._frames = self._tokens = self._bytes = 0
+
+    def add(self, text):
+        now = time.monotonic()
+        if not self._buffer and now - self._last_sent >= self.window:
+            self._last_sent = now
+            return self._send(text, 1, now)
+        if not self._buffer:
+            self._started = now
+        self._buffer.append(text)
+        self._size += len(text)
+        if now - self._started >= self.window or self._size >= self.max_bytes:
+            self._last_sent = now
+            return self.flush(now)
+        return None
+
+    def buffered(self):
+        return bool(self._buffer)
+
+    # time (time.monotonic) at which the buffered texts have to be sent or None when nothing is buffered
+    def deadline(self):
+        return self._started + self.window if self._buffer else None
+
+    # seconds until the buffered texts have to be sent
+    def remaining(self):
+        return max(0, self._started + self.window - time.monotonic())
+
+    def flush(self, now=None):
+        if not self._buffer:
+            return None
+        frame = self._send("".join(self._buffer), len(self._buffer), now or time.monotonic())
+        self._buffer = []
+        self._size = 0
+        return frame
+
+    def _send(self, text, tokens, now):
+        frame = _PREFIX + self._encode(text) + _SUFFIX
+        self._frames += 1
+        self._tokens += tokens
+        self._bytes += len(frame)
+        if now - self._second >= 1:
+            self._commit(0)
+        return frame
+
+    def _commit(self, ended):
+        self._writer._commit(self._frames, self._tokens, self._bytes, self._second, ended)
+        self._second = int(time.monotonic())
+        self._frames = self._tokens = self._bytes = 0
+
+    def close(self):
+        self._commit(1)
+
+
+
+# Reads the texts of an async stream in a task while aframes sends the frames. The writer waits for the next texts or for
+# the deadline of its buffered texts with a single timer per buffer (instead of a task and a timeout per text), and
+# takes all the texts that were read in the meantime at once. Reading pauses once max_bytes of texts have not been
+# taken yet, hence a fast upstream cannot fill the memory of a slow client.
+class _Reader:
+    def __init__(self, texts, max_bytes):
+        self._loop = asyncio.get_running_loop()
+        self._max_bytes = max_bytes
+        self._texts = []
+        self._size = 0
+        self._error = None
+        self._done = False
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._timer = None
+        self._deadline = None
+        self._task = self._loop.create_task(self._read(texts))
+
+    async def _read(self, texts):
+        try:
+            async for text in texts:
+                self._texts.append(text)
+                self._size += len(text)
+                self._ready.set()
+                if self._size >= self._max_bytes:
+                    self._room.clear()
+                    await self._room.wait()
+        except Exception as error:
+            self._error = error
+        finally:
+            self._done = True
+            self._ready.set()
+            # the stream is paused (not ended) when the reader is cancelled while it waits for room
+            if hasattr(texts, "aclose"):
+                await texts.aclose()
+
+    # waits until texts have been read or the deadline (time.monotonic) has passed
+    async def wait(self, deadline):
+        if deadline != self._deadline:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None if deadline is None else self._loop.call_later(
+                max(0, deadline - time.monotonic()), self._expire)
+            self._deadline = deadline
+        if not self._texts and not self._done:
+            self._ready.clear()
+            await self._ready.wait()
+
+    def _expire(self):
+        # the loop can run the timer slightly before the deadline, the next wait starts a new timer in that case
+        self._timer = self._deadline = None
+        self._ready.set()
+
+    def take(self):
+        texts = self._texts
+        self._texts = []
+        self._size = 0
+        self._room.set()
+        return texts
+
+    # True once the stream has ended and all its texts have been taken - the error of the stream is raised instead
+    def finished(self):
+        if self._texts or not self._done:
+            return False
+        if self._error is not None:
+            raise self._error
+        return True
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._task.cancel()
+
+
+sse_writer = SSEWriter()
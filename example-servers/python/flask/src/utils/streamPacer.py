@@ -0,0 +1,62 @@
+from utils.config import config
+import asyncio
+import time
+
+# Paces the chunks of any (sync or async) token generator - either with a fixed delay between chunks or at a
+# tokens-per-second rate. The chunks are scheduled against a deadline so that the time spent producing and sending a
+# chunk does not add up to the delay. In the async mode (asyncApp.py) a paced stream only awaits asyncio.sleep, hence
+# thousands of paced streams can share a single thread.
+
+# Settings can be configured in the .env file (see .env.example):
+# STREAM_CHUNK_DELAY - seconds between chunks
+# STREAM_TOKENS_PER_SECOND - rate of the chunks (takes precedence over STREAM_CHUNK_DELAY when set)
+
+
+class StreamPacer:
+    def __init__(self, delay=None, tokens_per_second=None):
+        self._delay = delay
+        self._tokens_per_second = tokens_per_second
+
+    def interval(self):
+        # values passed to the constructor take precedence over the settings
+        if self._tokens_per_second:
+            return 1 / self._tokens_per_second
+        if self._delay is not None:
+            return self._delay
+        settings = config.get("stream_pacer")
+        if settings["tokens_per_second"] > 0:
+            return 1 / settings["tokens_per_second"]
+        return settings["delay"]
+
+    def pace(self, chunks):
+        interval = self.interval()
+        next_time = None
+        for chunk in chunks:
+            now = time.monotonic()
+            if next_time is not None and next_time > now:
+                time.sleep(next_time - now)
+                # scheduling from the planned time prevents the sleep overshoot from accumulating
+                now = next_time
+            next_time = now + interval
+            yield chunk
+
+    # accepts both sync and async iterables
+    async def apace(self, chunks):
+        interval = self.interval()
+        loop = asyncio.get_running_loop()
+        next_time = None
+        async for chunk in chunks if hasattr(chunks, "__aiter__") else _aiter(chunks):
+            now = loop.time()
+            if next_time is not None and next_time > now:
+                await asyncio.sleep(next_time - now)
+                now = next_time
+            next_time = now + interval
+            yield chunk
+
+
+async def _aiter(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+stream_pacer = StreamPacer()
@@ -0,0 +1,220 @@
+from tempfile import TemporaryFile
+from utils.config import config
+from flask import Request
+from io import BytesIO
+import threading
+import resource
+import hashlib
+import weakref
+import uuid
+import sys
+import os
+
+# Streaming pass-through of uploaded files. Instead of reading every uploaded file into memory (file.read()) and then
+# encoding it again into a multipart body, uploads are piped to the upstream request in bounded chunks:
+# - UploadRequest keeps the files of a request in memory only while their total size is below the per-request ceiling,
+#   larger uploads are spilled to temporary files on disk as they are received. Werkzeug already spools every file to
+#   disk once it exceeds 500KB - the ceiling makes that threshold configurable and applies it to all files of the
+#   request up front (by its Content-Length), hence large files are written to disk directly instead of being copied
+#   there once they cross the threshold
+# - MultipartStream is a file-like multipart body with a known length that is read by the upstream client chunk by chunk
+
+# Settings can be configured in the .env file (see .env.example):
+# UPLOAD_MEMORY_LIMIT_KB - maximum size of the files of a single request that is kept in memory
+# UPLOAD_CHUNK_SIZE_KB - size of the chunks that are sent upstream
+
+def stream_size(stream):
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell() - position
+    stream.seek(position)
+    return size
+
+
+def iter_chunks(stream):
+    chunk_size = config.get("upload")["chunk_size"]
+    return iter(lambda: stream.read(chunk_size), b"")
+
+
+# An uploaded file that is sent as the raw body of an async upstream call - unlike a generator it has a known length and
+# can be rewound when the call is retried
+class FileBody:
+    def __init__(self, stream):
+        self._stream = stream
+        self._position = stream.tell()
+        self._length = stream_size(stream)
+
+    def __len__(self):
+        return self._length
+
+    def rewind(self):
+        self._stream.seek(self._position)
+
+    async def __aiter__(self):
+        for chunk in iter_chunks(self._stream):
+            yield chunk
+
+
+# sha256 of the file content (read in chunks) - the stream is rewound so that it can be sent afterwards
+def file_digest(file):
+    digest = hashlib.sha256()
+    for chunk in iter_chunks(file.stream):
+        digest.update(chunk)
+    file.stream.seek(0)
+    return digest.hexdigest().encode()
+
+
+# characters that would end a quoted parameter or the header - percent encoded as browsers and urllib3
+# (format_multipart_header_param) do
+_HEADER_PARAM_ESCAPES = {10: "%0A", 13: "%0D", 34: "%22"}
+
+
+# a Content-Disposition parameter, e.g. a filename chosen by the client cannot add headers or parts to the body
+def _header_param(name, value):
+    return f'{name}="{str(value).translate(_HEADER_PARAM_ESCAPES)}"'
+
+
+class MultipartStream:
+    # fields are regular form values and files are uploaded files (FileStorage) that are streamed from their position
+    def __init__(self, fields=None, files=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + self.boundary
+        self._parts = []
+        for name, value in (fields or {}).items():
+            header = (f'--{self.boundary}\r\nContent-Disposition: form-data; {_header_param("name", name)}\r\n\r\n'
+                      f'{value}\r\n').encode()
+            self._parts.append(header)
+        for name, file in (files or {}).items():
+            header = (f'--{self.boundary}\r\nContent-Disposition: form-data; {_header_param("name", name)}; '
+                      f'{_header_param("filename", file.filename)}\r\n'
+                      f'Content-Type: {file.mimetype or "application/octet-stream"}\r\n\r\n').encode()
+            self._parts.append(header)
+            self._parts.append(file.stream)
+            self._parts.append(b"\r\n")
+        self._parts.append(f"--{self.boundary}--\r\n".encode())
+        self._length = sum(len(part) if isinstance(part, bytes) else stream_size(part) for part in self._parts)
+        self._positions = [(part, part.tell()) for part in self._parts if not isinstance(part, bytes)]
+        self._index = 0
+        self._pending = b""
+        self.bytes_sent = 0
+
+    # the body is sent again from the start when the upstream call is retried
+    def rewind(self):
+        for stream, position in self._positions:
+            stream.seek(position)
+        self._index = 0
+        self._pending = b""
+        self.bytes_sent = 0
+
+    def __len__(self):
+        return self._length
+
+    # returns at most size bytes, hence only a single chunk of a file is held in memory at a time
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        chunks = []
+        remaining = size
+        # the pending bytes can be the rest of the last part (e.g. of the closing boundary)
+        while remaining > 0 and (self._pending or self._index < len(self._parts)):
+            if not self._pending:
+                part = self._parts[self._index]
+                if isinstance(part, bytes):
+                    self._pending = part
+                    self._index += 1
+                else:
+                    self._pending = part.read(min(remaining, config.get("upload")["chunk_size"]))
+                    if not self._pending:
+                        self._index += 1
+                        continue
+            chunk, self._pending = self._pending[:remaining], self._pending[remaining:]
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        data = b"".join(chunks)
+        self.bytes_sent += len(data)
+        return data
+
+    async def __aiter__(self):
+        chunk_size = config.get("upload")["chunk_size"]
+        for chunk in iter(lambda: self.read(chunk_size), b""):
+            yield chunk
+
+
+class UploadStats:
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, uploaded_bytes, memory_bytes, spilled):
+        with self._lock:
+            stats = self._routes.setdefault(route, {
+                "requests": 0, "uploaded_bytes": 0, "spilled_requests": 0, "estimated_peak_memory_bytes": 0})
+            stats["requests"] += 1
+            stats["uploaded_bytes"] += uploaded_bytes
+            stats["spilled_requests"] += 1 if spilled else 0
+            stats["estimated_peak_memory_bytes"] = max(stats["estimated_peak_memory_bytes"], memory_bytes)
+
+    # estimated_peak_memory_bytes is the largest amount of upload data a single request of the route held in memory - it
+    # is added up from the files kept in memory, the upload chunk and the buffers counted by hold_memory, it does not
+    # include the buffers of the upstream clients. process_peak_rss_mb is measured, but covers the whole process.
+    def stats(self):
+        # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+        with self._lock:
+            return {"process_peak_rss_mb": round(peak_rss_mb, 1), "routes": {k: dict(v) for k, v in self._routes.items()}}
+
+
+upload_stats = UploadStats()
+
+# the request of every uploaded file stream that is kept in memory or spilled to disk
+_stream_requests = weakref.WeakKeyDictionary()
+
+
+# Buffers that are derived from an uploaded file (e.g. a normalized image, see utils/imagePreprocessor.py) are counted
+# towards the memory of its request. The files are processed on other threads, hence the request is found by the stream.
+def hold_memory(stream, size):
+    request = _stream_requests.get(stream)
+    if request is not None:
+        request.hold_memory(size)
+
+
+# reads the rest of an uploaded file into memory (e.g. to send it in a micro-batch) and counts it towards the memory of
+# its request
+def read_into_memory(stream):
+    content = stream.read()
+    hold_memory(stream, len(content))
+    return content
+
+
+class UploadRequest(Request):
+    _upload_bytes = 0
+    _upload_spilled = False
+    _held_bytes = 0
+    _held_lock = threading.Lock()
+
+    # called by the form parser for every uploaded file of the request
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        self._upload_bytes = total_content_length or 0
+        if total_content_length is None or total_content_length > config.get("upload")["memory_limit"]:
+            self._upload_spilled = True
+            stream = TemporaryFile("rb+")
+        else:
+            stream = BytesIO()
+        _stream_requests[stream] = self
+        return stream
+
+    # the buffers of concurrently processed files are added up
+    def hold_memory(self, size):
+        with self._held_lock:
+            self._held_bytes += size
+
+    # called by Flask at the end of the request
+    def close(self):
+        if self._upload_bytes:
+            # in addition to the files kept in memory - one chunk is held while a file is streamed upstream and the
+            # buffers derived from the files (e.g. normalized images) are held while they are sent
+            memory_bytes = (config.get("upload")["chunk_size"] + (0 if self._upload_spilled else self._upload_bytes)
+                            + self._held_bytes)
+            upload_stats.record(self.path, self._upload_bytes, memory_bytes, self._upload_spilled)
+        super().close()
@@ -0,0 +1,21 @@
+import pytest
+import sys
+import os
+
+# Run from the parent directory: python -m pytest tests (pip install pytest)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from utils.config import config  # noqa: E402
+
+
+# sets environment variables and reloads the settings (see utils/config.py) - the previous values are restored after
+# the test
+@pytest.fixture
+def settings(monkeypatch):
+    def apply(**values):
+        for name, value in values.items():
+            monkeypatch.setenv(name, str(value))
+        config.load()
+    yield apply
+    monkeypatch.undo()
+    config.load()
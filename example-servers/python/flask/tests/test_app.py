@@ -0,0 +1,58 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.artifactStore import artifact_store
+from utils.resilience import resilience
+import importlib
+import base64
+import threading
+import pytest
+import json
+
+BODY = {"messages": [{"role": "user", "text": "Hello"}], "model": "gpt-4o"}
+
+
+# provider stub that answers every request with a JSON error, as the providers do e.g. for an invalid API key
+class ErrorHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({"message": "invalid api token", "error": {"message": "invalid api token"}}).encode()
+        self.send_response(401)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def app(settings):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ErrorHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub = f"http://127.0.0.1:{server.server_port}"
+    settings(OPENAI_API_KEY="test", COHERE_API_KEY="test", UPSTREAM_RETRIES=0,
+             UPSTREAM_URL_OVERRIDES=f"https://api.openai.com={stub},https://api.cohere.ai={stub}")
+    resilience._providers.clear()
+    yield importlib.import_module("app").app
+    resilience._providers.clear()
+    server.shutdown()
+    server.server_close()
+
+
+# the status of the upstream response is checked before the stream starts, hence the error is a JSON response
+@pytest.mark.parametrize("route", ["/openai-chat-stream", "/cohere-chat-stream", "/cohere-generate-stream"])
+def test_upstream_error_is_a_json_error_instead_of_a_stream(app, route):
+    response = app.test_client().post(route, json=BODY)
+    assert response.status_code == 500
+    assert response.get_json() == {"error": "invalid api token"}
+
+
+def test_artifact_is_served_with_its_content_hash_as_etag(app, settings, tmp_path):
+    settings(ARTIFACT_STORE_DIR=str(tmp_path))
+    name = artifact_store.save_base64(base64.b64encode(b"image").decode(), "png")
+    client = app.test_client()
+    response = client.get(f"/artifacts/{name}")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{name.split(".")[0]}"'
+    assert response.cache_control.max_age == 31536000
+    assert client.get(f"/artifacts/{name}", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
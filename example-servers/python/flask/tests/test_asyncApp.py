@@ -0,0 +1,60 @@
+from utils.artifactStore import artifact_store
+from utils.resilience import resilience
+import importlib
+import base64
+import asyncio
+import pytest
+
+BODY = {"messages": [{"role": "user", "text": "Hello"}], "model": "gpt-4o"}
+
+# nothing listens on this port - a request that gets past the admission control fails with a connection error
+UNREACHABLE = "http://127.0.0.1:9"
+
+
+@pytest.fixture
+def app(settings):
+    pytest.importorskip("quart")
+    settings(OPENAI_API_KEY="test", COHERE_API_KEY="test", PROVIDER_CONCURRENCY=1, PROVIDER_QUEUE_SIZE=0,
+             CIRCUIT_FAILURE_THRESHOLD=1, UPSTREAM_RETRIES=0,
+             UPSTREAM_URL_OVERRIDES=f"https://api.openai.com={UNREACHABLE},https://api.cohere.ai={UNREACHABLE}")
+    # the providers keep the settings they were created with
+    resilience._providers.clear()
+    yield importlib.import_module("asyncApp").app
+    resilience._providers.clear()
+
+
+def test_stream_is_shed_with_429_before_the_response_starts(app):
+    async def run():
+        held = await resilience.acquire_async("openai")
+        try:
+            return await app.test_client().post("/openai-chat-stream", json=BODY)
+        finally:
+            resilience.release_async(*held)
+    response = asyncio.run(run())
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_stream_fails_fast_with_503_when_the_circuit_is_open(app):
+    resilience.record("cohere", False)
+    response = asyncio.run(app.test_client().post("/cohere-chat-stream", json=BODY))
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_upstream_connection_error_is_a_json_error(app):
+    response = asyncio.run(app.test_client().post("/cohere-generate-stream", json=BODY))
+    assert response.status_code == 500
+    assert asyncio.run(response.get_json()) == {"error": "Internal service error"}
+
+
+def test_artifact_is_served_with_the_caching_headers_of_the_sync_app(app, settings, tmp_path):
+    settings(ARTIFACT_STORE_DIR=str(tmp_path))
+    name = artifact_store.save_base64(base64.b64encode(b"image").decode(), "png")
+    client = app.test_client()
+    response = asyncio.run(client.get(f"/artifacts/{name}"))
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{name.split(".")[0]}"'
+    assert response.cache_control.max_age == 31536000
+    response = asyncio.run(client.get(f"/artifacts/{name}", headers={"If-None-Match": response.headers["ETag"]}))
+    assert response.status_code == 304
@@ -0,0 +1,26 @@
+from utils.config import config
+import pytest
+
+
+def test_server_settings_are_read_without_the_other_sections(settings):
+    settings(PORT=9000, SERVER_WORKERS=3)
+    sections = config.read("server")
+    assert list(sections) == ["server"]
+    assert sections["server"]["port"] == 9000
+    assert sections["server"]["workers"] == 3
+
+
+@pytest.mark.parametrize("name, value", [("PORT", "abc"), ("SERVER_THREADS", "0"), ("SERVER_BACKLOG", "-1")])
+def test_invalid_server_setting_names_the_variable(monkeypatch, name, value):
+    monkeypatch.setenv(name, value)
+    with pytest.raises(ValueError, match=name):
+        config.read("server")
+
+
+def test_invalid_settings_of_every_section_are_reported_together(monkeypatch):
+    monkeypatch.setenv("PORT", "abc")
+    monkeypatch.setenv("UPSTREAM_RETRIES", "two")
+    with pytest.raises(ValueError) as error:
+        config.read("server", "resilience")
+    assert "PORT" in str(error.value)
+    assert "UPSTREAM_RETRIES" in str(error.value)
@@ -0,0 +1,164 @@
+from utils.resilience import Resilience, ProviderUnavailable, GuardedService, guards_itself
+import threading
+import asyncio
+import pytest
+import time
+
+
+@pytest.fixture
+def resilience(settings):
+    settings(PROVIDER_CONCURRENCY=1, PROVIDER_QUEUE_SIZE=1, PROVIDER_QUEUE_TIMEOUT=1, CIRCUIT_FAILURE_THRESHOLD=2,
+             CIRCUIT_OPEN_SECONDS=0.05, UPSTREAM_RETRIES=2, UPSTREAM_RETRY_BACKOFF_MS=10)
+    return Resilience()
+
+
+# acquires a slot of the provider on a thread and records whether it got one or the status it was shed with
+def acquire_on_thread(resilience, outcomes):
+    def acquire():
+        try:
+            resilience.release(*resilience.acquire("openai"))
+            outcomes.append("acquired")
+        except ProviderUnavailable as error:
+            outcomes.append(error.status)
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    while resilience.provider("openai").waiting < 1:
+        time.sleep(0.001)
+    return thread
+
+
+# ------------------ ADMISSION ------------------
+
+def test_request_is_shed_with_429_when_the_queue_is_full(resilience):
+    held = resilience.acquire("openai")
+    outcomes = []
+    waiting = acquire_on_thread(resilience, outcomes)
+    with pytest.raises(ProviderUnavailable) as error:
+        resilience.acquire("openai")
+    assert error.value.status == 429
+    assert error.value.retry_after == 1
+    # the queued request gets the slot once it is released
+    resilience.release(*held)
+    waiting.join()
+    assert outcomes == ["acquired"]
+    assert resilience.stats()["providers"]["openai"]["shed_queue_full"] == 1
+
+
+def test_request_that_waited_too_long_gets_503(resilience, settings):
+    settings(PROVIDER_QUEUE_TIMEOUT=0.05)
+    resilience = Resilience()
+    held = resilience.acquire("openai")
+    outcomes = []
+    acquire_on_thread(resilience, outcomes).join()
+    assert outcomes == [503]
+    resilience.release(*held)
+    resilience.release(*resilience.acquire("openai"))
+    assert resilience.stats()["providers"]["openai"]["in_flight"] == 0
+
+
+def test_async_admission_sheds_when_the_queue_is_full(resilience, settings):
+    settings(PROVIDER_QUEUE_SIZE=0)
+    resilience = Resilience()
+
+    async def run():
+        held = await resilience.acquire_async("openai")
+        try:
+            with pytest.raises(ProviderUnavailable) as error:
+                await resilience.acquire_async("openai")
+            return error.value.status
+        finally:
+            resilience.release_async(*held)
+    assert asyncio.run(run()) == 429
+
+
+# ------------------ CIRCUIT BREAKER ------------------
+
+def test_circuit_opens_after_consecutive_failures(resilience):
+    resilience.record("cohere", False)
+    resilience.release(*resilience.acquire("cohere"))
+    resilience.record("cohere", False)
+    with pytest.raises(ProviderUnavailable) as error:
+        resilience.acquire("cohere")
+    assert error.value.status == 503
+    assert resilience.stats()["providers"]["cohere"]["state"] == "open"
+
+
+def test_success_resets_the_failure_count(resilience):
+    resilience.record("cohere", False)
+    resilience.record("cohere", True)
+    resilience.record("cohere", False)
+    assert resilience.stats()["providers"]["cohere"]["state"] == "closed"
+
+
+def test_half_open_circuit_lets_a_single_probe_through(resilience, settings):
+    settings(PROVIDER_CONCURRENCY=0)
+    resilience = Resilience()
+    resilience.record("cohere", False)
+    resilience.record("cohere", False)
+    time.sleep(0.06)
+    probe = resilience.acquire("cohere")
+    assert probe[1] is True
+    with pytest.raises(ProviderUnavailable):
+        resilience.acquire("cohere")
+    resilience.record("cohere", True)
+    resilience.release(*probe)
+    assert resilience.stats()["providers"]["cohere"]["state"] == "closed"
+
+
+def test_failed_probe_opens_the_circuit_again(resilience):
+    resilience.record("cohere", False)
+    resilience.record("cohere", False)
+    time.sleep(0.06)
+    probe = resilience.acquire("cohere")
+    resilience.record("cohere", False)
+    resilience.release(*probe)
+    assert resilience.stats()["providers"]["cohere"]["state"] == "open"
+
+
+# ------------------ GUARDED SERVICE ------------------
+
+class Service:
+    def upstream(self):
+        return "upstream"
+
+    @guards_itself
+    def cached(self):
+        return "cached"
+
+
+def test_methods_that_guard_themselves_are_not_wrapped(resilience):
+    service = GuardedService(resilience, "cohere", Service())
+    resilience.record("cohere", False)
+    resilience.record("cohere", False)
+    with pytest.raises(ProviderUnavailable):
+        service.upstream()
+    # e.g. a response cache hit is answered while the circuit is open
+    assert service.cached() == "cached"
+    with pytest.raises(ProviderUnavailable):
+        resilience.call("cohere", lambda: "upstream")
+
+
+def test_call_releases_the_slot_when_the_function_fails(resilience):
+    with pytest.raises(ValueError):
+        resilience.call("openai", lambda: int("not a number"))
+    assert asyncio.run(resilience.call_async("openai", lambda: asyncio.sleep(0, "result"))) == "result"
+    assert resilience.stats()["providers"]["openai"]["in_flight"] == 0
+
+
+# ------------------ RETRIES ------------------
+
+def test_retry_delay_stops_after_the_configured_retries(resilience):
+    assert 0 <= resilience.retry_delay("openai", 0) <= 0.01
+    assert 0 <= resilience.retry_delay("openai", 1) <= 0.02
+    assert resilience.retry_delay("openai", 2) is None
+
+
+def test_retry_delay_uses_retry_after_up_to_the_maximum(resilience):
+    assert resilience.retry_delay("openai", 0, "3") == 3
+    assert resilience.retry_delay("openai", 0, "3600") == 10
+
+
+def test_no_retries_while_the_circuit_is_open(resilience):
+    resilience.record("openai", False)
+    resilience.record("openai", False)
+    assert resilience.retry_delay("openai", 0) is None
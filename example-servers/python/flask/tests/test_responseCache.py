@@ -0,0 +1,43 @@
+from utils.responseCache import ResponseCache
+import asyncio
+
+
+def test_payload_function_is_not_called_when_the_route_is_not_cached(settings):
+    settings(RESPONSE_CACHE_ROUTES="cohere-summarize")
+    cache = ResponseCache()
+    digests = []
+
+    def digest():
+        digests.append(True)
+        return b"file"
+    assert cache.cached("huggingface-image", "model", digest, lambda: {"text": "cat"}) == {"text": "cat"}
+    assert digests == []
+    assert cache.stats()["misses"] == 0
+
+
+def test_cached_route_answers_hits_without_computing(settings):
+    settings(RESPONSE_CACHE_ROUTES="huggingface-image")
+    cache = ResponseCache()
+    computed = []
+
+    def compute():
+        computed.append(True)
+        return {"text": "cat"}
+    for _ in range(2):
+        assert cache.cached("huggingface-image", "model", lambda: b"file", compute) == {"text": "cat"}
+    assert len(computed) == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_async_cached_route_accepts_a_payload_function(settings):
+    settings(RESPONSE_CACHE_ROUTES="huggingface-image")
+    cache = ResponseCache()
+
+    async def compute():
+        return {"text": "cat"}
+
+    async def run():
+        await cache.cached_async("huggingface-image", "model", lambda: b"file", compute)
+        return await cache.cached_async("huggingface-image", "model", b"file", compute)
+    assert asyncio.run(run()) == {"text": "cat"}
+    assert cache.stats()["hits"] == 1
@@ -0,0 +1,189 @@
+from utils.singleFlight import SingleFlight
+import threading
+import asyncio
+import pytest
+import time
+
+
+@pytest.fixture
+def single_flight(settings):
+    settings(SINGLE_FLIGHT="true")
+    return SingleFlight()
+
+
+# ------------------ CALLS ------------------
+
+def test_identical_calls_share_the_first_call(single_flight):
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def call():
+        calls.append(True)
+        started.set()
+        release.wait()
+        return "result"
+    results = []
+    leader = threading.Thread(target=lambda: results.append(single_flight.do("key", call)))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=lambda: results.append(single_flight.do("key", call)))
+    follower.start()
+    while single_flight.joined < 1:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    follower.join()
+    assert results == ["result", "result"]
+    assert len(calls) == 1
+    assert single_flight.stats()["in_flight"] == 0
+
+
+def test_error_of_the_first_call_is_raised_to_the_joined_calls(single_flight):
+    started, release = threading.Event(), threading.Event()
+
+    def call():
+        started.set()
+        release.wait()
+        raise ValueError("upstream failed")
+    errors = []
+
+    def request():
+        try:
+            single_flight.do("key", call)
+        except ValueError as error:
+            errors.append(error)
+    threads = [threading.Thread(target=request) for _ in range(2)]
+    threads[0].start()
+    started.wait()
+    threads[1].start()
+    while single_flight.joined < 1:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2
+
+
+def test_async_calls_share_the_first_call(single_flight):
+    calls = []
+
+    async def call():
+        calls.append(True)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(*(single_flight.do_async("key", call) for _ in range(3)))
+    assert asyncio.run(run()) == ["result"] * 3
+    assert len(calls) == 1
+    assert single_flight.stats()["in_flight"] == 0
+
+
+def test_cancelled_first_async_call_does_not_cancel_the_joined_ones(single_flight):
+    async def call():
+        await asyncio.sleep(0.02)
+        return "result"
+
+    async def run():
+        leader = asyncio.ensure_future(single_flight.do_async("key", call))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(single_flight.do_async("key", call))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower, leader.cancelled()
+    assert asyncio.run(run()) == ("result", True)
+
+
+# ------------------ STREAMS ------------------
+
+# a stream that produces its chunks once they are released
+class Upstream:
+    def __init__(self, count):
+        self.count = count
+        self.released = threading.Semaphore(0)
+        self.closed = False
+
+    def chunks(self):
+        try:
+            for index in range(self.count):
+                self.released.acquire()
+                yield index
+        finally:
+            self.closed = True
+
+
+def test_joined_stream_receives_the_produced_and_the_live_chunks(single_flight):
+    upstream = Upstream(3)
+    leader = single_flight.stream("key", upstream.chunks)
+    upstream.released.release()
+    assert next(leader) == 0
+    follower = single_flight.stream("key", upstream.chunks)
+    upstream.released.release(2)
+    assert list(leader) == [1, 2]
+    assert list(follower) == [0, 1, 2]
+    assert single_flight.stats()["streams_in_flight"] == 0
+
+
+def test_stream_continues_for_the_joined_requests_when_the_first_disconnects(single_flight):
+    upstream = Upstream(3)
+    leader = single_flight.stream("key", upstream.chunks)
+    upstream.released.release()
+    next(leader)
+    follower = single_flight.stream("key", upstream.chunks)
+    leader.close()
+    upstream.released.release(2)
+    assert list(follower) == [0, 1, 2]
+    assert upstream.closed
+
+
+def test_stream_is_closed_when_the_only_request_disconnects(single_flight):
+    upstream = Upstream(3)
+    leader = single_flight.stream("key", upstream.chunks)
+    upstream.released.release()
+    next(leader)
+    leader.close()
+    assert upstream.closed
+    assert single_flight.stats()["streams_in_flight"] == 0
+
+
+def test_async_joined_stream_receives_every_chunk(single_flight):
+    async def chunks():
+        for index in range(3):
+            await asyncio.sleep(0.001)
+            yield index
+
+    async def run():
+        leader = single_flight.stream_async("key", chunks)
+        first = await leader.__anext__()
+        follower = single_flight.stream_async("key", chunks)
+        return [first] + [chunk async for chunk in leader], [chunk async for chunk in follower]
+    assert asyncio.run(run()) == ([0, 1, 2], [0, 1, 2])
+    assert single_flight.stats()["streams_in_flight"] == 0
+
+
+def test_async_stream_is_cancelled_once_no_request_reads_it(single_flight):
+    closed = []
+
+    async def chunks():
+        try:
+            while True:
+                await asyncio.sleep(0.001)
+                yield "chunk"
+        finally:
+            closed.append(True)
+
+    async def run():
+        leader = single_flight.stream_async("key", chunks)
+        await leader.__anext__()
+        follower = single_flight.stream_async("key", chunks)
+        await follower.__anext__()
+        await leader.aclose()
+        # the joined request still reads the stream
+        assert await follower.__anext__() == "chunk"
+        assert not closed
+        await follower.aclose()
+        await asyncio.sleep(0.01)
+        # asyncio.run cancels the remaining tasks once run returns
+        return list(closed)
+    assert asyncio.run(run()) == [True]
+    assert single_flight.stats()["streams_in_flight"] == 0
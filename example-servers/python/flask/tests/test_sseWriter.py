@@ -0,0 +1,131 @@
+from utils.sseWriter import SSEWriter, _Stream
+import asyncio
+import pytest
+import json
+import time
+
+
+@pytest.fixture
+def writer(settings):
+    settings(SSE_JSON_CODEC="json", SSE_COALESCE_MS=50, SSE_COALESCE_BYTES=10)
+    return SSEWriter()
+
+
+def texts_of(frames):
+    return [json.loads(frame[len(b"data: "):])["text"] for frame in frames]
+
+
+def collect(frames):
+    async def run():
+        return [frame async for frame in frames]
+    return asyncio.run(run())
+
+
+async def slow_texts(texts, delay):
+    for text in texts:
+        await asyncio.sleep(delay)
+        yield text
+
+
+# ------------------ STREAM ------------------
+
+def test_first_text_is_sent_straight_away(writer):
+    stream = _Stream(writer, 0.05)
+    assert texts_of([stream.add("Hello")]) == ["Hello"]
+    assert stream.add(" world") is None
+    assert stream.buffered()
+
+
+def test_buffered_texts_are_joined_into_one_frame(writer):
+    stream = _Stream(writer, 0.05)
+    stream.add("a")
+    for text in ("b", "c", "d"):
+        assert stream.add(text) is None
+    assert texts_of([stream.flush()]) == ["bcd"]
+    assert stream.flush() is None
+    stream.close()
+    assert writer.stats()["frames"] == 2
+    assert writer.stats()["tokens"] == 4
+
+
+def test_frame_is_sent_once_the_buffer_reaches_max_bytes(writer):
+    stream = _Stream(writer, 0.05)
+    stream.add("a")
+    assert stream.add("12345") is None
+    assert texts_of([stream.add("67890")]) == ["1234567890"]
+    assert not stream.buffered()
+
+
+def test_frame_is_sent_once_the_window_has_passed(writer):
+    stream = _Stream(writer, 0.05)
+    stream.add("a")
+    stream.add("b")
+    assert stream.remaining() > 0
+    time.sleep(0.06)
+    assert stream.remaining() == 0
+    assert texts_of([stream.add("c")]) == ["bc"]
+
+
+def test_without_a_window_every_text_is_a_frame(writer):
+    assert texts_of(writer.frames(["a", "b", "c"])) == ["a", "b", "c"]
+
+
+# ------------------ ASYNC FRAMES ------------------
+
+def test_async_frames_keep_the_text(writer):
+    texts = ["Hello", " ", "world", "żółć", "\n", "\""] * 20
+    frames = collect(writer.aframes(slow_texts(texts, 0)))
+    assert "".join(texts_of(frames)) == "".join(texts)
+    assert len(frames) < len(texts)
+
+
+def test_buffered_texts_are_sent_at_the_deadline_without_a_new_text(writer):
+    async def texts():
+        yield "a"
+        yield "b"
+        await asyncio.sleep(0.2)
+        yield "c"
+
+    async def run():
+        frames = writer.aframes(texts())
+        first = await frames.__anext__()
+        start = time.monotonic()
+        second = await frames.__anext__()
+        elapsed = time.monotonic() - start
+        rest = [frame async for frame in frames]
+        return texts_of([first, second] + rest), elapsed
+    texts, elapsed = asyncio.run(run())
+    assert texts == ["a", "b", "c"]
+    assert elapsed < 0.15
+
+
+def test_error_of_the_texts_is_raised(writer):
+    async def texts():
+        yield "a"
+        raise ValueError("upstream failed")
+    with pytest.raises(ValueError):
+        collect(writer.aframes(texts()))
+
+
+# without a delay the reader is paused (it has read max_bytes that were not taken yet) when the frames are closed
+@pytest.mark.parametrize("delay", [0, 0.001])
+def test_closing_the_frames_closes_the_texts(writer, delay):
+    closed = []
+
+    async def texts():
+        try:
+            while True:
+                yield "text"
+                if delay:
+                    await asyncio.sleep(delay)
+        finally:
+            closed.append(True)
+
+    async def run():
+        frames = writer.aframes(texts())
+        await frames.__anext__()
+        await frames.aclose()
+        # the reader task is cancelled and closes the texts
+        await asyncio.sleep(0.01)
+    asyncio.run(run())
+    assert closed == [True]
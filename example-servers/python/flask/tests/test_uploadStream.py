@@ -0,0 +1,25 @@
+from utils.uploadStream import MultipartStream
+from werkzeug.datastructures import FileStorage
+from io import BytesIO
+
+
+def create_file(filename, content=b"image"):
+    return FileStorage(stream=BytesIO(content), filename=filename, content_type="image/png")
+
+
+def test_body_has_the_announced_length_and_can_be_read_again():
+    form = MultipartStream(fields={"prompt": "a cat"}, files={"image": create_file("cat.png")})
+    body = form.read()
+    assert len(body) == len(form)
+    form.rewind()
+    assert b"".join(iter(lambda: form.read(7), b"")) == body
+    assert b'name="image"; filename="cat.png"\r\nContent-Type: image/png\r\n\r\nimage\r\n' in body
+
+
+def test_filename_and_field_names_cannot_add_headers_or_parts():
+    filename = 'cat.png"\r\nContent-Type: text/html\r\n\r\n--boundary'
+    form = MultipartStream(fields={'prompt"\r\nX-Injected: 1': "a cat"}, files={"image": create_file(filename)})
+    body = form.read()
+    assert b'filename="cat.png%22%0D%0AContent-Type: text/html%0D%0A%0D%0A--boundary"' in body
+    assert b'name="prompt%22%0D%0AX-Injected: 1"' in body
+    assert body.count(b"\r\nContent-Type: ") == 1